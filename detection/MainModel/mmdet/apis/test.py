@@ -3,6 +3,7 @@ import pickle
 import shutil
 import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import mmcv
 import torch
@@ -10,18 +11,61 @@ import torch.distributed as dist
 from mmcv.image import tensor2imgs
 from mmcv.runner import get_dist_info
 
-from mmdet.core import encode_mask_results
+from mmdet.core import encode_mask_results, fuse_boxes
+
+
+def encode_results(result):
+    """Encode the masks of a batch of results with RLE."""
+    if isinstance(result[0], tuple):
+        result = [(bbox_results, encode_mask_results(mask_results))
+                  for bbox_results, mask_results in result]
+    return result
+
+
+def restore_order(results, data_loader):
+    """Put results back in dataset order if the sampler reordered them."""
+    sampler = data_loader.sampler
+    if hasattr(sampler, 'restore_order'):
+        results = sampler.restore_order(results)
+    return results
 
 
 def single_gpu_test(model,
                     data_loader,
                     show=False,
                     out_dir=None,
-                    show_score_thr=0.3):
+                    show_score_thr=0.3,
+                    postprocess_workers=1):
+    """Test model with a single gpu.
+
+    Only mask RLE encoding is moved off the test loop: for models with a
+    mask head it runs in ``postprocess_workers`` background threads and
+    overlaps with the forward of the next batch. NMS and rescaling run
+    inside the heads' ``get_bboxes`` as part of the forward, so box-only
+    models (e.g. Faster R-CNN, VFNet, GFLv2) get no postprocess overlap.
+    Results are returned in dataset order, also when the sampler (e.g.
+    ``ShapeBucketSampler``) visits the images in another order.
+
+    Args:
+        model (nn.Module): Model to be tested.
+        data_loader (nn.Dataloader): Pytorch data loader.
+        show (bool): Whether to show the results.
+        out_dir (str, optional): Directory to save the painted images.
+        show_score_thr (float): Score threshold of the shown boxes.
+        postprocess_workers (int): Threads encoding the mask results, 0 to
+            encode them in the test loop. Not used by models without a mask
+            head. Default: 1.
+
+    Returns:
+        list: The prediction results.
+    """
     model.eval()
     results = []
     dataset = data_loader.dataset
     prog_bar = mmcv.ProgressBar(len(dataset))
+    with_mask = getattr(getattr(model, 'module', model), 'with_mask', False)
+    executor = ThreadPoolExecutor(postprocess_workers) if (
+        with_mask and postprocess_workers > 0) else None
     for i, data in enumerate(data_loader):
         with torch.no_grad():
             result = model(return_loss=False, rescale=True, **data)
@@ -56,14 +100,67 @@ def single_gpu_test(model,
                     score_thr=show_score_thr)
 
         # encode mask results
-        if isinstance(result[0], tuple):
-            result = [(bbox_results, encode_mask_results(mask_results))
-                      for bbox_results, mask_results in result]
-        results.extend(result)
+        if executor is not None:
+            results.append(executor.submit(encode_results, result))
+        else:
+            results.append(encode_results(result))
 
         for _ in range(batch_size):
             prog_bar.update()
-    return results
+    if executor is not None:
+        results = [future.result() for future in results]
+        executor.shutdown()
+    results = [result for batch in results for result in batch]
+    return restore_order(results, data_loader)
+
+
+def multi_model_test(models, data_loader, fusion_cfg=None):
+    """Test several models on the same images.
+
+    Each batch is loaded once and fed to every model. With a
+    :obj:`MultiPipelineDataset` the batch holds the data of every distinct
+    test pipeline and each model gets the one of its own pipeline, otherwise
+    all models share the data of the dataset's pipeline.
+
+    Args:
+        models (list[nn.Module]): Models to be tested.
+        data_loader (nn.Dataloader): Pytorch data loader.
+        fusion_cfg (dict, optional): Keyword arguments of
+            :func:`mmdet.core.fuse_boxes`. If given, the boxes of all models
+            are fused batch by batch and mask results are dropped.
+
+    Returns:
+        list: The fused results if ``fusion_cfg`` is given, otherwise the
+            results of each model in the ``single_gpu_test`` format.
+    """
+    for model in models:
+        model.eval()
+    model_results = [[] for _ in models]
+    fused_results = []
+    dataset = data_loader.dataset
+    pipeline_inds = getattr(dataset, 'pipeline_inds', None)
+    prog_bar = mmcv.ProgressBar(len(dataset))
+    for data in data_loader:
+        batch_results = []
+        with torch.no_grad():
+            for i, model in enumerate(models):
+                model_data = data if pipeline_inds is None else data[
+                    pipeline_inds[i]]
+                batch_results.append(
+                    model(return_loss=False, rescale=True, **model_data))
+
+        if fusion_cfg is not None:
+            fused_results.extend(
+                fuse_boxes(list(zip(*batch_results)), **fusion_cfg))
+        else:
+            for results, result in zip(model_results, batch_results):
+                results.extend(encode_results(result))
+
+        for _ in range(len(batch_results[0])):
+            prog_bar.update()
+    if fusion_cfg is not None:
+        return restore_order(fused_results, data_loader)
+    return [restore_order(results, data_loader) for results in model_results]
 
 
 def multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
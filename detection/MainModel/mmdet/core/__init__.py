@@ -4,4 +4,5 @@ from .evaluation import *  # noqa: F401, F403
 from .export import *  # noqa: F401, F403
 from .mask import *  # noqa: F401, F403
 from .post_processing import *  # noqa: F401, F403
+from .results import *  # noqa: F401, F403
 from .utils import *  # noqa: F401, F403
@@ -56,6 +56,27 @@ def average_precision(recalls, precisions, mode='area'):
     return ap
 
 
+def _gt_ignore_per_range(gt_ignore_inds, gt_areas, area_ranges):
+    """Whether each gt is ignored in each area range, (num_scales, n)."""
+    gt_ignore = np.tile(gt_ignore_inds, (len(area_ranges), 1))
+    for k, (min_area, max_area) in enumerate(area_ranges):
+        # if no area range is specified, no gt is ignored for its area
+        if min_area is not None:
+            gt_ignore[k] |= (gt_areas < min_area) | (gt_areas >= max_area)
+    return gt_ignore
+
+
+def _in_area_ranges(det_bboxes, area_ranges):
+    """Whether each det is within each area range, (num_scales, m)."""
+    in_ranges = np.ones((len(area_ranges), det_bboxes.shape[0]), dtype=bool)
+    det_areas = (det_bboxes[:, 2] - det_bboxes[:, 0]) * (
+        det_bboxes[:, 3] - det_bboxes[:, 1])
+    for k, (min_area, max_area) in enumerate(area_ranges):
+        if min_area is not None:
+            in_ranges[k] = (det_areas >= min_area) & (det_areas < max_area)
+    return in_ranges
+
+
 def tpfp_imagenet(det_bboxes,
                   gt_bboxes,
                   gt_bboxes_ignore=None,
@@ -110,43 +131,31 @@ def tpfp_imagenet(det_bboxes,
                           default_iou_thr)
     # sort all detections by scores in descending order
     sort_inds = np.argsort(-det_bboxes[:, -1])
-    for k, (min_area, max_area) in enumerate(area_ranges):
-        gt_covered = np.zeros(num_gts, dtype=bool)
-        # if no area range is specified, gt_area_ignore is all False
-        if min_area is None:
-            gt_area_ignore = np.zeros_like(gt_ignore_inds, dtype=bool)
-        else:
-            gt_areas = gt_w * gt_h
-            gt_area_ignore = (gt_areas < min_area) | (gt_areas >= max_area)
-        for i in sort_inds:
-            max_iou = -1
-            matched_gt = -1
-            # find best overlapped available gt
-            for j in range(num_gts):
-                # different from PASCAL VOC: allow finding other gts if the
-                # best overlapped ones are already matched by other det bboxes
-                if gt_covered[j]:
-                    continue
-                elif ious[i, j] >= iou_thrs[j] and ious[i, j] > max_iou:
-                    max_iou = ious[i, j]
-                    matched_gt = j
-            # there are 4 cases for a det bbox:
-            # 1. it matches a gt, tp = 1, fp = 0
-            # 2. it matches an ignored gt, tp = 0, fp = 0
-            # 3. it matches no gt and within area range, tp = 0, fp = 1
-            # 4. it matches no gt but is beyond area range, tp = 0, fp = 0
-            if matched_gt >= 0:
-                gt_covered[matched_gt] = 1
-                if not (gt_ignore_inds[matched_gt]
-                        or gt_area_ignore[matched_gt]):
-                    tp[k, i] = 1
-            elif min_area is None:
-                fp[k, i] = 1
-            else:
-                bbox = det_bboxes[i, :4]
-                area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
-                if area >= min_area and area < max_area:
-                    fp[k, i] = 1
+    # the matching does not depend on the area range (ignored gts are
+    # covered too), so it is done once for all ranges
+    eligible = ious >= iou_thrs
+    candidate_ious = np.where(eligible, ious, -1)
+    gt_covered = np.zeros(num_gts, dtype=bool)
+    matched_gts = np.full(num_dets, -1, dtype=np.int64)
+    for i in sort_inds[eligible[sort_inds].any(axis=1)]:
+        # find best overlapped available gt
+        # different from PASCAL VOC: allow finding other gts if the
+        # best overlapped ones are already matched by other det bboxes
+        det_ious = np.where(gt_covered, -1, candidate_ious[i])
+        matched_gt = det_ious.argmax()
+        if det_ious[matched_gt] > -1:
+            gt_covered[matched_gt] = True
+            matched_gts[i] = matched_gt
+    # there are 4 cases for a det bbox:
+    # 1. it matches a gt, tp = 1, fp = 0
+    # 2. it matches an ignored gt, tp = 0, fp = 0
+    # 3. it matches no gt and within area range, tp = 0, fp = 1
+    # 4. it matches no gt but is beyond area range, tp = 0, fp = 0
+    gt_ignore = _gt_ignore_per_range(gt_ignore_inds, gt_w * gt_h,
+                                     area_ranges)
+    matched = matched_gts >= 0
+    tp[:, matched] = ~gt_ignore[:, matched_gts[matched]]
+    fp[:, ~matched] = _in_area_ranges(det_bboxes[~matched], area_ranges)
     return tp, fp
 
 
@@ -207,33 +216,22 @@ def tpfp_default(det_bboxes,
     ious_argmax = ious.argmax(axis=1)
     # sort all dets in descending order by scores
     sort_inds = np.argsort(-det_bboxes[:, -1])
-    for k, (min_area, max_area) in enumerate(area_ranges):
-        gt_covered = np.zeros(num_gts, dtype=bool)
-        # if no area range is specified, gt_area_ignore is all False
-        if min_area is None:
-            gt_area_ignore = np.zeros_like(gt_ignore_inds, dtype=bool)
-        else:
-            gt_areas = (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * (
-                gt_bboxes[:, 3] - gt_bboxes[:, 1])
-            gt_area_ignore = (gt_areas < min_area) | (gt_areas >= max_area)
-        for i in sort_inds:
-            if ious_max[i] >= iou_thr:
-                matched_gt = ious_argmax[i]
-                if not (gt_ignore_inds[matched_gt]
-                        or gt_area_ignore[matched_gt]):
-                    if not gt_covered[matched_gt]:
-                        gt_covered[matched_gt] = True
-                        tp[k, i] = 1
-                    else:
-                        fp[k, i] = 1
-                # otherwise ignore this detected bbox, tp = 0, fp = 0
-            elif min_area is None:
-                fp[k, i] = 1
-            else:
-                bbox = det_bboxes[i, :4]
-                area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
-                if area >= min_area and area < max_area:
-                    fp[k, i] = 1
+    # a matched det is a tp if it is the highest scored det matching its gt
+    # and a fp otherwise, unless the gt is ignored (tp = 0, fp = 0). Only
+    # whether the gt is ignored depends on the area range.
+    matched = ious_max >= iou_thr
+    matched_inds = sort_inds[matched[sort_inds]]
+    matched_gts = ious_argmax[matched_inds]
+    first = np.zeros(len(matched_inds), dtype=bool)
+    first[np.unique(matched_gts, return_index=True)[1]] = True
+    gt_areas = (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * (
+        gt_bboxes[:, 3] - gt_bboxes[:, 1])
+    gt_ignore = _gt_ignore_per_range(gt_ignore_inds, gt_areas, area_ranges)
+    counted = ~gt_ignore[:, matched_gts]
+    tp[:, matched_inds] = counted & first
+    fp[:, matched_inds] = counted & ~first
+    # unmatched dets within area range are false positives
+    fp[:, ~matched] = _in_area_ranges(det_bboxes[~matched], area_ranges)
     return tp, fp
 
 
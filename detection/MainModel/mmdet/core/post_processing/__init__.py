@@ -1,8 +1,10 @@
 from .bbox_nms import fast_nms, multiclass_nms
+from .box_fusion import fuse_boxes, fuse_results
 from .merge_augs import (merge_aug_bboxes, merge_aug_masks,
                          merge_aug_proposals, merge_aug_scores)
 
 __all__ = [
     'multiclass_nms', 'merge_aug_proposals', 'merge_aug_bboxes',
-    'merge_aug_scores', 'merge_aug_masks', 'fast_nms'
+    'merge_aug_scores', 'merge_aug_masks', 'fast_nms', 'fuse_boxes',
+    'fuse_results'
 ]
@@ -0,0 +1,327 @@
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+
+def _bbox_areas(bboxes):
+    return (bboxes[..., 2] - bboxes[..., 0]) * (
+        bboxes[..., 3] - bboxes[..., 1])
+
+
+def _ious(bboxes, others):
+    """IoU of (g, 4) boxes with (g, k, 4) boxes, without the +1 offset.
+
+    Returns:
+        ndarray: shape (g, k).
+    """
+    lt = np.maximum(bboxes[:, None, :2], others[..., :2])
+    rb = np.minimum(bboxes[:, None, 2:], others[..., 2:])
+    wh = np.maximum(rb - lt, 0)
+    overlaps = wh[..., 0] * wh[..., 1]
+    union = _bbox_areas(bboxes)[:, None] + _bbox_areas(others) - overlaps
+    return overlaps / np.maximum(union, np.finfo(np.float64).eps)
+
+
+def wbf_batched(bboxes, scores, valid, weights, iou_thr=0.55,
+                conf_type='avg'):
+    """Weighted boxes fusion of many independent groups at once.
+
+    A group is the boxes of one class of one image. Within a group, boxes
+    are visited in descending score order and each one joins the cluster
+    whose fused box has the highest IoU (> ``iou_thr``) with it, or starts
+    a new cluster. Step ``t`` handles the ``t``-th box of every group in one
+    vectorized update, and fused boxes are kept as running sums.
+
+    Args:
+        bboxes (ndarray): shape (g, l, 4), sorted by descending score within
+            each group.
+        scores (ndarray): shape (g, l), already multiplied by model weights.
+        valid (ndarray): shape (g, l), False for padding.
+        weights (ndarray): weights of all models.
+        iou_thr (float): IoU threshold for a box to join a cluster.
+        conf_type (str): 'avg' or 'max'.
+
+    Returns:
+        tuple: fused boxes (g, l, 4), their scores (g, l) and a (g, l) mask
+            of the clusters that exist.
+    """
+    num_groups, max_len = scores.shape
+    fused = np.zeros((num_groups, max_len, 4))
+    box_sums = np.zeros((num_groups, max_len, 4))
+    conf_sums = np.zeros((num_groups, max_len))
+    conf_maxes = np.zeros((num_groups, max_len))
+    counts = np.zeros((num_groups, max_len), dtype=np.int64)
+    num_clusters = np.zeros(num_groups, dtype=np.int64)
+    for t in range(max_len):
+        rows = np.flatnonzero(valid[:, t])
+        if len(rows) == 0:
+            break
+        bbox, score = bboxes[rows, t], scores[rows, t]
+        k = num_clusters[rows].max()
+        matched = np.zeros(len(rows), dtype=bool)
+        best = np.zeros(len(rows), dtype=np.int64)
+        if k > 0:
+            ious = _ious(bbox, fused[rows, :k])
+            ious[np.arange(k)[None, :] >= num_clusters[rows, None]] = -1
+            best = ious.argmax(axis=1)
+            matched = ious[np.arange(len(rows)), best] > iou_thr
+        # boxes which start a new cluster
+        new_rows = rows[~matched]
+        best[~matched] = num_clusters[new_rows]
+        num_clusters[new_rows] += 1
+
+        best_rows = (rows, best)
+        box_sums[best_rows] += score[:, None] * bbox
+        conf_sums[best_rows] += score
+        conf_maxes[best_rows] = np.maximum(conf_maxes[best_rows], score)
+        counts[best_rows] += 1
+        fused[best_rows] = box_sums[best_rows] / conf_sums[best_rows][:, None]
+
+    exists = counts > 0
+    if conf_type == 'avg':
+        fused_scores = conf_sums / np.maximum(counts, 1)
+        fused_scores *= np.minimum(len(weights), counts) / weights.sum()
+    elif conf_type == 'max':
+        fused_scores = conf_maxes / weights.max()
+    else:
+        raise ValueError(f'conf_type must be avg or max, got {conf_type}')
+    return fused, fused_scores, exists
+
+
+def nmw_batched(bboxes, scores, valid, iou_thr=0.55):
+    """Non-maximum weighted fusion of many independent groups at once.
+
+    The cluster heads are the boxes kept by greedy NMS, and every other box
+    joins the earlier head with the highest IoU. Both are found in one pass
+    over the score order. A fused box is the average of its members weighted
+    by score * IoU with the head, and keeps the head score.
+
+    Args:
+        bboxes (ndarray): shape (g, l, 4), sorted by descending score within
+            each group.
+        scores (ndarray): shape (g, l), already multiplied by model weights.
+        valid (ndarray): shape (g, l), False for padding.
+        iou_thr (float): IoU threshold for a box to join a head.
+
+    Returns:
+        tuple: fused boxes (g, l, 4), their scores (g, l) and a (g, l) mask
+            of the heads.
+    """
+    num_groups, max_len = scores.shape
+    head_ious = np.full((num_groups, max_len), -1.)
+    heads = np.zeros((num_groups, max_len), dtype=np.int64)
+    is_head = np.zeros((num_groups, max_len), dtype=bool)
+    for t in range(max_len):
+        rows = np.flatnonzero(valid[:, t] & (head_ious[:, t] <= iou_thr))
+        if len(rows) == 0:
+            continue
+        is_head[rows, t] = True
+        ious = _ious(bboxes[rows, t], bboxes[rows])
+        ious[:, :t + 1] = -1
+        # strict > keeps the earliest head among equal IoUs
+        closer = ious > head_ious[rows]
+        head_ious[rows] = np.where(closer, ious, head_ious[rows])
+        heads[rows] = np.where(closer, t, heads[rows])
+    heads[is_head] = np.nonzero(is_head)[1]
+    head_ious[is_head] = 1
+
+    member_weights = np.where(valid, scores * head_ious, 0)
+    group_inds = np.broadcast_to(np.arange(num_groups)[:, None], heads.shape)
+    box_sums = np.zeros((num_groups, max_len, 4))
+    conf_sums = np.zeros((num_groups, max_len))
+    np.add.at(box_sums, (group_inds, heads),
+              member_weights[..., None] * bboxes)
+    np.add.at(conf_sums, (group_inds, heads), member_weights)
+    conf_sums = np.maximum(conf_sums, np.finfo(np.float64).eps)
+    return box_sums / conf_sums[..., None], np.where(is_head, scores,
+                                                     0), is_head
+
+
+def soft_nms_batched(bboxes,
+                     scores,
+                     valid,
+                     iou_thr=0.5,
+                     sigma=0.5,
+                     min_score=0.001,
+                     method='gaussian'):
+    """Soft-NMS of many independent groups at once.
+
+    Args:
+        bboxes (ndarray): shape (g, l, 4).
+        scores (ndarray): shape (g, l), already multiplied by model weights.
+        valid (ndarray): shape (g, l), False for padding.
+        iou_thr (float): IoU threshold of the linear method.
+        sigma (float): sigma of the gaussian method.
+        min_score (float): boxes whose decayed score is not above it are
+            dropped.
+        method (str): 'gaussian' or 'linear'.
+
+    Returns:
+        tuple: boxes (g, l, 4), decayed scores (g, l) and a (g, l) mask of
+            the kept boxes.
+    """
+    if method not in ('gaussian', 'linear'):
+        raise ValueError(f'method must be gaussian or linear, got {method}')
+    scores = np.where(valid, scores, 0)
+    remaining = valid.copy()
+    for _ in range(scores.shape[1]):
+        rows = np.flatnonzero(remaining.any(axis=1))
+        if len(rows) == 0:
+            break
+        picked = np.where(remaining[rows], scores[rows], -np.inf).argmax(1)
+        remaining[rows, picked] = False
+        ious = _ious(bboxes[rows, picked], bboxes[rows])
+        if method == 'gaussian':
+            decay = np.exp(-ious**2 / sigma)
+        else:
+            decay = np.where(ious > iou_thr, 1 - ious, 1)
+        scores[rows] *= np.where(remaining[rows], decay, 1)
+    return bboxes, scores, valid & (scores > min_score)
+
+
+def _pack_groups(images, score_scales, skip_box_thr):
+    """Stack the boxes of every (image, class) into padded (g, l) arrays,
+    sorted by descending weighted score within each group."""
+    groups = []
+    for results in images:
+        results = [
+            result[0] if isinstance(result, tuple) else result
+            for result in results
+        ]
+        for class_id in range(len(results[0])):
+            dets = [result[class_id] for result in results]
+            model_inds = np.repeat(
+                np.arange(len(dets)), [len(d) for d in dets])
+            dets = np.concatenate(dets).astype(np.float64)
+            bboxes = np.hstack([
+                np.minimum(dets[:, :2], dets[:, 2:4]),
+                np.maximum(dets[:, :2], dets[:, 2:4])
+            ])
+            scores = dets[:, 4]
+            # boxes with zero score carry no weight in any of the averages
+            keep = (scores >= skip_box_thr) & (scores > 0) & (
+                _bbox_areas(bboxes) > 0)
+            scores = scores[keep] * score_scales[model_inds[keep]]
+            order = scores.argsort()[::-1]
+            groups.append((bboxes[keep][order], scores[order]))
+
+    max_len = max([len(scores) for _, scores in groups] + [0])
+    bboxes = np.zeros((len(groups), max_len, 4))
+    scores = np.zeros((len(groups), max_len))
+    valid = np.zeros((len(groups), max_len), dtype=bool)
+    for i, (group_bboxes, group_scores) in enumerate(groups):
+        bboxes[i, :len(group_scores)] = group_bboxes
+        scores[i, :len(group_scores)] = group_scores
+        valid[i, :len(group_scores)] = True
+    return bboxes, scores, valid
+
+
+def fuse_boxes(images,
+               weights=None,
+               method='wbf',
+               iou_thr=0.55,
+               skip_box_thr=0.0,
+               score_thr=0.0,
+               conf_type='avg',
+               sigma=0.5,
+               min_score=0.001,
+               soft_nms_method='gaussian'):
+    """Fuse the detections of several models on a chunk of images.
+
+    All (image, class) groups of the chunk are clustered together. Score
+    weighting follows the ensemble-boxes package: WBF multiplies scores by
+    the model weight, NMW by weight / max(weights) and soft-NMS by
+    weight / sum(weights).
+
+    Args:
+        images (list[list]): for each image, the results of every model as
+            returned by ``single_gpu_test``, i.e. a list of (n, 5) arrays per
+            class. ``(bbox_results, segm_results)`` tuples are accepted and
+            only the boxes are fused.
+        weights (list[float] | None): model weights. Default: all 1.
+        method (str): 'wbf', 'nmw' or 'soft_nms'. Default: 'wbf'.
+        iou_thr (float): IoU threshold for fusing boxes. Default: 0.55.
+        skip_box_thr (float): input boxes with a (raw) score lower than it
+            are ignored, as are zero-score and zero-area boxes.
+            Default: 0.0.
+        score_thr (float): fused boxes with a score lower than it are
+            dropped. Default: 0.0.
+        conf_type (str): fused score of WBF, 'avg' or 'max'.
+        sigma (float): sigma of gaussian soft-NMS.
+        min_score (float): score a box must keep after soft-NMS decay.
+        soft_nms_method (str): 'gaussian' or 'linear'.
+
+    Returns:
+        list[list[ndarray]]: fused (k, 5) float32 boxes per class for each
+            image, sorted by score.
+    """
+    num_models = len(images[0])
+    weights = np.ones(num_models) if weights is None else np.asarray(
+        weights, dtype=np.float64)
+    assert len(weights) == num_models, \
+        f'got {len(weights)} weights for {num_models} models'
+    if method == 'wbf':
+        score_scales = weights
+    elif method == 'nmw':
+        score_scales = weights / weights.max()
+    elif method == 'soft_nms':
+        score_scales = weights / weights.sum()
+    else:
+        raise ValueError(f'method must be wbf, nmw or soft_nms, got {method}')
+
+    bboxes, scores, valid = _pack_groups(images, score_scales, skip_box_thr)
+    if method == 'wbf':
+        bboxes, scores, keep = wbf_batched(bboxes, scores, valid, weights,
+                                           iou_thr, conf_type)
+    elif method == 'nmw':
+        bboxes, scores, keep = nmw_batched(bboxes, scores, valid, iou_thr)
+    else:
+        bboxes, scores, keep = soft_nms_batched(bboxes, scores, valid,
+                                                iou_thr, sigma, min_score,
+                                                soft_nms_method)
+    keep &= scores >= score_thr
+
+    dets = np.concatenate([bboxes, scores[..., None]], axis=-1)
+    dets = dets.astype(np.float32)
+    fused_dets = []
+    for group_dets, group_scores, group_keep in zip(dets, scores, keep):
+        inds = np.flatnonzero(group_keep)
+        fused_dets.append(group_dets[inds[group_scores[inds].argsort()[::-1]]])
+    num_classes = len(fused_dets) // len(images)
+    return [
+        fused_dets[i:i + num_classes]
+        for i in range(0, len(fused_dets), num_classes)
+    ]
+
+
+def fuse_results(model_results, nproc=4, chunk_size=64, **fusion_cfg):
+    """Fuse the results of several models over a whole dataset.
+
+    Images are split into chunks of ``chunk_size``, which are fused in
+    ``nproc`` processes.
+
+    Args:
+        model_results (list[list]): one ``single_gpu_test`` output per
+            model, all over the same images in the same order.
+        nproc (int): processes to spread the chunks over. Default: 4.
+        chunk_size (int): images fused together in one call. Default: 64.
+        **fusion_cfg: keyword arguments of :func:`fuse_boxes`.
+
+    Returns:
+        list[list[ndarray]]: fused results in the ``single_gpu_test`` format.
+    """
+    num_imgs = len(model_results[0])
+    assert all(len(results) == num_imgs for results in model_results), \
+        'all models must have results for the same images'
+    per_image = list(zip(*model_results))
+    chunks = [
+        per_image[i:i + chunk_size] for i in range(0, num_imgs, chunk_size)
+    ]
+    fuse = partial(fuse_boxes, **fusion_cfg)
+    if nproc <= 1 or len(chunks) <= 1:
+        fused_chunks = [fuse(chunk) for chunk in chunks]
+    else:
+        with Pool(min(nproc, len(chunks))) as pool:
+            fused_chunks = pool.map(fuse, chunks)
+    return [result for chunk in fused_chunks for result in chunk]
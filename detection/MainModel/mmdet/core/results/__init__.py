@@ -0,0 +1,3 @@
+from .detection_results import DetectionResults, load_results
+
+__all__ = ['DetectionResults', 'load_results']
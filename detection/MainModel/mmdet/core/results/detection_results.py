@@ -0,0 +1,248 @@
+import json
+import os
+import os.path as osp
+
+import mmcv
+import numpy as np
+
+HEADER_FILE = 'header.json'
+FORMAT_VERSION = 1
+
+
+class DetectionResults(object):
+    """Columnar container of the detection results of a dataset.
+
+    All detections are stored in flat columns, ordered by image and then by
+    label, with ``offsets[i]:offsets[i + 1]`` the rows of image ``i``:
+
+    - ``bboxes``: float32 (n, 4)
+    - ``scores``: float32 (n, )
+    - ``labels``: int16 (n, )
+    - ``offsets``: int64 (num_images + 1, )
+    - ``mask_sizes`` (optional): int32 (n, 2), RLE size of each mask
+    - ``mask_offsets`` (optional): int64 (n + 1, ), rows of ``mask_counts``
+    - ``mask_counts`` (optional): uint8 (m, ), all RLE counts back to back
+    - ``mask_scores`` (optional): float32 (n, ), for mask scoring models
+
+    On disk it is a directory of ``.npy`` files with a ``header.json`` that
+    also holds free-form metadata (dataset, classes, config, checkpoint...).
+    :meth:`load` memory-maps the columns, so opening a result is cheap and
+    ``results[i]`` only reads the rows of image ``i``.
+
+    Indexing and iteration give the same per-image structure as
+    ``single_gpu_test`` (a list of (k, 5) arrays per class, or a
+    ``(bbox_results, segm_results)`` tuple), so code written for result
+    lists keeps working.
+
+    Args:
+        bboxes, scores, labels, offsets (ndarray): the columns above.
+        num_classes (int): number of classes.
+        meta (dict, optional): json serializable metadata.
+        mask_sizes, mask_offsets, mask_counts, mask_scores (ndarray,
+            optional): the mask columns above.
+    """
+
+    columns = ('bboxes', 'scores', 'labels', 'offsets', 'mask_sizes',
+               'mask_offsets', 'mask_counts', 'mask_scores')
+
+    def __init__(self,
+                 bboxes,
+                 scores,
+                 labels,
+                 offsets,
+                 num_classes,
+                 meta=None,
+                 mask_sizes=None,
+                 mask_offsets=None,
+                 mask_counts=None,
+                 mask_scores=None):
+        self.bboxes = bboxes
+        self.scores = scores
+        self.labels = labels
+        self.offsets = offsets
+        self.num_classes = num_classes
+        self.meta = meta or {}
+        self.mask_sizes = mask_sizes
+        self.mask_offsets = mask_offsets
+        self.mask_counts = mask_counts
+        self.mask_scores = mask_scores
+
+    @property
+    def with_mask(self):
+        return self.mask_sizes is not None
+
+    @property
+    def num_dets(self):
+        return len(self.scores)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def image_slice(self, idx):
+        """Row range of image ``idx`` in the flat columns."""
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'image index {idx} out of range')
+        return slice(int(self.offsets[idx]), int(self.offsets[idx + 1]))
+
+    def __getitem__(self, idx):
+        rows = self.image_slice(idx)
+        dets = np.concatenate(
+            [self.bboxes[rows], self.scores[rows, None]], axis=1)
+        splits = np.searchsorted(self.labels[rows],
+                                 np.arange(1, self.num_classes))
+        bbox_results = np.split(dets, splits)
+        if not self.with_mask:
+            return bbox_results
+        bounds = [0] + splits.tolist() + [rows.stop - rows.start]
+        masks = self._decode_masks(rows)
+        segm_results = [
+            masks[begin:end] for begin, end in zip(bounds[:-1], bounds[1:])
+        ]
+        if self.mask_scores is None:
+            return bbox_results, segm_results
+        mask_scores = np.asarray(self.mask_scores[rows])
+        mask_scores = [
+            mask_scores[begin:end].tolist()
+            for begin, end in zip(bounds[:-1], bounds[1:])
+        ]
+        return bbox_results, (segm_results, mask_scores)
+
+    def _decode_masks(self, rows):
+        count_offsets = self.mask_offsets[rows.start:rows.stop + 1]
+        counts = self.mask_counts[count_offsets[0]:count_offsets[-1]]
+        counts = np.asarray(counts).tobytes()
+        begins = count_offsets - count_offsets[0]
+        return [
+            dict(size=size, counts=counts[begin:end])
+            for size, begin, end in zip(self.mask_sizes[rows].tolist(),
+                                        begins[:-1], begins[1:])
+        ]
+
+    def to_list(self):
+        """Results as a plain list, the ``single_gpu_test`` format."""
+        return list(self)
+
+    @classmethod
+    def from_list(cls, results, meta=None):
+        """Build from ``single_gpu_test`` / ``multi_gpu_test`` results.
+
+        Args:
+            results (list): per-image list of (k, 5) arrays per class, or of
+                ``(bbox_results, segm_results)`` tuples with RLE encoded
+                masks.
+            meta (dict, optional): json serializable metadata.
+        """
+        assert len(results) > 0, 'results must not be empty'
+        with_mask = isinstance(results[0], tuple)
+        num_classes = len(results[0][0] if with_mask else results[0])
+        bboxes, labels, counts = [], [], []
+        segms, mask_scores = [], []
+        with_mask_scores = False
+        for result in results:
+            if with_mask:
+                bbox_results, segm_results = result
+                if isinstance(segm_results, tuple):
+                    segm_results, cls_mask_scores = segm_results
+                    with_mask_scores = True
+                    for scores in cls_mask_scores:
+                        mask_scores.extend(scores)
+                for segm in segm_results:
+                    segms.extend(segm)
+            else:
+                bbox_results = result
+            for label, dets in enumerate(bbox_results):
+                bboxes.append(dets)
+                labels.append(np.full(len(dets), label, dtype=np.int16))
+            counts.append(sum(len(dets) for dets in bbox_results))
+
+        dets = np.concatenate(bboxes).astype(np.float32).reshape(-1, 5)
+        columns = dict(
+            bboxes=np.ascontiguousarray(dets[:, :4]),
+            scores=np.ascontiguousarray(dets[:, 4]),
+            labels=np.concatenate(labels),
+            offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        if with_mask:
+            assert len(segms) == len(dets), \
+                'every box must have a mask'
+            encoded = [
+                segm['counts'].encode() if isinstance(segm['counts'], str)
+                else segm['counts'] for segm in segms
+            ]
+            columns.update(
+                mask_sizes=np.array([segm['size'] for segm in segms],
+                                    dtype=np.int32).reshape(-1, 2),
+                mask_offsets=np.concatenate(
+                    [[0], np.cumsum([len(c) for c in encoded])]).astype(
+                        np.int64),
+                mask_counts=np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            if with_mask_scores:
+                columns['mask_scores'] = np.array(
+                    mask_scores, dtype=np.float32)
+        return cls(num_classes=num_classes, meta=meta, **columns)
+
+    def dump(self, path):
+        """Write the columns and the header into the directory ``path``.
+
+        The header is written last, so an interrupted dump is not loadable.
+        """
+        os.makedirs(path, exist_ok=True)
+        header_path = osp.join(path, HEADER_FILE)
+        if osp.exists(header_path):
+            os.remove(header_path)
+        for name in self.columns:
+            column = getattr(self, name)
+            if column is not None:
+                np.save(osp.join(path, f'{name}.npy'), np.asarray(column))
+        header = dict(
+            version=FORMAT_VERSION,
+            num_images=len(self),
+            num_classes=self.num_classes,
+            num_dets=self.num_dets,
+            columns=[
+                name for name in self.columns
+                if getattr(self, name) is not None
+            ],
+            meta=self.meta)
+        with open(header_path, 'w') as f:
+            json.dump(header, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open a result directory written by :meth:`dump`.
+
+        Args:
+            path (str): the directory.
+            mmap (bool): memory-map the columns instead of reading them.
+                Default: True.
+        """
+        with open(osp.join(path, HEADER_FILE)) as f:
+            header = json.load(f)
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError(
+                f'unsupported result format version {header["version"]}')
+        columns = {
+            name: np.load(
+                osp.join(path, f'{name}.npy'),
+                mmap_mode='r' if mmap else None)
+            for name in header['columns']
+        }
+        return cls(
+            num_classes=header['num_classes'], meta=header['meta'], **columns)
+
+    @staticmethod
+    def is_results_dir(path):
+        return osp.isfile(osp.join(path, HEADER_FILE))
+
+
+def load_results(path, mmap=True):
+    """Load results saved either as a pickle/json (``mmcv.dump``) or as a
+    :class:`DetectionResults` directory."""
+    if DetectionResults.is_results_dir(path):
+        return DetectionResults.load(path, mmap=mmap)
+    return mmcv.load(path)
@@ -3,7 +3,7 @@ from .cityscapes import CityscapesDataset
 from .coco import CocoDataset
 from .custom import CustomDataset
 from .dataset_wrappers import (ClassBalancedDataset, ConcatDataset,
-                               RepeatDataset)
+                               MultiPipelineDataset, RepeatDataset)
 from .deepfashion import DeepFashionDataset
 from .lvis import LVISDataset, LVISV1Dataset, LVISV05Dataset
 from .nightowls import NightOwlsDataset
@@ -20,9 +20,9 @@ __all__ = [
     'VOCDataset', 'CityscapesDataset', 'LVISDataset', 'LVISV05Dataset',
     'LVISV1Dataset', 'GroupSampler', 'DistributedGroupSampler',
     'DistributedSampler', 'build_dataloader', 'ConcatDataset', 'RepeatDataset',
-    'ClassBalancedDataset', 'WIDERFaceDataset', 'DATASETS', 'PIPELINES',
-    'build_dataset', 'replace_ImageToTensor', 'get_loading_pipeline',
-    'NumClassCheckHook'
+    'ClassBalancedDataset', 'MultiPipelineDataset', 'WIDERFaceDataset',
+    'DATASETS', 'PIPELINES', 'build_dataset', 'replace_ImageToTensor',
+    'get_loading_pipeline', 'NumClassCheckHook'
 ]
 
 __all__ += ['WaymoOpenDataset', 'NightOwlsDataset']
@@ -9,7 +9,8 @@ from mmcv.runner import get_dist_info
 from mmcv.utils import Registry, build_from_cfg
 from torch.utils.data import DataLoader
 
-from .samplers import DistributedGroupSampler, DistributedSampler, GroupSampler
+from .samplers import (DistributedGroupSampler, DistributedSampler,
+                       GroupSampler, ShapeBucketSampler)
 
 if platform.system() != 'Windows':
     # https://github.com/pytorch/pytorch/issues/973
@@ -80,6 +81,7 @@ def build_dataloader(dataset,
                      dist=True,
                      shuffle=True,
                      seed=None,
+                     shape_bucket=False,
                      **kwargs):
     """Build PyTorch DataLoader.
 
@@ -96,6 +98,10 @@ def build_dataloader(dataset,
         dist (bool): Distributed training/test or not. Default: True.
         shuffle (bool): Whether to shuffle the data at every epoch.
             Default: True.
+        shape_bucket (bool): In non-distributed testing (``shuffle=False``),
+            batch images of similar shape together with
+            :class:`ShapeBucketSampler`. Results then come in the sampler
+            order. Default: False.
         kwargs: any keyword argument to be used to initialize DataLoader
 
     Returns:
@@ -114,7 +120,12 @@ def build_dataloader(dataset,
         batch_size = samples_per_gpu
         num_workers = workers_per_gpu
     else:
-        sampler = GroupSampler(dataset, samples_per_gpu) if shuffle else None
+        if shuffle:
+            sampler = GroupSampler(dataset, samples_per_gpu)
+        elif shape_bucket:
+            sampler = ShapeBucketSampler(dataset, samples_per_gpu)
+        else:
+            sampler = None
         batch_size = num_gpus * samples_per_gpu
         num_workers = num_gpus * workers_per_gpu
 
@@ -12,7 +12,7 @@ from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 from terminaltables import AsciiTable
 
-from mmdet.core import eval_recalls
+from mmdet.core import DetectionResults, eval_recalls
 from .builder import DATASETS
 from .custom import CustomDataset
 
@@ -232,9 +232,27 @@ class CocoDataset(CustomDataset):
                     json_results.append(data)
         return json_results
 
+    def _columnar2json(self, results):
+        """Convert :obj:`DetectionResults` boxes to COCO json style.
+
+        Same output as :meth:`_det2json`, built from the flat columns.
+        """
+        img_ids = np.repeat(self.img_ids, np.diff(results.offsets))
+        bboxes = np.asarray(results.bboxes, dtype=np.float64)
+        bboxes[:, 2:] -= bboxes[:, :2]
+        scores = np.asarray(results.scores, dtype=np.float64)
+        cat_ids = np.asarray(self.cat_ids)[np.asarray(results.labels)]
+        return [
+            dict(image_id=img_id, bbox=bbox, score=score, category_id=cat_id)
+            for img_id, bbox, score, cat_id in zip(
+                img_ids.tolist(), bboxes.tolist(), scores.tolist(),
+                cat_ids.tolist())
+        ]
+
     def pseudo_results(self, results, output_path=None, pseudo_score_threshold=0.8,
                        pseudo_confidence_threshold=0.65):
-        assert isinstance(results, list), "results must be a list"
+        assert isinstance(results, (list, DetectionResults)), \
+            "results must be a list or DetectionResults"
         assert len(results) == len(self), "The length of results is not equal to the dataset len: {} != {}".format(
             len(results), len(self)
         )
@@ -354,8 +372,8 @@ class CocoDataset(CustomDataset):
         automatically recognize the type, and dump them to json files.
 
         Args:
-            results (list[list | tuple | ndarray]): Testing results of the
-                dataset.
+            results (list[list | tuple | ndarray] | DetectionResults):
+                Testing results of the dataset.
             outfile_prefix (str): The filename prefix of the json files. If the
                 prefix is "somepath/xxx", the json files will be named
                 "somepath/xxx.bbox.json", "somepath/xxx.segm.json",
@@ -366,7 +384,12 @@ class CocoDataset(CustomDataset):
                 values are corresponding filenames.
         """
         result_files = dict()
-        if isinstance(results[0], list):
+        if isinstance(results, DetectionResults) and not results.with_mask:
+            json_results = self._columnar2json(results)
+            result_files['bbox'] = f'{outfile_prefix}.bbox.json'
+            result_files['proposal'] = f'{outfile_prefix}.bbox.json'
+            mmcv.dump(json_results, result_files['bbox'])
+        elif isinstance(results[0], list):
             json_results = self._det2json(results)
             result_files['bbox'] = f'{outfile_prefix}.bbox.json'
             result_files['proposal'] = f'{outfile_prefix}.bbox.json'
@@ -414,8 +437,8 @@ class CocoDataset(CustomDataset):
         """Format the results to json (standard format for COCO evaluation).
 
         Args:
-            results (list[tuple | numpy.ndarray]): Testing results of the
-                dataset.
+            results (list[tuple | numpy.ndarray] | DetectionResults): Testing
+                results of the dataset.
             jsonfile_prefix (str | None): The prefix of json files. It includes
                 the file path and the prefix of filename, e.g., "a/b/prefix".
                 If not specified, a temp file will be created. Default: None.
@@ -425,7 +448,8 @@ class CocoDataset(CustomDataset):
                 the json filepaths, tmp_dir is the temporal directory created \
                 for saving json files when jsonfile_prefix is not specified.
         """
-        assert isinstance(results, list), 'results must be a list'
+        assert isinstance(results, (list, DetectionResults)), \
+            'results must be a list or DetectionResults'
         assert len(results) == len(self), (
             'The length of results is not equal to the dataset len: {} != {}'.
             format(len(results), len(self)))
@@ -450,7 +474,8 @@ class CocoDataset(CustomDataset):
         """Evaluation in COCO protocol.
 
         Args:
-            results (list[list | tuple]): Testing results of the dataset.
+            results (list[list | tuple] | DetectionResults): Testing results
+                of the dataset.
             metric (str | list[str]): Metrics to be evaluated. Options are
                 'bbox', 'segm', 'proposal', 'proposal_fast'.
             logger (logging.Logger | str | None): Logger used for printing
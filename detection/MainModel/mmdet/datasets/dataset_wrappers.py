@@ -1,4 +1,5 @@
 import bisect
+import json
 import math
 from collections import defaultdict
 
@@ -8,6 +9,7 @@ from torch.utils.data.dataset import ConcatDataset as _ConcatDataset
 
 from .builder import DATASETS
 from .coco import CocoDataset
+from .pipelines import Compose
 
 
 @DATASETS.register_module()
@@ -167,6 +169,67 @@ class RepeatDataset(object):
         return self.times * self._ori_len
 
 
+class MultiPipelineDataset(object):
+    """A wrapper running the test pipelines of several models on each image.
+
+    Identical pipelines are run once and shared. When all the remaining
+    pipelines start with the same loading transform (e.g.
+    ``LoadImageFromFile``), the image is loaded and decoded once and only
+    the rest of each pipeline is run on a copy of the loaded results, so one
+    item costs one decode whatever the number of models.
+
+    Args:
+        dataset (:obj:`CustomDataset`): The test dataset, whose own pipeline
+            is not used.
+        pipelines (list[list[dict]]): Test pipeline of each model.
+
+    Attributes:
+        pipeline_inds (list[int]): For each model, the index of its data in
+            the list returned by ``__getitem__``.
+    """
+
+    def __init__(self, dataset, pipelines):
+        self.dataset = dataset
+        self.CLASSES = dataset.CLASSES
+        keys = [
+            json.dumps(pipeline, sort_keys=True, default=str)
+            for pipeline in pipelines
+        ]
+        unique_keys = list(dict.fromkeys(keys))
+        self.pipeline_inds = [unique_keys.index(key) for key in keys]
+        unique_pipelines = [pipelines[keys.index(key)] for key in unique_keys]
+
+        first_keys = set(
+            json.dumps(pipeline[0], sort_keys=True, default=str)
+            for pipeline in unique_pipelines)
+        if len(first_keys) == 1 and \
+                unique_pipelines[0][0]['type'].startswith('LoadImage'):
+            self.load_pipeline = Compose(unique_pipelines[0][:1])
+            self.pipelines = [
+                Compose(pipeline[1:]) for pipeline in unique_pipelines
+            ]
+        else:
+            self.load_pipeline = None
+            self.pipelines = [
+                Compose(pipeline) for pipeline in unique_pipelines
+            ]
+
+    def __getitem__(self, idx):
+        img_info = self.dataset.data_infos[idx]
+        results = dict(img_info=img_info)
+        if self.dataset.proposals is not None:
+            results['proposals'] = self.dataset.proposals[idx]
+        self.dataset.pre_pipeline(results)
+        if self.load_pipeline is not None:
+            results = self.load_pipeline(results)
+        # transforms replace the arrays of ``results`` rather than modifying
+        # them in place, so a shallow copy per pipeline is enough
+        return [pipeline(dict(results)) for pipeline in self.pipelines]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
 # Modified from https://github.com/facebookresearch/detectron2/blob/41d475b75a230221e21d9cac5d69655e3415e3a4/detectron2/data/samplers/distributed_sampler.py#L57 # noqa
 @DATASETS.register_module()
 class ClassBalancedDataset(object):
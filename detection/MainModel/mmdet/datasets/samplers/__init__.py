@@ -1,4 +1,8 @@
 from .distributed_sampler import DistributedSampler
 from .group_sampler import DistributedGroupSampler, GroupSampler
+from .shape_bucket_sampler import ShapeBucketSampler
 
-__all__ = ['DistributedSampler', 'DistributedGroupSampler', 'GroupSampler']
+__all__ = [
+    'DistributedSampler', 'DistributedGroupSampler', 'GroupSampler',
+    'ShapeBucketSampler'
+]
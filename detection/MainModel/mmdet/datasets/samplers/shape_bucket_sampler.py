@@ -0,0 +1,48 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class ShapeBucketSampler(Sampler):
+    """Test sampler putting images of similar shape in the same batch.
+
+    Images are visited by aspect ratio and then by height, so with a
+    ``keep_ratio`` resize the images of a batch mostly get the same padded
+    shape and little compute is spent on padding. Every image is visited
+    exactly once; ``order`` maps the n-th visited sample to its dataset index
+    and :meth:`restore_order` puts results back in dataset order.
+
+    Args:
+        dataset (Dataset): Dataset with ``data_infos`` holding ``height`` and
+            ``width``, or a wrapper of one (``dataset.dataset``). Other
+            datasets are visited in order.
+        samples_per_gpu (int): Batch size. Default: 1.
+    """
+
+    def __init__(self, dataset, samples_per_gpu=1):
+        self.dataset = dataset
+        self.samples_per_gpu = samples_per_gpu
+        data_infos = getattr(dataset, 'data_infos', None)
+        if data_infos is None and hasattr(dataset, 'dataset'):
+            data_infos = getattr(dataset.dataset, 'data_infos', None)
+        if data_infos is None:
+            # no shape information, keep the dataset order
+            self.order = list(range(len(dataset)))
+            return
+        assert len(data_infos) == len(dataset)
+        heights = np.array([info['height'] for info in data_infos])
+        widths = np.array([info['width'] for info in data_infos])
+        self.order = np.lexsort((heights, widths / heights)).tolist()
+
+    def restore_order(self, results):
+        """Reorder results produced in sampler order to dataset order."""
+        assert len(results) == len(self.order)
+        restored = [None] * len(results)
+        for result, idx in zip(results, self.order):
+            restored[idx] = result
+        return restored
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
@@ -159,13 +159,42 @@ class BaseDetector(nn.Module, metaclass=ABCMeta):
                 kwargs['proposals'] = kwargs['proposals'][0]
             return self.simple_test(imgs[0], img_metas[0], **kwargs)
         else:
-            assert imgs[0].size(0) == 1, 'aug test does not support ' \
-                                         'inference with batch size ' \
-                                         f'{imgs[0].size(0)}'
             # TODO: support test augmentation for predefined proposals
             assert 'proposals' not in kwargs
+            if imgs[0].size(0) > 1:
+                return self.batched_aug_test(imgs, img_metas, **kwargs)
             return self.aug_test(imgs, img_metas, **kwargs)
 
+    def batched_aug_test(self, imgs, img_metas, **kwargs):
+        """Test a batch of images with test time augmentation.
+
+        The features of each augmentation are extracted for the whole batch
+        in one forward, then the heads merge the augmentations one image at a
+        time with ``aug_test_feats``, which detectors supporting batched
+        augmentation test implement.
+
+        Args:
+            imgs (list[Tensor]): the outer list indicates test-time
+                augmentations and inner Tensor should have a shape NxCxHxW,
+                which contains all images in the batch.
+            img_metas (list[list[dict]]): the outer list indicates test-time
+                augs (multiscale, flip, etc.) and the inner list indicates
+                images in a batch.
+
+        Returns:
+            list: Results of each image.
+        """
+        assert getattr(self, 'aug_test_feats', None) is not None, \
+            f'{self.__class__.__name__} aug test does not support ' \
+            f'inference with batch size {imgs[0].size(0)}'
+        feats = self.extract_feats(imgs)
+        results = []
+        for i in range(imgs[0].size(0)):
+            img_feats = [tuple(lvl[i:i + 1] for lvl in x) for x in feats]
+            metas = [[img_meta[i]] for img_meta in img_metas]
+            results.extend(self.aug_test_feats(img_feats, metas, **kwargs))
+        return results
+
     @auto_fp16(apply_to=('img', ))
     def forward(self, img, img_metas, return_loss=True, **kwargs):
         """Calls either :func:`forward_train` or :func:`forward_test` depending
@@ -57,6 +57,10 @@ class CornerNet(SingleStageDetector):
 
         return out_bboxes, out_labels
 
+    # aug test runs flipped pairs through the backbone together, so it does
+    # not start from per-augmentation features
+    aug_test_feats = None
+
     def aug_test(self, imgs, img_metas, rescale=False):
         """Augment testing of CornerNet.
 
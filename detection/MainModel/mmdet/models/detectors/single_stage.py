@@ -146,9 +146,12 @@ class SingleStageDetector(BaseDetector):
                 The outer list corresponds to each image. The inner list
                 corresponds to each class.
         """
+        feats = self.extract_feats(imgs)
+        return self.aug_test_feats(feats, img_metas, rescale=rescale)
+
+    def aug_test_feats(self, feats, img_metas, rescale=False):
+        """Test with augmentations from the features of each augmentation."""
         assert hasattr(self.bbox_head, 'aug_test'), \
             f'{self.bbox_head.__class__.__name__}' \
             ' does not support test-time augmentation'
-
-        feats = self.extract_feats(imgs)
         return [self.bbox_head.aug_test(feats, img_metas, rescale=rescale)]
@@ -6,6 +6,10 @@ from .faster_rcnn import FasterRCNN
 class TridentFasterRCNN(FasterRCNN):
     """Implementation of `TridentNet <https://arxiv.org/abs/1901.01892>`_"""
 
+    # the features hold num_branch copies of the batch, so they cannot be
+    # split per image for a batched aug test
+    aug_test_feats = None
+
     def __init__(self,
                  backbone,
                  rpn_head,
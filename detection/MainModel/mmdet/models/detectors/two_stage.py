@@ -210,6 +210,10 @@ class TwoStageDetector(BaseDetector):
         of imgs[0].
         """
         x = self.extract_feats(imgs)
+        return self.aug_test_feats(x, img_metas, rescale=rescale)
+
+    def aug_test_feats(self, x, img_metas, rescale=False):
+        """Test with augmentations from the features of each augmentation."""
         proposal_list = self.rpn_head.aug_test_rpn(x, img_metas)
         return self.roi_head.aug_test(
             x, proposal_list, img_metas, rescale=rescale)
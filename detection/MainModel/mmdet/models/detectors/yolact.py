@@ -141,6 +141,9 @@ class YOLACT(SingleStageDetector):
                     segm_results.append(segm_result)
         return list(zip(bbox_results, segm_results))
 
+    # aug test is not implemented, so neither is the batched aug test
+    aug_test_feats = None
+
     def aug_test(self, imgs, img_metas, rescale=False):
         """Test with augmentations."""
         raise NotImplementedError
@@ -0,0 +1,212 @@
+import argparse
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from mmcv import Config, DictAction
+from mmcv.cnn import fuse_conv_bn
+from mmcv.parallel import MMDataParallel
+from mmcv.runner import load_checkpoint, wrap_fp16_model
+
+from mmdet.apis.test import encode_results
+from mmdet.datasets import (build_dataloader, build_dataset,
+                            replace_ImageToTensor)
+from mmdet.models import build_detector
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='MMDet benchmark test throughput at several batch sizes',
+        epilog='e.g. configs/faster_rcnn/faster_rcnn_r50_fpn_1x_coco.py '
+        'configs/vfnet/vfnet_custom.py configs/gflv2/gflv2_custom.py')
+    parser.add_argument('configs', nargs='+', help='test config files')
+    parser.add_argument(
+        '--checkpoints',
+        nargs='+',
+        help='checkpoint of each config (default: random weights, which '
+        'is enough for speed but slows NMS down with many boxes)')
+    parser.add_argument(
+        '--batch-sizes',
+        type=int,
+        nargs='+',
+        default=[1, 4, 8],
+        help='samples_per_gpu values to benchmark')
+    parser.add_argument(
+        '--num-images',
+        type=int,
+        default=200,
+        help='images timed per setting, after the warmup')
+    parser.add_argument(
+        '--num-warmup', type=int, default=16, help='images not timed')
+    parser.add_argument(
+        '--postprocess-workers',
+        type=int,
+        default=1,
+        help='threads encoding mask results in the overlapped run, as in '
+        'single_gpu_test (0 to skip that run)')
+    parser.add_argument(
+        '--fuse-conv-bn',
+        action='store_true',
+        help='Whether to fuse conv and bn, this will slightly increase'
+        'the inference speed')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used configs, the key-value '
+        'pair in xxx=yyy format will be merged into config file.')
+    args = parser.parse_args()
+    if args.checkpoints and len(args.checkpoints) != len(args.configs):
+        raise ValueError('give one checkpoint per config')
+    return args
+
+
+def build_model(cfg, checkpoint, fuse_conv=False):
+    cfg.model.train_cfg = None
+    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
+    fp16_cfg = cfg.get('fp16', None)
+    if fp16_cfg is not None:
+        wrap_fp16_model(model)
+    if checkpoint is not None:
+        load_checkpoint(model, checkpoint, map_location='cpu')
+    if fuse_conv:
+        model = fuse_conv_bn(model)
+    model = MMDataParallel(model, device_ids=[0])
+    model.eval()
+    return model
+
+
+def run_loop(model, loader, num_warmup_batches, executor=None):
+    """Seconds spent in forward and in inline encoding, and the wall time.
+
+    Only batches after the warmup are timed. With an ``executor`` the
+    results are encoded in its threads as in ``single_gpu_test`` and the
+    encode time is not measured separately.
+    """
+    num_timed, forward_time, encode_time, start_time = 0, 0., 0., None
+    futures = []
+    for i, data in enumerate(loader):
+        if i == num_warmup_batches:
+            torch.cuda.synchronize()
+            start_time = time.perf_counter()
+        tic = time.perf_counter()
+        with torch.no_grad():
+            result = model(return_loss=False, rescale=True, **data)
+        torch.cuda.synchronize()
+        toc = time.perf_counter()
+        if executor is not None:
+            futures.append(executor.submit(encode_results, result))
+        else:
+            encode_results(result)
+        if start_time is not None:
+            num_timed += len(result)
+            forward_time += toc - tic
+            encode_time += time.perf_counter() - toc
+    for future in futures:
+        future.result()
+    torch.cuda.synchronize()
+    if start_time is None:
+        return 0, float('nan'), float('nan'), float('nan')
+    return (num_timed, forward_time, encode_time,
+            time.perf_counter() - start_time)
+
+
+def measure(model, cfg, batch_size, num_images, num_warmup,
+            postprocess_workers):
+    """Images per second of the forward alone and of the test loop.
+
+    The test loop is timed with result encoding inline and, for models
+    with a mask head, once more with the encoding in background threads
+    as ``single_gpu_test`` does (``overlapped``, None otherwise), so the
+    gain of batching and the gain of overlapping the encoding are reported
+    apart.
+    """
+    test_cfg = cfg.data.test.copy()
+    test_cfg.pop('samples_per_gpu', None)
+    if batch_size > 1:
+        test_cfg.pipeline = replace_ImageToTensor(test_cfg.pipeline)
+    dataset = build_dataset(test_cfg)
+    data_loader = build_dataloader(
+        dataset,
+        samples_per_gpu=batch_size,
+        workers_per_gpu=cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False,
+        shape_bucket=batch_size > 1)
+
+    num_warmup_batches = -(-num_warmup // batch_size)
+    num_batches = -(-num_images // batch_size)
+
+    def loader():
+        return itertools.islice(data_loader, num_warmup_batches + num_batches)
+
+    num_timed, forward_time, encode_time, inline_time = run_loop(
+        model, loader(), num_warmup_batches)
+    speed = dict(
+        forward=num_timed / forward_time,
+        encode=num_timed / encode_time if encode_time else float('inf'),
+        inline=num_timed / inline_time,
+        overlapped=None)
+    if model.module.with_mask and postprocess_workers > 0:
+        with ThreadPoolExecutor(postprocess_workers) as executor:
+            num_timed, _, _, overlapped_time = run_loop(
+                model, loader(), num_warmup_batches, executor)
+        speed['overlapped'] = num_timed / overlapped_time
+    return speed
+
+
+def main():
+    args = parse_args()
+    checkpoints = args.checkpoints or [None] * len(args.configs)
+
+    rows = []
+    for config, checkpoint in zip(args.configs, checkpoints):
+        cfg = Config.fromfile(config)
+        if args.cfg_options is not None:
+            cfg.merge_from_dict(args.cfg_options)
+        if cfg.get('custom_imports', None):
+            from mmcv.utils import import_modules_from_strings
+            import_modules_from_strings(**cfg['custom_imports'])
+        if cfg.get('cudnn_benchmark', False):
+            torch.backends.cudnn.benchmark = True
+        cfg.model.pretrained = None
+        cfg.data.test.test_mode = True
+        model = build_model(cfg, checkpoint, args.fuse_conv_bn)
+
+        speeds = []
+        for batch_size in args.batch_sizes:
+            speed = measure(model, cfg, batch_size, args.num_images,
+                            args.num_warmup, args.postprocess_workers)
+            speeds.append(speed)
+            line = (f'{config} batch {batch_size}: '
+                    f'forward {speed["forward"]:.1f} img / s, '
+                    f'encode {speed["encode"]:.1f} img / s, '
+                    f'test loop {speed["inline"]:.1f} img / s inline')
+            if speed['overlapped'] is not None:
+                line += f', {speed["overlapped"]:.1f} img / s overlapped'
+            print(line)
+        rows.append((config, speeds))
+        del model
+        torch.cuda.empty_cache()
+
+    # batch speedups compare the inline test loop, so they do not include
+    # the encoding overlap, which is the last column
+    header = ['config'] + [f'batch {b}' for b in args.batch_sizes]
+    header.append('overlap gain')
+    print('\n' + ' | '.join(header))
+    for config, speeds in rows:
+        base = speeds[0]['inline']
+        cells = [
+            f'{speed["inline"]:.1f} ({speed["inline"] / base:.2f}x)'
+            for speed in speeds
+        ]
+        gains = [
+            '-' if speed['overlapped'] is None else
+            f'{speed["overlapped"] / speed["inline"]:.2f}x' for speed in speeds
+        ]
+        print(' | '.join([config] + cells + [' / '.join(gains)]))
+
+
+if __name__ == '__main__':
+    main()
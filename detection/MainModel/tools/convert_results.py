@@ -0,0 +1,53 @@
+import argparse
+import os.path as osp
+import time
+
+import mmcv
+
+from mmdet.core import DetectionResults, load_results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Convert pickled test results to a DetectionResults '
+        'directory (.dets) or back')
+    parser.add_argument('src', help='result pkl or .dets directory')
+    parser.add_argument('dst', help='output .dets directory or pkl file')
+    parser.add_argument('--config', help='config the results come from')
+    parser.add_argument(
+        '--checkpoint', help='checkpoint the results come from')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    tic = time.perf_counter()
+    results = load_results(args.src)
+    print(f'loaded {len(results)} images from {args.src} '
+          f'in {time.perf_counter() - tic:.2f} s')
+
+    if args.dst.endswith('.dets'):
+        if not isinstance(results, DetectionResults):
+            meta = dict(source=osp.abspath(args.src))
+            if args.config:
+                cfg = mmcv.Config.fromfile(args.config)
+                meta.update(
+                    config=args.config,
+                    dataset=cfg.data.test.get('type'),
+                    ann_file=cfg.data.test.get('ann_file'),
+                    classes=cfg.get('classes'))
+            if args.checkpoint:
+                meta['checkpoint'] = args.checkpoint
+            results = DetectionResults.from_list(results, meta=meta)
+        results.dump(args.dst)
+        print(f'{results.num_dets} detections of {len(results)} images '
+              f'written to {args.dst}')
+    else:
+        if isinstance(results, DetectionResults):
+            results = results.to_list()
+        mmcv.dump(results, args.dst)
+        print(f'{len(results)} images written to {args.dst}')
+
+
+if __name__ == '__main__':
+    main()
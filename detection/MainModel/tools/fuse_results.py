@@ -0,0 +1,197 @@
+import argparse
+import time
+
+import mmcv
+import numpy as np
+import pandas as pd
+from pycocotools.coco import COCO
+
+from mmdet.core import DetectionResults, fuse_results, load_results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Fuse the results of several models into a submission')
+    parser.add_argument(
+        'results',
+        nargs='+',
+        help='result files of single_gpu_test (pkl or .dets directory)')
+    parser.add_argument(
+        '--ann-file',
+        default='../../input/data/test.json',
+        help='test annotation file, gives the image order and file names')
+    parser.add_argument('--out', help='submission csv file')
+    parser.add_argument(
+        '--out-pkl',
+        help='fused results in pickle format, or a DetectionResults '
+        'directory if it ends with .dets')
+    parser.add_argument(
+        '--weights',
+        type=float,
+        nargs='+',
+        help='weight of each model (default: all 1)')
+    parser.add_argument(
+        '--method',
+        default='wbf',
+        choices=['wbf', 'nmw', 'soft_nms'],
+        help='box fusion method')
+    parser.add_argument('--iou-thr', type=float, default=0.55)
+    parser.add_argument(
+        '--skip-box-thr',
+        type=float,
+        default=0.0,
+        help='ignore input boxes with a lower score')
+    parser.add_argument(
+        '--score-thr',
+        type=float,
+        default=0.0,
+        help='drop fused boxes with a lower score')
+    parser.add_argument(
+        '--conf-type', default='avg', choices=['avg', 'max'], help='WBF only')
+    parser.add_argument(
+        '--sigma', type=float, default=0.5, help='gaussian soft-NMS sigma')
+    parser.add_argument(
+        '--nproc', type=int, default=4, help='processes over images')
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help='also run the notebook path (ensemble-boxes per image) and '
+        'compare time and output')
+    return parser.parse_args()
+
+
+def results2submission(results, coco):
+    """Format fused results as PredictionString rows.
+
+    Each image becomes one '%d %.8f %.5f %.5f %.5f %.5f ' * n string, with
+    boxes ordered by label and then by descending score.
+    """
+    prediction_strings, file_names = [], []
+    for img_id, result in zip(coco.getImgIds(), results):
+        labels = np.concatenate(
+            [np.full(len(dets), i) for i, dets in enumerate(result)])
+        dets = np.concatenate(result)
+        order = np.lexsort((-dets[:, 4], labels))
+        rows = np.column_stack(
+            [labels[order], dets[order, 4], dets[order, :4]])
+        prediction_strings.append(
+            ('%d %.8f %.5f %.5f %.5f %.5f ' * len(rows)) %
+            tuple(rows.ravel().tolist()))
+        file_names.append(coco.loadImgs(img_id)[0]['file_name'])
+    submission = pd.DataFrame()
+    submission['PredictionString'] = prediction_strings
+    submission['image_id'] = file_names
+    return submission
+
+
+def notebook_submission(model_results, coco, weights, iou_thr, skip_box_thr):
+    """The path of faster_rcnn_inference_ensemble.ipynb, for comparison."""
+    from ensemble_boxes import weighted_boxes_fusion
+
+    prediction_strings = []
+    for img_id, results in zip(coco.getImgIds(), zip(*model_results)):
+        img_info = coco.loadImgs(img_id)[0]
+        scale = np.array([img_info['width'], img_info['height']] * 2)
+        boxes_list, scores_list, labels_list = [], [], []
+        for result in results:
+            boxes, scores, labels = [], [], []
+            for j, dets in enumerate(result):
+                boxes += (dets[:, :4] / scale).tolist()
+                scores += dets[:, 4].tolist()
+                labels += [j] * len(dets[:, 4].tolist())
+            boxes_list.append(boxes)
+            scores_list.append(scores)
+            labels_list.append(labels)
+        boxes, scores, labels = weighted_boxes_fusion(
+            boxes_list,
+            scores_list,
+            labels_list,
+            weights=weights,
+            iou_thr=iou_thr,
+            skip_box_thr=skip_box_thr)
+        predict_zip = list(zip(boxes * scale, scores, labels))
+        predict_zip.sort(key=lambda x: (x[2], -x[1]))
+        prediction_string = ''
+        for box, score, label in predict_zip:
+            prediction_string += str(int(label)) + ' ' + f'{score:.8f}' + \
+                ' ' + f'{box[0]:.5f}' + ' ' + f'{box[1]:.5f}' + ' ' + \
+                f'{box[2]:.5f}' + ' ' + f'{box[3]:.5f}' + ' '
+        prediction_strings.append(prediction_string)
+    return prediction_strings
+
+
+def compare_submissions(prediction_strings, reference_strings):
+    """Number of images whose box count differs and the largest difference
+    of the matched (label, score, box) values on the other images."""
+    num_mismatch, max_diff = 0, 0.
+    for pred, ref in zip(prediction_strings, reference_strings):
+        pred = np.array(pred.split(), dtype=np.float64).reshape(-1, 6)
+        ref = np.array(ref.split(), dtype=np.float64).reshape(-1, 6)
+        if pred.shape != ref.shape:
+            num_mismatch += 1
+            continue
+        if len(pred):
+            pred = pred[np.lexsort((pred[:, 2], -pred[:, 1], pred[:, 0]))]
+            ref = ref[np.lexsort((ref[:, 2], -ref[:, 1], ref[:, 0]))]
+            max_diff = max(max_diff, np.abs(pred - ref).max())
+    return num_mismatch, max_diff
+
+
+def main():
+    args = parse_args()
+    assert args.out or args.out_pkl or args.benchmark, (
+        'Please specify at least one operation (save/benchmark the fused '
+        'results) with the argument "--out", "--out-pkl" or "--benchmark"')
+
+    model_results = [load_results(path) for path in args.results]
+    model_results = [[
+        result[0] if isinstance(result, tuple) else result
+        for result in results
+    ] for results in model_results]
+    coco = COCO(args.ann_file)
+    fusion_cfg = dict(
+        weights=args.weights,
+        method=args.method,
+        iou_thr=args.iou_thr,
+        skip_box_thr=args.skip_box_thr,
+        score_thr=args.score_thr,
+        conf_type=args.conf_type,
+        sigma=args.sigma)
+
+    tic = time.perf_counter()
+    fused = fuse_results(model_results, nproc=args.nproc, **fusion_cfg)
+    submission = results2submission(fused, coco)
+    elapsed = time.perf_counter() - tic
+    print(f'fused {len(args.results)} models over {len(fused)} images '
+          f'with {args.method} in {elapsed:.2f} s')
+
+    if args.out:
+        submission.to_csv(args.out, index=None)
+        print(f'writing submission to {args.out}')
+    if args.out_pkl:
+        if args.out_pkl.endswith('.dets'):
+            DetectionResults.from_list(
+                fused, meta=dict(fused=args.results,
+                                 **fusion_cfg)).dump(args.out_pkl)
+        else:
+            mmcv.dump(fused, args.out_pkl)
+        print(f'writing fused results to {args.out_pkl}')
+
+    if args.benchmark:
+        assert args.method == 'wbf' and args.conf_type == 'avg' and \
+            args.score_thr == 0, \
+            'the notebook path only covers wbf with conf_type avg'
+        tic = time.perf_counter()
+        reference = notebook_submission(model_results, coco, args.weights,
+                                        args.iou_thr, args.skip_box_thr)
+        reference_elapsed = time.perf_counter() - tic
+        num_mismatch, max_diff = compare_submissions(
+            submission['PredictionString'], reference)
+        print(f'notebook path: {reference_elapsed:.2f} s '
+              f'({reference_elapsed / elapsed:.1f}x slower)')
+        print(f'images with a different box count: {num_mismatch}, '
+              f'max difference otherwise: {max_diff:.6f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -11,9 +11,10 @@ from mmcv.runner import (get_dist_info, init_dist, load_checkpoint,
                          wrap_fp16_model)
 from tools.rearrange_weights import rearrange_classes
 
-from mmdet.apis import multi_gpu_test, single_gpu_test
-from mmdet.datasets import (build_dataloader, build_dataset,
-                            replace_ImageToTensor)
+from mmdet.apis import multi_gpu_test, multi_model_test, single_gpu_test
+from mmdet.core import DetectionResults
+from mmdet.datasets import (MultiPipelineDataset, build_dataloader,
+                            build_dataset, replace_ImageToTensor)
 from mmdet.models import build_detector
 
 
@@ -22,7 +23,10 @@ def parse_args():
         description='MMDet test (and eval) a model')
     parser.add_argument('config', help='test config file path')
     parser.add_argument('checkpoint', help='checkpoint file')
-    parser.add_argument('--out', help='output result file in pickle format')
+    parser.add_argument(
+        '--out',
+        help='output result file in pickle format, or a DetectionResults '
+        'directory if it ends with .dets')
     parser.add_argument(
         '--fuse-conv-bn',
         action='store_true',
@@ -89,6 +93,37 @@ def parse_args():
         type=float,
         default=1.6667,
         help='aspect ratio of images when overriding test image scales')
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='images per forward (overrides data.test.samples_per_gpu); '
+        'batches are formed from images of similar shape')
+    parser.add_argument(
+        '--extra-models',
+        nargs='+',
+        metavar='CONFIG CHECKPOINT',
+        help='config and checkpoint pairs of more models to test along with '
+        'the first one, loading every image once for all of them')
+    parser.add_argument(
+        '--fusion',
+        choices=['wbf', 'nmw', 'soft_nms'],
+        help='fuse the boxes of all models on the fly with this method; '
+        'without it each model gets its own output (out_0.pkl, ...)')
+    parser.add_argument(
+        '--fusion-weights',
+        type=float,
+        nargs='+',
+        help='weight of each model in the fusion (default: all 1)')
+    parser.add_argument(
+        '--fusion-iou-thr',
+        type=float,
+        default=0.55,
+        help='IoU threshold of the box fusion')
+    parser.add_argument(
+        '--fusion-skip-box-thr',
+        type=float,
+        default=0.0,
+        help='boxes with a lower score are ignored by the box fusion')
     parser.add_argument(
         '--launcher',
         choices=['none', 'pytorch', 'slurm', 'mpi'],
@@ -103,12 +138,94 @@ def parse_args():
         raise ValueError(
             '--options and --eval-options cannot be both '
             'specified, --options is deprecated in favor of --eval-options')
+    if args.extra_models and len(args.extra_models) % 2:
+        raise ValueError('--extra-models takes config and checkpoint pairs')
+    if args.fusion and not args.extra_models:
+        raise ValueError('--fusion needs --extra-models')
     if args.options:
         warnings.warn('--options is deprecated in favor of --eval-options')
         args.eval_options = args.options
     return args
 
 
+def clear_pretrained(cfg):
+    cfg.model.pretrained = None
+    if cfg.model.get('neck'):
+        if isinstance(cfg.model.neck, list):
+            for neck_cfg in cfg.model.neck:
+                if neck_cfg.get('rfp_backbone'):
+                    if neck_cfg.rfp_backbone.get('pretrained'):
+                        neck_cfg.rfp_backbone.pretrained = None
+        elif cfg.model.neck.get('rfp_backbone'):
+            if cfg.model.neck.rfp_backbone.get('pretrained'):
+                cfg.model.neck.rfp_backbone.pretrained = None
+
+
+def override_img_scale(cfg, args):
+    """Apply ``--img-scale-short`` to the test pipeline of ``cfg``."""
+    if args.img_scale_short is not None:
+        img_scale = [(round(short * args.img_aspect_ratio), short)
+                     for short in args.img_scale_short]
+        cfg.data.test.pipeline[1].img_scale = img_scale
+        print('test img_scale:', cfg.data.test.pipeline[1].img_scale)
+
+
+def build_test_model(cfg, checkpoint_file, dataset, fuse_conv=False):
+    """Build the model of ``cfg`` and load its checkpoint for testing."""
+    cfg.model.train_cfg = None
+    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
+    fp16_cfg = cfg.get('fp16', None)
+    if fp16_cfg is not None:
+        wrap_fp16_model(model)
+    checkpoint = load_checkpoint(model, checkpoint_file, map_location='cpu')
+    # perform model surgery
+    classes_rearrange = cfg.get('classes_rearrange', False)
+    if classes_rearrange:
+        model = rearrange_classes(model, cfg.classes, cfg.dataset_type)
+    if fuse_conv:
+        model = fuse_conv_bn(model)
+    # old versions did not save class info in checkpoints, this walkaround is
+    # for backward compatibility
+    if 'CLASSES' in checkpoint.get('meta', {}):
+        model.CLASSES = checkpoint['meta']['CLASSES']
+    else:
+        model.CLASSES = dataset.CLASSES
+    return model
+
+
+def save_and_evaluate(args, cfg, dataset, outputs, out_suffix='', **meta):
+    """Save, format and evaluate the outputs as asked by ``args``."""
+    if args.out:
+        root, ext = os.path.splitext(args.out)
+        out = root + out_suffix + ext
+        print(f'\nwriting results to {out}')
+        if out.endswith('.dets'):
+            DetectionResults.from_list(
+                outputs,
+                meta=dict(
+                    dataset=cfg.data.test.get('type'),
+                    ann_file=cfg.data.test.get('ann_file'),
+                    classes=list(dataset.CLASSES),
+                    **meta)).dump(out)
+        else:
+            mmcv.dump(outputs, out)
+    kwargs = {} if args.eval_options is None else args.eval_options
+    if args.format_only:
+        dataset.format_results(outputs, **kwargs)
+    if args.eval:
+        eval_kwargs = cfg.get('evaluation', {}).copy()
+        # hard-code way to remove EvalHook args
+        for key in [
+                'interval', 'tmpdir', 'start', 'gpu_collect', 'save_best',
+                'rule'
+        ]:
+            eval_kwargs.pop(key, None)
+        eval_kwargs.update(dict(metric=args.eval, **kwargs))
+        print(dataset.evaluate(outputs, **eval_kwargs))
+    if args.img_scale_short is not None:
+        print('test img_scale:', cfg.data.test.pipeline[1].img_scale)
+
+
 def main():
     args = parse_args()
 
@@ -121,8 +238,10 @@ def main():
     if args.eval and args.format_only:
         raise ValueError('--eval and --format_only cannot be both specified')
 
-    if args.out is not None and not args.out.endswith(('.pkl', '.pickle')):
-        raise ValueError('The output file must be a pkl file.')
+    if args.out is not None and not args.out.endswith(
+            ('.pkl', '.pickle', '.dets')):
+        raise ValueError('The output file must be a pkl file or a .dets '
+                         'directory.')
 
     cfg = Config.fromfile(args.config)
     if args.cfg_options is not None:
@@ -134,22 +253,15 @@ def main():
     # set cudnn_benchmark
     if cfg.get('cudnn_benchmark', False):
         torch.backends.cudnn.benchmark = True
-    cfg.model.pretrained = None
-    if cfg.model.get('neck'):
-        if isinstance(cfg.model.neck, list):
-            for neck_cfg in cfg.model.neck:
-                if neck_cfg.get('rfp_backbone'):
-                    if neck_cfg.rfp_backbone.get('pretrained'):
-                        neck_cfg.rfp_backbone.pretrained = None
-        elif cfg.model.neck.get('rfp_backbone'):
-            if cfg.model.neck.rfp_backbone.get('pretrained'):
-                cfg.model.neck.rfp_backbone.pretrained = None
+    clear_pretrained(cfg)
 
     # in case the test dataset is concatenated
     samples_per_gpu = 1
     if isinstance(cfg.data.test, dict):
         cfg.data.test.test_mode = True
         samples_per_gpu = cfg.data.test.pop('samples_per_gpu', 1)
+        if args.batch_size is not None:
+            samples_per_gpu = args.batch_size
         if samples_per_gpu > 1:
             # Replace 'ImageToTensor' to 'DefaultFormatBundle'
             cfg.data.test.pipeline = replace_ImageToTensor(
@@ -159,16 +271,14 @@ def main():
             ds_cfg.test_mode = True
         samples_per_gpu = max(
             [ds_cfg.pop('samples_per_gpu', 1) for ds_cfg in cfg.data.test])
+        if args.batch_size is not None:
+            samples_per_gpu = args.batch_size
         if samples_per_gpu > 1:
             for ds_cfg in cfg.data.test:
                 ds_cfg.pipeline = replace_ImageToTensor(ds_cfg.pipeline)
 
     # override img_scale
-    if args.img_scale_short is not None:
-        img_scale = [(round(short * args.img_aspect_ratio), short)
-                     for short in args.img_scale_short]
-        cfg.data.test.pipeline[1].img_scale = img_scale
-        print('test img_scale:', cfg.data.test.pipeline[1].img_scale)
+    override_img_scale(cfg, args)
 
     # init distributed env first, since logger depends on the dist info.
     if args.launcher == 'none':
@@ -184,27 +294,77 @@ def main():
         samples_per_gpu=samples_per_gpu,
         workers_per_gpu=cfg.data.workers_per_gpu,
         dist=distributed,
-        shuffle=False)
+        shuffle=False,
+        shape_bucket=samples_per_gpu > 1)
 
     # build the model and load checkpoint
-    cfg.model.train_cfg = None
-    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
-    fp16_cfg = cfg.get('fp16', None)
-    if fp16_cfg is not None:
-        wrap_fp16_model(model)
-    checkpoint = load_checkpoint(model, args.checkpoint, map_location='cpu')
-    # perform model surgery
-    classes_rearrange = cfg.get('classes_rearrange', False)
-    if classes_rearrange:
-        model = rearrange_classes(model, cfg.classes, cfg.dataset_type)
-    if args.fuse_conv_bn:
-        model = fuse_conv_bn(model)
-    # old versions did not save class info in checkpoints, this walkaround is
-    # for backward compatibility
-    if 'CLASSES' in checkpoint.get('meta', {}):
-        model.CLASSES = checkpoint['meta']['CLASSES']
-    else:
-        model.CLASSES = dataset.CLASSES
+    model = build_test_model(cfg, args.checkpoint, dataset, args.fuse_conv_bn)
+
+    if args.extra_models:
+        assert not distributed, \
+            '--extra-models only supports non-distributed testing'
+        configs = [args.config] + args.extra_models[::2]
+        checkpoints = [args.checkpoint] + args.extra_models[1::2]
+        models = [MMDataParallel(model, device_ids=[0])]
+        pipelines = [cfg.data.test.pipeline]
+        for config, checkpoint in zip(configs[1:], checkpoints[1:]):
+            # the extra models get the same overrides as the first one
+            extra_cfg = Config.fromfile(config)
+            if args.cfg_options is not None:
+                extra_cfg.merge_from_dict(args.cfg_options)
+            clear_pretrained(extra_cfg)
+            override_img_scale(extra_cfg, args)
+            pipeline = extra_cfg.data.test.pipeline
+            if samples_per_gpu > 1:
+                pipeline = replace_ImageToTensor(pipeline)
+            pipelines.append(pipeline)
+            models.append(
+                MMDataParallel(
+                    build_test_model(extra_cfg, checkpoint, dataset,
+                                     args.fuse_conv_bn),
+                    device_ids=[0]))
+        # every image is decoded once, models with the same test pipeline
+        # also share the transformed data
+        multi_dataset = MultiPipelineDataset(dataset, pipelines)
+        print(f'testing {len(models)} models with '
+              f'{len(multi_dataset.pipelines)} distinct test pipelines')
+        data_loader = build_dataloader(
+            multi_dataset,
+            samples_per_gpu=samples_per_gpu,
+            workers_per_gpu=cfg.data.workers_per_gpu,
+            dist=False,
+            shuffle=False,
+            shape_bucket=samples_per_gpu > 1)
+        fusion_cfg = None
+        if args.fusion:
+            fusion_cfg = dict(
+                weights=args.fusion_weights,
+                method=args.fusion,
+                iou_thr=args.fusion_iou_thr,
+                skip_box_thr=args.fusion_skip_box_thr)
+        outputs = multi_model_test(models, data_loader, fusion_cfg)
+        if fusion_cfg is None:
+            for i, (config, checkpoint, model_outputs) in enumerate(
+                    zip(configs, checkpoints, outputs)):
+                print(f'\nmodel {i}: {config}')
+                save_and_evaluate(
+                    args,
+                    cfg,
+                    dataset,
+                    model_outputs,
+                    out_suffix=f'_{i}',
+                    config=config,
+                    checkpoint=checkpoint)
+        else:
+            save_and_evaluate(
+                args,
+                cfg,
+                dataset,
+                outputs,
+                config=configs,
+                checkpoint=checkpoints,
+                fusion=fusion_cfg)
+        return
 
     if not distributed:
         model = MMDataParallel(model, device_ids=[0])
@@ -220,24 +380,13 @@ def main():
 
     rank, _ = get_dist_info()
     if rank == 0:
-        if args.out:
-            print(f'\nwriting results to {args.out}')
-            mmcv.dump(outputs, args.out)
-        kwargs = {} if args.eval_options is None else args.eval_options
-        if args.format_only:
-            dataset.format_results(outputs, **kwargs)
-        if args.eval:
-            eval_kwargs = cfg.get('evaluation', {}).copy()
-            # hard-code way to remove EvalHook args
-            for key in [
-                    'interval', 'tmpdir', 'start', 'gpu_collect', 'save_best',
-                    'rule'
-            ]:
-                eval_kwargs.pop(key, None)
-            eval_kwargs.update(dict(metric=args.eval, **kwargs))
-            print(dataset.evaluate(outputs, **eval_kwargs))
-        if args.img_scale_short is not None:
-            print('test img_scale:', cfg.data.test.pipeline[1].img_scale)
+        save_and_evaluate(
+            args,
+            cfg,
+            dataset,
+            outputs,
+            config=args.config,
+            checkpoint=args.checkpoint)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import json
 import os
 import random
 import h5py
@@ -46,12 +47,55 @@ class RandomGenerator(object):
         return sample
 
 
+class SliceShards(object):
+    """pack_synapse.py 로 만든 shard 에서 slice 를 읽습니다.
+
+    shard 는 memmap 으로 열고, worker process 마다 한 번만 엽니다. (fork 된 handle 은 쓰지 않습니다)
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.image_size = index['image_size']
+        self.resized = index.get('resized', True)
+        self.shards = index['shards']
+        self.slices = index['slices']
+        self._pid = None
+        self._handles = None
+
+    def __contains__(self, slice_name):
+        return slice_name in self.slices
+
+    def _open(self):
+        if self._pid != os.getpid():
+            self._handles = [(np.load(os.path.join(self.shard_dir, shard['image']), mmap_mode='r'),
+                              np.load(os.path.join(self.shard_dir, shard['label']), mmap_mode='r'))
+                             for shard in self.shards]
+            self._pid = os.getpid()
+        return self._handles
+
+    def __getitem__(self, slice_name):
+        shard, offset = self.slices[slice_name]
+        images, labels = self._open()[shard]
+        return np.array(images[offset]), np.array(labels[offset])
+
+
 class Synapse_dataset(Dataset):
-    def __init__(self, base_dir, list_dir, split, transform=None):
+    def __init__(self, base_dir, list_dir, split, transform=None, shard_dir=None, img_size=None):
         self.transform = transform  # using transform in torch!
         self.split = split
         self.sample_list = open(os.path.join(list_dir, self.split+'.txt')).readlines()
         self.data_dir = base_dir
+        self.shards = SliceShards(shard_dir) if shard_dir and split == "train" else None
+        if self.shards is not None:
+            missing = [name.strip('\n') for name in self.sample_list if name.strip('\n') not in self.shards]
+            if missing:
+                raise KeyError('{} slices are not in {} (e.g. {})'.format(len(missing), shard_dir, missing[0]))
+            # pack_synapse.py --img_size 로 줄인 shard 를 다른 크기로 학습하면 RandomGenerator 가 줄인 slice 를 다시
+            # zoom 하므로 (e.g. 224 -> 512) 해상도를 잃습니다. 원래 크기의 shard 는 npz 와 같이 zoom 됩니다.
+            if img_size and self.shards.resized and self.shards.image_size != [img_size, img_size]:
+                raise ValueError('{} holds slices pre-resized to {} but img_size is {}; repack with --img_size {} '
+                                 'or without --img_size'.format(shard_dir, self.shards.image_size, img_size, img_size))
 
     def __len__(self):
         return len(self.sample_list)
@@ -59,14 +103,17 @@ class Synapse_dataset(Dataset):
     def __getitem__(self, idx):
         if self.split == "train":
             slice_name = self.sample_list[idx].strip('\n')
-            data_path = os.path.join(self.data_dir, slice_name+'.npz')
-            data = np.load(data_path)
-            image, label = data['image'], data['label']
+            if self.shards is not None:
+                image, label = self.shards[slice_name]
+            else:
+                data_path = os.path.join(self.data_dir, slice_name+'.npz')
+                data = np.load(data_path)
+                image, label = data['image'], data['label']
         else:
             vol_name = self.sample_list[idx].strip('\n')
             filepath = self.data_dir + "/{}.npy.h5".format(vol_name)
-            data = h5py.File(filepath)
-            image, label = data['image'][:], data['label'][:]
+            with h5py.File(filepath, 'r') as data:
+                image, label = data['image'][:], data['label'][:]
 
         sample = {'image': image, 'label': label}
         if self.transform:
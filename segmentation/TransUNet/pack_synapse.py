@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import numpy as np
+from scipy.ndimage import zoom
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--root_path', type=str,
+                    default='../data/Synapse/train_npz', help='root dir for the training slices (*.npz)')
+parser.add_argument('--list_dir', type=str,
+                    default='./lists/lists_Synapse', help='list dir')
+parser.add_argument('--split', type=str, default='train', help='list file to pack')
+parser.add_argument('--output_dir', type=str,
+                    default='../data/Synapse/train_shards', help='where to write the shards and index.json')
+parser.add_argument('--shard_size', type=int, default=1024, help='slices per shard')
+parser.add_argument('--img_size', type=int, default=0,
+                    help='resize slices to img_size at pack time (0: keep the original size)')
+
+
+def load_slice(root_path, slice_name, img_size):
+    data = np.load(os.path.join(root_path, slice_name + '.npz'))
+    image, label = data['image'], data['label']
+    x, y = image.shape
+    if img_size and (x != img_size or y != img_size):
+        # RandomGenerator 와 같은 resampling (image order=3, label order=0)
+        image = zoom(image, (img_size / x, img_size / y), order=3)
+        label = zoom(label, (img_size / x, img_size / y), order=0)
+    return image.astype(np.float32), label.astype(np.uint8)
+
+
+def write_shard(output_dir, shard_id, images, labels):
+    shard = {'image': 'image_{:04d}.npy'.format(shard_id), 'label': 'label_{:04d}.npy'.format(shard_id),
+             'count': len(images)}
+    for key, array in (('image', images), ('label', labels)):
+        path = os.path.join(output_dir, shard[key])
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, np.stack(array))
+        os.replace(tmp_path, path)
+    return shard
+
+
+def pack(root_path, slice_names, output_dir, shard_size=1024, img_size=0):
+    """slice 별 .npz 를 shard_size 장씩 묶어 (N, H, W) .npy shard 와 index.json 으로 씁니다.
+
+    .npy 는 압축하지 않으므로 dataset 에서 memmap 으로 열어 slice 하나만 읽을 수 있습니다.
+    index.json 은 마지막에 쓰므로 중간에 멈추면 index 가 없는 (쓰지 않는) 상태로 남습니다.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shards, slices = [], {}
+    images, labels = [], []
+    image_size = None
+    for slice_name in tqdm(slice_names, ncols=70):
+        image, label = load_slice(root_path, slice_name, img_size)
+        if image_size is None:
+            image_size = list(image.shape)
+        elif list(image.shape) != image_size:
+            raise ValueError('{} has shape {} but the shards hold {}; pass --img_size to resize'.format(
+                slice_name, list(image.shape), image_size))
+        slices[slice_name] = [len(shards), len(images)]
+        images.append(image)
+        labels.append(label)
+        if len(images) == shard_size:
+            shards.append(write_shard(output_dir, len(shards), images, labels))
+            images, labels = [], []
+    if images:
+        shards.append(write_shard(output_dir, len(shards), images, labels))
+
+    # resized: --img_size 로 줄인 shard 인지 (Synapse_dataset 이 학습 img_size 와 맞는지 확인합니다)
+    index = {'image_size': image_size, 'resized': bool(img_size), 'shards': shards, 'slices': slices}
+    tmp_path = os.path.join(output_dir, 'index.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(output_dir, 'index.json'))
+    return index
+
+
+if __name__ == "__main__":
+    # python pack_synapse.py --img_size 224
+    # python train.py --shard_dir ../data/Synapse/train_shards
+    args = parser.parse_args()
+    slice_names = [line.strip('\n') for line in open(os.path.join(args.list_dir, args.split + '.txt')) if line.strip()]
+    index = pack(args.root_path, slice_names, args.output_dir, args.shard_size, args.img_size)
+    print('packed {} slices of {} into {} shards at {}'.format(len(index['slices']), index['image_size'],
+                                                                len(index['shards']), args.output_dir))
@@ -12,6 +12,8 @@ from trainer import trainer_synapse
 parser = argparse.ArgumentParser()
 parser.add_argument('--root_path', type=str,
                     default='../data/Synapse/train_npz', help='root dir for data')
+parser.add_argument('--shard_dir', type=str,
+                    default=None, help='shards written by pack_synapse.py (read instead of root_path)')
 parser.add_argument('--dataset', type=str,
                     default='Synapse', help='experiment_name')
 parser.add_argument('--list_dir', type=str,
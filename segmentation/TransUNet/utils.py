@@ -1,8 +1,8 @@
 import numpy as np
 import torch
 from medpy import metric
-from scipy.ndimage import zoom
 import torch.nn as nn
+import torch.nn.functional as F
 import SimpleITK as sitk
 
 
@@ -58,32 +58,43 @@ def calculate_metric_percase(pred, gt):
         return 0, 0
 
 
-def test_single_volume(image, label, net, classes, patch_size=[256, 256], test_save_path=None, case=None, z_spacing=1):
+@torch.no_grad()
+def predict_volume(image, net, patch_size=[256, 256], batch_size=16, device=None):
+    """(D, H, W) volume 을 batch_size 장씩 묶어 slice 별 예측을 (D, H, W) int64 tensor 로 돌려줍니다.
+
+    resize 는 device 위에서 tensor interpolation 으로 합니다. (입력 bicubic, 예측 nearest)
+    scipy zoom(order=3 / order=0) 과 경계 부근 몇 pixel 이 다를 수 있습니다.
+    """
+    net.eval()
+    device = device or next(net.parameters()).device
+    volume = torch.as_tensor(image, dtype=torch.float32).to(device)
+    depth, x, y = volume.shape
+    resize = x != patch_size[0] or y != patch_size[1]
+    prediction = torch.empty((depth, x, y), dtype=torch.int64, device=device)
+    for start in range(0, depth, batch_size):
+        slices = volume[start:start + batch_size].unsqueeze(1)
+        if resize:
+            slices = F.interpolate(slices, size=tuple(patch_size), mode='bicubic', align_corners=False)
+        # softmax 는 argmax 결과를 바꾸지 않으므로 logit 에 바로 argmax 합니다.
+        out = net(slices).argmax(dim=1, keepdim=True)
+        if resize:
+            out = F.interpolate(out.float(), size=(x, y), mode='nearest')
+        prediction[start:start + batch_size] = out.squeeze(1).long()
+    return prediction
+
+
+def test_single_volume(image, label, net, classes, patch_size=[256, 256], test_save_path=None, case=None, z_spacing=1,
+                       batch_size=16):
     image, label = image.squeeze(0).cpu().detach().numpy(), label.squeeze(0).cpu().detach().numpy()
     if len(image.shape) == 3:
-        prediction = np.zeros_like(label)
-        for ind in range(image.shape[0]):
-            slice = image[ind, :, :]
-            x, y = slice.shape[0], slice.shape[1]
-            if x != patch_size[0] or y != patch_size[1]:
-                slice = zoom(slice, (patch_size[0] / x, patch_size[1] / y), order=3)  # previous using 0
-            input = torch.from_numpy(slice).unsqueeze(0).unsqueeze(0).float().cuda()
-            net.eval()
-            with torch.no_grad():
-                outputs = net(input)
-                out = torch.argmax(torch.softmax(outputs, dim=1), dim=1).squeeze(0)
-                out = out.cpu().detach().numpy()
-                if x != patch_size[0] or y != patch_size[1]:
-                    pred = zoom(out, (x / patch_size[0], y / patch_size[1]), order=0)
-                else:
-                    pred = out
-                prediction[ind] = pred
+        prediction = predict_volume(image, net, patch_size, batch_size).cpu().numpy().astype(label.dtype)
     else:
+        device = next(net.parameters()).device
         input = torch.from_numpy(image).unsqueeze(
-            0).unsqueeze(0).float().cuda()
+            0).unsqueeze(0).float().to(device)
         net.eval()
         with torch.no_grad():
-            out = torch.argmax(torch.softmax(net(input), dim=1), dim=1).squeeze(0)
+            out = torch.argmax(net(input), dim=1).squeeze(0)
             prediction = out.cpu().detach().numpy()
     metric_list = []
     for i in range(1, classes):
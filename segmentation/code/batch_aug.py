@@ -0,0 +1,110 @@
+import torch
+
+
+def _class_tensor(classes, device):
+    return torch.as_tensor(list(classes), dtype=torch.long, device=device)
+
+
+def cutmix_batch(images, masks, p=0.3, min_cut=70, max_cut=300, margin=10):
+    """batch 안의 임의의 다른 sample 에서 사각형 영역을 잘라 붙입니다.
+
+    images: (batch, channel, height, width), masks: (batch, height, width). 같은 device 에 있으면 됩니다.
+    sample 마다 p 의 확률로 적용되며 원본은 바꾸지 않고 새 tensor 를 돌려줍니다.
+    """
+    batch_size, _, height, width = images.shape
+    device = images.device
+    apply = torch.rand(batch_size, device=device) < p
+    if not bool(apply.any()):
+        return images, masks
+
+    partner = torch.randint(0, batch_size, (batch_size,), device=device)
+    max_h, max_w = min(max_cut, height - margin), min(max_cut, width - margin)
+    h_cut_size = torch.randint(min(min_cut, max_h - 1), max_h, (batch_size,), device=device)
+    w_cut_size = torch.randint(min(min_cut, max_w - 1), max_w, (batch_size,), device=device)
+    start_h = (torch.rand(batch_size, device=device) * (height - h_cut_size - margin)).long()
+    start_w = (torch.rand(batch_size, device=device) * (width - w_cut_size - margin)).long()
+
+    ys = torch.arange(height, device=device).view(1, -1, 1)
+    xs = torch.arange(width, device=device).view(1, 1, -1)
+    box = ((ys >= start_h.view(-1, 1, 1)) & (ys < (start_h + h_cut_size).view(-1, 1, 1)) &
+           (xs >= start_w.view(-1, 1, 1)) & (xs < (start_w + w_cut_size).view(-1, 1, 1)) &
+           apply.view(-1, 1, 1))
+
+    images = torch.where(box.unsqueeze(1), images[partner], images)
+    masks = torch.where(box, masks[partner], masks)
+    return images, masks
+
+
+def copyblob_batch(images, masks, src_classes, dst_class):
+    """utils.copyblob 을 batch 단위로 vectorize 한 것입니다.
+
+    sample i 마다 src_classes 중 하나를 골라, 그 class 의 blob 을 임의의 sample 의 dst_class 영역 위
+    임의의 위치(blob 의 좌상단 pixel 기준)로 옮겨 붙입니다. 원본은 바꾸지 않고 새 tensor 를 돌려줍니다.
+    src 는 모두 원본 batch 에서 읽으므로 같은 batch 안에서 붙여 넣은 blob 이 다시 복사되지는 않습니다.
+    """
+    batch_size, _, height, width = images.shape
+    device = images.device
+    src_classes = _class_tensor(src_classes, device)
+    src_class = src_classes[torch.randint(0, len(src_classes), (batch_size,), device=device)]
+    partner = torch.randint(0, batch_size, (batch_size,), device=device)
+
+    src_region = masks == src_class.view(-1, 1, 1).to(masks.dtype)
+    dst_region = masks[partner] == dst_class
+    valid = src_region.flatten(1).any(1) & dst_region.flatten(1).any(1)
+    if not bool(valid.any()):
+        return images, masks
+
+    # src blob 의 기준점: y + x 가 가장 작은 pixel (같으면 y 가 작은 pixel)
+    ys = torch.arange(height, device=device).view(1, -1, 1)
+    xs = torch.arange(width, device=device).view(1, 1, -1)
+    score = ((ys + xs) * height + ys).expand(batch_size, height, width)
+    score = torch.where(src_region, score, torch.full_like(score, (height + width) * height))
+    anchor = score.flatten(1).argmin(1)
+    # dst 영역에서 임의의 pixel 하나
+    rand = torch.where(dst_region, torch.rand(dst_region.shape, device=device), torch.full(dst_region.shape, -1., device=device))
+    target = rand.flatten(1).argmax(1)
+    offset_y = target // width - anchor // width
+    offset_x = target % width - anchor % width
+
+    b, y, x = (src_region & valid.view(-1, 1, 1)).nonzero(as_tuple=True)
+    dst_b = partner[b]
+    dst_y = (y + offset_y[b]).clamp_(0, height - 1)
+    dst_x = (x + offset_x[b]).clamp_(0, width - 1)
+    # 같은 위치에 여러 pixel 이 떨어지면 (partner 가 겹치거나 clamp 된 경우) advanced index 대입은 결과가 정해지지 않으므로,
+    # numpy 대입(utils.copyblob)처럼 뒤의 src 만 남깁니다.
+    dst = (dst_b * height + dst_y) * width + dst_x
+    dst_sorted, order = torch.sort(dst, stable=True)
+    last = torch.ones_like(dst_sorted, dtype=torch.bool)
+    last[:-1] = dst_sorted[1:] != dst_sorted[:-1]
+    keep = order[last]
+    b, y, x, dst_b, dst_y, dst_x = b[keep], y[keep], x[keep], dst_b[keep], dst_y[keep], dst_x[keep]
+
+    out_images, out_masks = images.clone(), masks.clone()
+    out_images[dst_b, :, dst_y, dst_x] = images[b, :, y, x]
+    out_masks[dst_b, dst_y, dst_x] = masks[b, y, x]
+    return out_images, out_masks
+
+
+class BatchMix:
+    """device 위의 batch 에 CutMix, CopyBlob 을 적용합니다.
+
+    train loop 에서 batch 를 device 로 옮긴 뒤 `images, masks = batch_mix(images, masks)` 로 사용합니다.
+    """
+
+    def __init__(self, cutmix_p=0., copyblob=False, src_classes=(2, 4, 5, 6, 7, 8), dst_classes=(0, 3)):
+        self.cutmix_p = cutmix_p
+        self.copyblob = copyblob
+        self.src_classes = tuple(src_classes)
+        self.dst_classes = tuple(dst_classes)
+
+    def __call__(self, images, masks):
+        if self.cutmix_p > 0:
+            images, masks = cutmix_batch(images, masks, p=self.cutmix_p)
+        if self.copyblob:
+            for dst_class in self.dst_classes:
+                images, masks = copyblob_batch(images, masks, self.src_classes, dst_class)
+        return images, masks
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(cutmix_p={self.cutmix_p}, copyblob={self.copyblob}, '
+                f'src_classes={self.src_classes}, dst_classes={self.dst_classes})')
@@ -0,0 +1,246 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from importlib import import_module
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from scipy.ndimage import distance_transform_edt as edt
+import lib.lovasz_losses as LOVASZ
+from loss import HausdorffDTLoss
+from tta import TTA, benchmark_tta
+from utils import distance_field, load_model
+
+
+def build_models(args, num_classes, device):
+    """--model_dir 가 있으면 best.pth 를 읽고, 없으면 random weight 로 만듭니다. (속도 측정용)"""
+    model_names = args.model.split(',')
+    if args.model_dir:
+        model_dirs = ['../model/' + model_dir for model_dir in args.model_dir.split(',')]
+        models = [load_model(model_dir, num_classes, device, args, model_name, 'inference')
+                  for model_name, model_dir in zip(model_names, model_dirs)]
+    else:
+        models = [getattr(import_module("model"), model_name)(num_classes=num_classes) for model_name in model_names]
+    return [model.to(device).eval() for model in models]
+
+
+def bench_tta(args):
+    device = torch.device(args.device)
+    models = build_models(args, 12, device)
+    images = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+    if args.channels_last:
+        models = [model.to(memory_format=torch.channels_last) for model in models]
+    ttas = [TTA.from_spec(spec, dtype=getattr(torch, args.buffer_dtype), max_pixels=args.max_pixels,
+                          precision=args.precision, channels_last=args.channels_last)
+            for spec in args.specs.split('|')]
+    print(f'models: {args.model} / batch: {args.batch_size} x {args.size} x {args.size} / device: {device} / '
+          f'precision: {args.precision}{" (channels last)" if args.channels_last else ""}')
+    for result in benchmark_tta(models, ttas, images, repeat=args.repeat):
+        print(f"{result['spec']:<60} {result['images/s']:8.2f} images/s")
+
+
+def _timeit(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return out, (time.time() - start) / repeat
+
+
+def random_masks(batch_size, size, num_classes, seed=0):
+    """원과 다각형을 겹쳐 그린 (batch, size, size) label. (distance transform 비교용)"""
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((batch_size, size, size), dtype=np.uint8)
+    for mask in masks:
+        for _ in range(rng.integers(1, 8)):
+            label = int(rng.integers(1, num_classes))
+            if rng.random() < 0.5:
+                center = tuple(int(v) for v in rng.integers(0, size, 2))
+                cv2.circle(mask, center, int(rng.integers(3, size // 4)), label, -1)
+            else:
+                cv2.fillPoly(mask, [rng.integers(0, size, (6, 2)).astype(np.int32)], label)
+    return torch.from_numpy(masks).long()
+
+
+def scipy_distance_field(img):
+    """이전 HausdorffDTLoss.distance_field (scipy, image 마다 host 에서 계산)"""
+    field = np.zeros_like(img)
+    for batch in range(len(img)):
+        fg_mask = img[batch] > 0.5
+        if fg_mask.any():
+            field[batch] = edt(fg_mask) + edt(~fg_mask)
+    return field
+
+
+def scipy_hausdorff_loss(pred, target, alpha=2.0, num_classes=12):
+    """이전 HausdorffDTLoss.forward: class 마다 host 로 옮겨 scipy EDT 를 합니다."""
+    pred_all = torch.softmax(pred, dim=1)
+    target_all = nn.functional.one_hot(target, num_classes).permute(0, 3, 1, 2).float()
+    loss_sum = 0
+    for c in range(num_classes):
+        pred_c, target_c = pred_all[:, c], target_all[:, c]
+        pred_dt = torch.from_numpy(scipy_distance_field(pred_c.detach().cpu().numpy())).float().to(pred.device)
+        target_dt = torch.from_numpy(scipy_distance_field(target_c.cpu().numpy())).float().to(pred.device)
+        distance = pred_dt ** alpha + target_dt ** alpha
+        loss_sum += ((pred_c - target_c) ** 2 * distance).mean()
+    return loss_sum / num_classes / pred_all.shape[0] / 3 + nn.CrossEntropyLoss()(pred, target)
+
+
+def bench_hausdorff(args):
+    device = torch.device(args.device)
+    num_classes = 12
+    target = random_masks(args.batch_size, args.size, num_classes).to(device)
+    # target 근처의 logit 이라 pred 의 distance field 도 비어 있지 않습니다.
+    noise = random_masks(args.batch_size, args.size, num_classes, seed=1).to(device)
+    pred = (nn.functional.one_hot(target, num_classes) * 2. + nn.functional.one_hot(noise, num_classes)).permute(0, 3, 1, 2)
+    pred = pred + torch.randn(pred.shape, device=device)
+    print(f'batch: {args.batch_size} x {num_classes} x {args.size} x {args.size} / device: {device}')
+
+    target_all = nn.functional.one_hot(target, num_classes).permute(0, 3, 1, 2).flatten(0, 1).float()
+    reference, scipy_time = _timeit(lambda: scipy_distance_field(target_all.cpu().numpy()), 1, device)
+    print(f'{"scipy edt (previous)":<24} {scipy_time * 1000:10.1f} ms')
+    for backend in ('torch', 'scipy'):
+        field, field_time = _timeit(lambda: distance_field(target_all, backend), args.repeat, device)
+        error = (field.cpu() - torch.from_numpy(reference)).abs()
+        print(f'{"distance_field " + backend:<24} {field_time * 1000:10.1f} ms (max abs error {error.max():.6f})')
+
+    old_loss, old_time = _timeit(lambda: scipy_hausdorff_loss(pred, target, num_classes=num_classes), 1, device)
+    print(f'{"scipy loss (previous)":<24} {old_time * 1000:10.1f} ms (loss {old_loss.item():.6f})')
+    target_onehot = nn.functional.one_hot(target, num_classes).permute(0, 3, 1, 2).float()
+    for backend in ('torch', 'scipy'):
+        criterion = HausdorffDTLoss(num_classes=num_classes, dt_backend=backend)
+        new_loss, new_time = _timeit(lambda: criterion(pred, target), args.repeat, device)
+        target_dt = criterion.distance_field(target_onehot)
+        cached_loss, cached_time = _timeit(lambda: criterion(pred, target, target_dt=target_dt), args.repeat, device)
+        print(f'{"loss " + backend:<24} {new_time * 1000:10.1f} ms (loss {new_loss.item():.6f})')
+        print(f'{"loss " + backend + " (cached)":<24} {cached_time * 1000:10.1f} ms (loss {cached_loss.item():.6f})')
+
+
+def bench_lovasz(args):
+    device = torch.device(args.device)
+    num_classes = 12
+    labels = random_masks(args.batch_size, args.size, num_classes).to(device)
+    logits = torch.randn(args.batch_size, num_classes, args.size, args.size, device=device)
+    print(f'batch: {args.batch_size} x {num_classes} x {args.size} x {args.size} / device: {device}')
+
+    # 같은 입력에서 loss 와 gradient 가 이전 구현(class, image 마다 sort)과 같은지 확인합니다.
+    ignored = labels.clone()
+    ignored[:, :args.size // 8] = 255
+    cases = [('present', False, None, labels), ('present', True, None, labels), ('all', False, None, labels),
+             ([1, 3, 5], True, None, labels), ('present', True, 255, ignored), ('present', False, 255, ignored)]
+    for classes, per_image, ignore, target in cases:
+        outs = []
+        for fn in (LOVASZ.lovasz_softmax_loop, LOVASZ.lovasz_softmax):
+            probas = torch.softmax(logits, dim=1).requires_grad_()
+            loss = fn(probas, target, classes=classes, per_image=per_image, ignore=ignore)
+            loss.backward()
+            outs.append((loss.detach(), probas.grad))
+        (ref, ref_grad), (out, out_grad) = outs
+        ok = torch.allclose(ref, out, rtol=1e-4, atol=1e-6) and torch.allclose(ref_grad, out_grad, rtol=1e-3, atol=1e-7)
+        print(f'classes={str(classes):<10} per_image={per_image!s:<5} ignore={ignore!s:<4} '
+              f'loss {ref.item():.6f} / {out.item():.6f} / max grad diff {(ref_grad - out_grad).abs().max():.2e} '
+              f'{"OK" if ok else "MISMATCH"}')
+
+    for per_image in (False, True):
+        for name, fn in (('loop', LOVASZ.lovasz_softmax_loop), ('batched', LOVASZ.lovasz_softmax)):
+            def step():
+                probas = torch.softmax(logits, dim=1).requires_grad_()
+                loss = fn(probas, labels, per_image=per_image)
+                loss.backward()
+                return loss
+            _, elapsed = _timeit(step, args.repeat, device)
+            print(f'{name + (" (per image)" if per_image else ""):<24} {elapsed * 1000:10.1f} ms (forward + backward)')
+
+
+# 이전 model.py 가 import 할 때 불러오던 backend (eager 비교용)
+_eager_imports = """
+import segmentation_models_pytorch
+import torchvision.models
+try:
+    import segmentation.TransUNet.networks.vit_seg_modeling
+except ImportError:
+    pass
+"""
+
+_first_batch = """
+import time
+start = time.time()
+{eager}
+import {script}
+import torch
+import model
+imported = time.time()
+net = model.build_model({model_name!r}, 12, pretrained=False).eval()
+with torch.no_grad():
+    net(torch.randn(1, 3, {size}, {size}))
+print(imported - start, time.time() - start)
+"""
+
+
+def bench_startup(args):
+    """train.py / inference.py 의 import + model 생성 + 첫 batch forward 까지의 시간을 새 process 에서 잽니다."""
+    print(f'model: {args.model} / input: 1 x 3 x {args.size} x {args.size} / repeat: {args.repeat} (median)')
+    for script in ('train', 'inference'):
+        for mode, eager in (('eager backends', _eager_imports), ('lazy registry', '')):
+            code = _first_batch.format(eager=eager, script=script, model_name=args.model, size=args.size)
+            times = []
+            for _ in range(args.repeat):
+                out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+                times.append(tuple(map(float, out.stdout.split()[-2:])))
+            import_time = statistics.median(t[0] for t in times)
+            first_batch = statistics.median(t[1] for t in times)
+            print(f'{script + ".py (" + mode + ")":<32} import {import_time:6.2f} s / first batch {first_batch:6.2f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # python benchmark.py tta --model DeepLapV3PlusEfficientnetB0NoisyStudent --specs 'scales=1|scales=0.5,1,2'
+    tta_parser = subparsers.add_parser('tta', help='throughput per TTA configuration')
+    tta_parser.add_argument('--model', type=str, default='DeepLapV3PlusEfficientnetB0NoisyStudent')
+    tta_parser.add_argument('--model_dir', type=str, default='', help='load best.pth from ../model/{model_dir} (default: random weights)')
+    tta_parser.add_argument('--specs', type=str, default='scales=1|scales=0.5,1,2;weights=0.3,0.4,0.3|scales=0.5,1,2;weights=0.3,0.4,0.3;flips=none,hflip',
+                            help="TTA specs separated by '|'")
+    tta_parser.add_argument('--batch_size', type=int, default=8)
+    tta_parser.add_argument('--size', type=int, default=512)
+    tta_parser.add_argument('--repeat', type=int, default=3)
+    tta_parser.add_argument('--buffer_dtype', type=str, default='float16')
+    tta_parser.add_argument('--max_pixels', type=int, default=None)
+    tta_parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    tta_parser.add_argument('--channels_last', '--channels-last', action='store_true')
+    tta_parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    tta_parser.set_defaults(func=bench_tta)
+
+    # python benchmark.py hausdorff --batch_size 8 --size 512
+    hausdorff_parser = subparsers.add_parser('hausdorff', help='HausdorffDTLoss: scipy / exact device EDT backends vs the previous loop')
+    hausdorff_parser.add_argument('--batch_size', type=int, default=8)
+    hausdorff_parser.add_argument('--size', type=int, default=512)
+    hausdorff_parser.add_argument('--repeat', type=int, default=3)
+    hausdorff_parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    hausdorff_parser.set_defaults(func=bench_hausdorff)
+
+    # python benchmark.py lovasz --batch_size 8 --size 512
+    lovasz_parser = subparsers.add_parser('lovasz', help='lovasz_softmax: batched sort vs per-class loop (equivalence + time)')
+    lovasz_parser.add_argument('--batch_size', type=int, default=8)
+    lovasz_parser.add_argument('--size', type=int, default=512)
+    lovasz_parser.add_argument('--repeat', type=int, default=3)
+    lovasz_parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    lovasz_parser.set_defaults(func=bench_lovasz)
+
+    # python benchmark.py startup --model DeepLapV3PlusEfficientnetB0NoisyStudent
+    startup_parser = subparsers.add_parser('startup', help='time to first batch of train.py / inference.py in a new process')
+    startup_parser.add_argument('--model', type=str, default='DeepLapV3PlusEfficientnetB0NoisyStudent')
+    startup_parser.add_argument('--size', type=int, default=512)
+    startup_parser.add_argument('--repeat', type=int, default=3)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,356 @@
+import hashlib
+import json
+import os
+import cv2
+import numpy as np
+import torch
+from pycocotools import mask as mask_utils
+from pycocotools.coco import COCO
+from utils import distance_field
+
+
+def annotation_key(annotation_path, *extra):
+    """annotation 파일 내용과 extra(category 목록 등)로부터 cache key를 만듭니다."""
+    sha1 = hashlib.sha1()
+    with open(annotation_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    for item in extra:
+        sha1.update(json.dumps(item, ensure_ascii=False).encode('utf-8'))
+    return sha1.hexdigest()[:16]
+
+
+def default_cache_dir(annotation_path):
+    return os.path.join(os.path.dirname(os.path.abspath(annotation_path)), 'cache')
+
+
+def category_pixel_values(coco, category_names):
+    """category_id -> mask pixel value (category_names 에서의 index)"""
+    return {cat['id']: category_names.index(cat['name']) for cat in coco.loadCats(coco.getCatIds())}
+
+
+def rasterize_mask(coco, image_infos, pixel_values):
+    # Unknown = 1, General trash = 2, ... , Cigarette = 11
+    masks = np.zeros((image_infos['height'], image_infos['width']), dtype=np.uint8)
+    for ann in coco.loadAnns(coco.getAnnIds(imgIds=image_infos['id'])):
+        np.maximum(masks, coco.annToMask(ann) * np.uint8(pixel_values[ann['category_id']]), out=masks)
+    return masks
+
+
+def _save_array_atomic(path, shape, dtype, fill_fn):
+    """fill_fn 으로 채운 .npy 를 임시 파일에 쓴 뒤 rename 합니다."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+    fill_fn(array)
+    array.flush()
+    del array
+    os.replace(tmp_path, path)
+
+
+def _save_json_atomic(path, obj):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class ClassStats:
+    """annotation 파일의 class 통계를 rasterize 하지 않고 (RLE area) 한 번에 구해 npz 로 저장합니다.
+
+    - areas: (N, num_classes) image 별 class pixel 수 (category_names 순서, background 는 나머지 pixel)
+    - presence: (N,) image 별 class 가 있으면 bit 가 켜진 bitset
+    - image_ids: row 순서 (정렬된 image id)
+    annotation 의 pixel 수는 annToMask(ann).sum() 과 같고, 겹치는 annotation 은 각각 셉니다. (get_classes_count 와 같음)
+    cache 는 MaskCache 와 같이 annotation 파일 hash 로 구분됩니다.
+    """
+
+    def __init__(self, annotation_path, category_names, cache_dir=None, coco=None):
+        self.annotation_path = annotation_path
+        self.category_names = list(category_names)
+        self.cache_dir = cache_dir or default_cache_dir(annotation_path)
+        self.key = annotation_key(annotation_path, self.category_names, 'stats')
+        self.path = os.path.join(self.cache_dir, f'stats_{self.key}.npz')
+
+        if not os.path.exists(self.path):
+            self.build(coco or COCO(annotation_path))
+        with np.load(self.path) as stats:
+            self.image_ids = stats['image_ids']
+            self.areas = stats['areas']
+            self.presence = stats['presence']
+            self.category_ids = stats['category_ids']
+
+    def build(self, coco):
+        print(f'building class stats {self.path}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        pixel_values = category_pixel_values(coco, self.category_names)
+        image_ids = sorted(coco.getImgIds())
+        rows = {image_id: row for row, image_id in enumerate(image_ids)}
+        areas = np.zeros((len(image_ids), len(self.category_names)), dtype=np.int64)
+        for ann in coco.loadAnns(coco.getAnnIds()):
+            area = int(mask_utils.area(coco.annToRLE(ann)))
+            areas[rows[ann['image_id']], pixel_values[ann['category_id']]] += area
+        image_pixels = np.array([info['height'] * info['width'] for info in coco.loadImgs(image_ids)], dtype=np.int64)
+        areas[:, 0] = image_pixels - areas[:, 1:].sum(axis=1)
+        presence = ((areas > 0) << np.arange(len(self.category_names))).sum(axis=1).astype(np.int64)
+        # category_names 의 index -> category_id (get_classes_count 의 category_id 순서를 위해, 없으면 -1)
+        category_ids = np.full(len(self.category_names), -1, dtype=np.int64)
+        for category_id, value in pixel_values.items():
+            category_ids[value] = category_id
+
+        tmp_path = f'{self.path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, image_ids=np.asarray(image_ids, dtype=np.int64), areas=areas, presence=presence,
+                 category_ids=category_ids)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def classes_count(self):
+        """class 별 전체 pixel 수 (category_names 순서)"""
+        return self.areas.sum(axis=0)
+
+    def has_class(self, class_index):
+        """(N,) class_index (category_names 의 index) 가 있는 image 인지"""
+        return (self.presence >> class_index) & 1 == 1
+
+    def __len__(self):
+        return len(self.image_ids)
+
+
+class MaskCache:
+    """annotation 파일의 semantic mask 를 한 번만 rasterize 해서 uint8 memmap 으로 저장/조회합니다.
+
+    cache 는 annotation 파일 내용과 category_names 의 hash 로 구분되므로
+    annotation 이 바뀌면 자동으로 새로 만들어집니다.
+    mask 는 file_name 으로 조회하며 memmap 의 slice(zero-copy)를 돌려줍니다.
+    """
+
+    def __init__(self, annotation_path, category_names, cache_dir=None, coco=None):
+        self.annotation_path = annotation_path
+        self.cache_dir = cache_dir or default_cache_dir(annotation_path)
+        self.key = annotation_key(annotation_path, list(category_names))
+        self.path = os.path.join(self.cache_dir, f'masks_{self.key}.npy')
+        self.index_path = os.path.join(self.cache_dir, f'masks_{self.key}.json')
+
+        if not (os.path.exists(self.path) and os.path.exists(self.index_path)):
+            self.build(coco or COCO(annotation_path), category_names)
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            self.file_names = json.load(f)
+        self.rows = {file_name: row for row, file_name in enumerate(self.file_names)}
+        self._masks = None
+
+    def build(self, coco, category_names):
+        print(f'building mask cache {self.path}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        pixel_values = category_pixel_values(coco, category_names)
+        image_infos = coco.loadImgs(sorted(coco.getImgIds()))
+        sizes = {(info['height'], info['width']) for info in image_infos}
+        if len(sizes) != 1:
+            raise ValueError(f'mask cache needs images of the same size, got {sorted(sizes)}')
+        height, width = sizes.pop()
+
+        def fill(masks):
+            for row, info in enumerate(image_infos):
+                masks[row] = rasterize_mask(coco, info, pixel_values)
+
+        _save_array_atomic(self.path, (len(image_infos), height, width), np.uint8, fill)
+        _save_json_atomic(self.index_path, [info['file_name'] for info in image_infos])
+
+    @property
+    def masks(self):
+        # worker process 마다 lazy 하게 open 합니다.
+        # copy-on-write mode 라서 쓰기가 cache 파일에 반영되지는 않지만 같은 process 안에서는 남습니다.
+        # 수정이 필요하면 copy 해서 사용하세요.
+        if self._masks is None:
+            self._masks = np.load(self.path, mmap_mode='c')
+        return self._masks
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_masks'] = None
+        return state
+
+    def __contains__(self, file_name):
+        return file_name in self.rows
+
+    def __getitem__(self, file_name):
+        return self.masks[self.rows[file_name]]
+
+    def __len__(self):
+        return len(self.file_names)
+
+
+class ImageStore:
+    """annotation 파일의 이미지들을 하나의 N x H x W x 3 uint8(RGB) memmap 으로 모아 둡니다.
+
+    decode(cv2.imread + BGR2RGB)는 build 할 때 한 번만 합니다.
+    이미지는 file_name 으로 조회하며 memmap 의 slice(zero-copy)를 돌려줍니다.
+    """
+
+    def __init__(self, annotation_path, image_root, cache_dir=None, coco=None):
+        self.annotation_path = annotation_path
+        self.image_root = image_root
+        self.cache_dir = cache_dir or default_cache_dir(annotation_path)
+        self.key = annotation_key(annotation_path, 'images')
+        self.path = os.path.join(self.cache_dir, f'images_{self.key}.npy')
+        self.index_path = os.path.join(self.cache_dir, f'images_{self.key}.json')
+
+        if not (os.path.exists(self.path) and os.path.exists(self.index_path)):
+            self.build(coco or COCO(annotation_path))
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            self.file_names = json.load(f)
+        self.rows = {file_name: row for row, file_name in enumerate(self.file_names)}
+        self._images = None
+
+    def build(self, coco):
+        print(f'building image store {self.path}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        image_infos = coco.loadImgs(sorted(coco.getImgIds()))
+        sizes = {(info['height'], info['width']) for info in image_infos}
+        if len(sizes) != 1:
+            raise ValueError(f'image store needs images of the same size, got {sorted(sizes)}')
+        height, width = sizes.pop()
+
+        def fill(images):
+            for row, info in enumerate(image_infos):
+                image = cv2.imread(os.path.join(self.image_root, info['file_name']))
+                images[row] = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+        _save_array_atomic(self.path, (len(image_infos), height, width, 3), np.uint8, fill)
+        _save_json_atomic(self.index_path, [info['file_name'] for info in image_infos])
+
+    @property
+    def images(self):
+        # MaskCache.masks 와 같이 copy-on-write mode 로 lazy 하게 open 합니다.
+        if self._images is None:
+            self._images = np.load(self.path, mmap_mode='c')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __contains__(self, file_name):
+        return file_name in self.rows
+
+    def __getitem__(self, file_name):
+        return self.images[self.rows[file_name]]
+
+    def __len__(self):
+        return len(self.file_names)
+
+
+class DistanceFieldCache:
+    """MaskCache 의 mask 마다 class 별 distance field (HausdorffDTLoss 의 target_dt) 를 float16 memmap 으로 저장합니다.
+
+    mask 가 바뀌지 않는 경우 (validation) 에만 유효합니다.
+    file_names 를 주면 그 image 만 저장합니다. mask cache 가 train_all.json 으로 만들어져도 (--cache_source)
+    val 의 image 만 저장하도록 train.py 는 val 의 file_name 을 넘깁니다. cache 는 file_names 의 hash 로 구분됩니다.
+    크기는 N x num_classes x H x W x 2 bytes 입니다. 512 x 512, 12 class 면 image 한 장에 6 MiB 이므로
+    val (655 장) 은 약 3.9 GiB 입니다.
+    build 는 utils.distance_field (backend) 로 chunk_size 장씩 합니다.
+    """
+
+    def __init__(self, mask_cache, file_names=None, num_classes=12, device=None, chunk_size=8, backend='torch'):
+        self.mask_cache = mask_cache
+        self.file_names = sorted(mask_cache.file_names if file_names is None else file_names)
+        missing = [file_name for file_name in self.file_names if file_name not in mask_cache]
+        if missing:
+            raise KeyError(f'{len(missing)} images are not in the mask cache, e.g. {missing[0]}')
+        self.num_classes = num_classes
+        self.backend = backend
+        subset_key = hashlib.sha1(json.dumps(self.file_names).encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(mask_cache.cache_dir, f'distance_{mask_cache.key}_{subset_key}_{num_classes}.npy')
+        if not os.path.exists(self.path):
+            self.build(device, chunk_size)
+        self.rows = {file_name: row for row, file_name in enumerate(self.file_names)}
+        self._fields = None
+
+    def build(self, device, chunk_size):
+        shape = (len(self.file_names), self.num_classes) + self.mask_cache.masks.shape[1:]
+        print(f'building distance field cache {self.path} ({np.prod(shape) * 2 / 2 ** 30:.1f} GiB)')
+        classes = torch.arange(self.num_classes, device=device).view(1, -1, 1, 1)
+
+        def fill(fields):
+            for start in range(0, len(self.file_names), chunk_size):
+                masks = [self.mask_cache[file_name] for file_name in self.file_names[start:start + chunk_size]]
+                chunk = torch.from_numpy(np.stack(masks)).to(device)
+                one_hot = chunk.long().unsqueeze(1) == classes
+                field = distance_field(one_hot.flatten(0, 1), self.backend).view(one_hot.shape)
+                fields[start:start + len(chunk)] = field.half().cpu().numpy()
+
+        _save_array_atomic(self.path, shape, np.float16, fill)
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = np.load(self.path, mmap_mode='r')
+        return self._fields
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fields'] = None
+        return state
+
+    def __getitem__(self, file_name):
+        return self.fields[self.rows[file_name]]
+
+    def lookup(self, file_names, device=None):
+        """file_names 의 distance field 를 (batch, num_classes, H, W) tensor 로 읽습니다."""
+        return torch.from_numpy(np.stack([self[file_name] for file_name in file_names])).to(device, non_blocking=True)
+
+
+class ProbCacheWriter:
+    """model 하나의 class 확률 map 을 (N, scales, C, size, size) memmap 으로 씁니다.
+
+    dtype 이 uint8 이면 확률에 255 를 곱해 양자화하고, float16 이면 그대로 저장합니다.
+    close 할 때 meta(json)와 함께 rename 하므로 중간에 멈추면 cache 가 남지 않습니다.
+    """
+
+    def __init__(self, path, file_names, scales, num_classes, size, dtype='uint8', meta=None):
+        if dtype not in ('uint8', 'float16'):
+            raise ValueError(f'Unknown prob cache dtype ({dtype})')
+        self.path = path
+        self.meta = dict(meta or {}, file_names=list(file_names), scales=list(scales),
+                         num_classes=num_classes, size=size, dtype=dtype)
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.probs = np.lib.format.open_memmap(self.tmp_path, mode='w+', dtype=dtype,
+                                               shape=(len(file_names), len(scales), num_classes, size, size))
+
+    def write(self, start, probs):
+        """probs: (batch, scales, C, size, size) 의 0~1 확률 (torch.Tensor)"""
+        if self.meta['dtype'] == 'uint8':
+            probs = probs.float().mul(255).round_().clamp_(0, 255).to(torch.uint8)
+        else:
+            probs = probs.to(torch.float16)
+        self.probs[start:start + len(probs)] = probs.cpu().numpy()
+
+    def close(self):
+        self.probs.flush()
+        del self.probs
+        os.replace(self.tmp_path, self.path)
+        _save_json_atomic(os.path.splitext(self.path)[0] + '.json', self.meta)
+
+
+class ProbCache:
+    """ProbCacheWriter 로 저장한 확률 map 을 memmap 으로 읽습니다."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.splitext(path)[0] + '.json', 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.file_names = self.meta['file_names']
+        self.scales = self.meta['scales']
+        self.probs = np.load(path, mmap_mode='r')
+
+    def to_tensor(self, device=None):
+        """(N, scales, C, size, size) 를 저장된 dtype 그대로 tensor 로 읽습니다."""
+        return torch.from_numpy(np.array(self.probs)).to(device)
+
+    def dequantize(self, probs):
+        if self.meta['dtype'] == 'uint8':
+            return probs.float().div_(255)
+        return probs.float()
+
+    def __len__(self):
+        return len(self.file_names)
@@ -0,0 +1,137 @@
+import copy
+import glob
+import os
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+_checkpoint_pattern = re.compile(r'checkpoint_(\d+)_(\d+)\.pth$')
+
+
+def capture_rng_state():
+    """torch, cuda, numpy, python 의 RNG 상태"""
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': np.random.get_state(),
+        'python': random.getstate(),
+    }
+
+
+def restore_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+
+
+def host_snapshot(obj):
+    """state 를 host 로 복사합니다. 이후 training step 이 바꾸는 tensor 와 memory 를 공유하지 않습니다.
+
+    cuda tensor 는 pinned memory 로 non_blocking 복사하므로 GPU 를 기다리지 않습니다.
+    복사는 현재 stream 순서대로 끝나므로 파일로 쓰기 전에 돌려주는 event 를 synchronize 해야 합니다.
+    """
+    has_cuda = False
+
+    def snapshot(value):
+        nonlocal has_cuda
+        if torch.is_tensor(value):
+            value = value.detach()
+            if value.is_cuda:
+                has_cuda = True
+                host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                return host.copy_(value, non_blocking=True)
+            return value.clone()
+        if isinstance(value, dict):
+            return type(value)((key, snapshot(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(snapshot(item) for item in value)
+        return copy.deepcopy(value)
+
+    state = snapshot(obj)
+    event = None
+    if has_cuda:
+        event = torch.cuda.Event()
+        event.record()
+    return state, event
+
+
+def _save_atomic(obj, path):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager:
+    """전체 학습 상태를 background thread 에서 저장하고 최근 keep_last 개만 남깁니다.
+
+    save 는 host snapshot 만 만들고 바로 돌아오며, 파일은 임시 파일에 쓴 뒤 rename 하므로
+    중간에 멈춰도 깨진 checkpoint 가 남지 않습니다. 저장은 순서대로 하나씩 합니다.
+    checkpoint 이름은 checkpoint_{epoch}_{step}.pth 이고, (epoch, step) 은 이어서 학습할 위치입니다.
+    """
+
+    def __init__(self, save_dir, keep_last=3):
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def path(self, epoch, step):
+        return os.path.join(self.save_dir, f'checkpoint_{epoch:04d}_{step:06d}.pth')
+
+    def checkpoints(self):
+        """(epoch, step) 순서로 정렬된 checkpoint 경로"""
+        found = []
+        for path in glob.glob(os.path.join(self.save_dir, 'checkpoint_*.pth')):
+            match = _checkpoint_pattern.search(os.path.basename(path))
+            if match:
+                found.append((int(match.group(1)), int(match.group(2)), path))
+        return [path for _, _, path in sorted(found)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def _submit(self, fn, *args):
+        self.futures = [future for future in self.futures if not future.done() or future.exception()]
+        self.futures.append(self.executor.submit(fn, *args))
+
+    def _write(self, state, event, path, prune):
+        if event is not None:
+            event.synchronize()
+        _save_atomic(state, path)
+        if prune and self.keep_last > 0:
+            for old_path in self.checkpoints()[:-self.keep_last]:
+                os.remove(old_path)
+
+    def save(self, state, epoch, step):
+        """state 전체 (model, optimizer, scheduler, scaler, rng 등) 를 checkpoint_{epoch}_{step}.pth 로 저장합니다."""
+        snapshot, event = host_snapshot(dict(state, epoch=epoch, step=step))
+        self._submit(self._write, snapshot, event, self.path(epoch, step), True)
+
+    def save_weights(self, state_dict, file_name):
+        """best.pth, latest.pth 처럼 model weight 만 저장합니다. (load_model 로 읽는 형식)"""
+        snapshot, event = host_snapshot(state_dict)
+        self._submit(self._write, snapshot, event, os.path.join(self.save_dir, file_name), False)
+
+    def load(self, path=None, map_location='cpu'):
+        """path (default: 가장 최근 checkpoint) 를 읽습니다. checkpoint 가 없으면 None"""
+        self.wait()
+        path = path or self.latest()
+        if path is None:
+            return None
+        print(f'resuming from {path}')
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def wait(self):
+        """진행 중인 저장이 모두 끝날 때까지 기다립니다. 저장 중 error 는 여기서 다시 raise 됩니다."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -1,11 +1,12 @@
 # 전처리를 위한 라이브러리
 from pycocotools.coco import COCO
-import torchvision.transforms as transforms
 import albumentations as A
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler
 import cv2
 import os
+from cache import MaskCache, ImageStore, category_pixel_values, rasterize_mask
 
 dataset_path = '../input/data'
 
@@ -17,6 +18,16 @@ def get_classname(classID, cats):
     return "None"
 
 
+def normalize_image(image, mean_std):
+    """(channel, height, width) tensor 에 torchvision transforms.Normalize 와 같은 normalize 를 합니다.
+
+    torchvision 을 import 하면 torchvision.models 까지 불러와 시작이 느려지므로 직접 계산합니다.
+    """
+    mean = torch.as_tensor(mean_std[0], dtype=image.dtype).view(-1, 1, 1)
+    std = torch.as_tensor(mean_std[1], dtype=image.dtype).view(-1, 1, 1)
+    return (image - mean) / std
+
+
 class BaseAugmentation:
     def __init__(self):
         self.transform = A.Compose([
@@ -35,7 +46,8 @@ class CustomDataset(Dataset):
     """COCO format"""
     num_classes = 12
 
-    def __init__(self, data_dir, category_names, mode='train', transform=None, cutmix=False):
+    def __init__(self, data_dir, category_names, mode='train', transform=None, cutmix=False, mask_cache=True,
+                 cache_source=None, image_store=False, uint8=False):
         super().__init__()
         self.mode = mode
         self.transform = transform
@@ -44,6 +56,37 @@ class CustomDataset(Dataset):
         self.mean_std = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         self.image_num = len(self.coco.getImgIds())
         self.cutmix = cutmix
+        self.pixel_values = category_pixel_values(self.coco, category_names)
+
+        # uint8: normalize 하지 않은 uint8 이미지를 돌려줍니다. (utils.normalize_batch 로 batch 단위 normalize)
+        self.uint8 = uint8
+
+        # cache_source: mask cache / image store 를 만들 annotation 파일 (default: data_dir). e.g. train_all.json
+        own_source = cache_source is None or os.path.abspath(cache_source) == os.path.abspath(data_dir)
+        source, source_coco = (data_dir, self.coco) if own_source else (cache_source, None)
+        self.mask_cache = None
+        if mask_cache and mode in ('train', 'val'):
+            self.mask_cache = MaskCache(source, category_names, coco=source_coco)
+        self.image_store = None
+        if image_store:
+            self.image_store = ImageStore(source, dataset_path, coco=source_coco)
+
+    def load_image(self, image_infos):
+        if self.image_store is not None and image_infos['file_name'] in self.image_store:
+            images = self.image_store[image_infos['file_name']]
+        else:
+            images = cv2.imread(os.path.join(dataset_path, image_infos['file_name']))
+            images = cv2.cvtColor(images, cv2.COLOR_BGR2RGB)
+        if self.uint8:
+            return images
+        images = images.astype(np.float32)
+        images /= 255.0
+        return images
+
+    def load_mask(self, image_infos):
+        if self.mask_cache is not None and image_infos['file_name'] in self.mask_cache:
+            return self.mask_cache[image_infos['file_name']]
+        return rasterize_mask(self.coco, image_infos, self.pixel_values)
 
     def __getitem__(self, index: int):
         index2 = np.random.randint(0, self.image_num)
@@ -51,23 +94,10 @@ class CustomDataset(Dataset):
         image_id = self.coco.getImgIds(imgIds=index)
         image_infos = self.coco.loadImgs(image_id)[0]
 
-        images = cv2.imread(os.path.join(dataset_path, image_infos['file_name']))
-        images = cv2.cvtColor(images, cv2.COLOR_BGR2RGB).astype(np.float32)
-        images /= 255.0
+        images = self.load_image(image_infos)
 
         if self.mode == 'train' or self.mode == 'val':
-            ann_ids = self.coco.getAnnIds(imgIds=image_infos['id'])
-            anns = self.coco.loadAnns(ann_ids)
-            cat_ids = self.coco.getCatIds()
-            cats = self.coco.loadCats(cat_ids)
-            masks = np.zeros((image_infos["height"], image_infos["width"]))
-
-            # Unknown = 1, General trash = 2, ... , Cigarette = 11
-            for i in range(len(anns)):
-                className = get_classname(anns[i]['category_id'], cats)
-                pixel_value = self.category_names.index(className)
-                masks = np.maximum(self.coco.annToMask(anns[i]) * pixel_value, masks)
-            masks = masks.astype(np.float32)
+            masks = self.load_mask(image_infos)
 
             # Both images should be same size 512 for cutmix
             if self.cutmix and self.mode == 'train':
@@ -75,17 +105,11 @@ class CustomDataset(Dataset):
                 if cutmix_p > 0.7:
                     image_id2 = self.coco.getImgIds(imgIds=index2)
                     image_infos2 = self.coco.loadImgs(image_id2)[0]
-                    images2 = cv2.imread(os.path.join(dataset_path, image_infos2['file_name']))
-                    images2 = cv2.cvtColor(images2, cv2.COLOR_BGR2RGB).astype(np.float32)
-                    images2 /= 255.0
-                    ann_ids2 = self.coco.getAnnIds(imgIds=image_infos2['id'])
-                    anns2 = self.coco.loadAnns(ann_ids2)
-                    masks2 = np.zeros((image_infos2["height"], image_infos2["width"]))
-                    for i in range(len(anns2)):
-                        className = get_classname(anns2[i]['category_id'], cats)
-                        pixel_value = self.category_names.index(className)
-                        masks2 = np.maximum(self.coco.annToMask(anns2[i]) * pixel_value, masks2)
-                    masks2 = masks2.astype(np.float32)
+                    # cache 의 image, mask 를 직접 수정하지 않도록 copy 합니다.
+                    images2 = self.load_image(image_infos2).copy()
+                    images = images.copy()
+                    masks = masks.copy()
+                    masks2 = self.load_mask(image_infos2).copy()
 
                     h_cut_size = np.random.randint(70, 300)
                     w_cut_size = np.random.randint(70, 300)
@@ -106,7 +130,8 @@ class CustomDataset(Dataset):
             if self.transform is not None:
                 transformed = self.transform(image=images, mask=masks)
                 images = transformed["image"]
-                images = transforms.Normalize(*self.mean_std)(images)
+                if not self.uint8:
+                    images = normalize_image(images, self.mean_std)
                 masks = transformed["mask"]
             return images, masks, image_infos
 
@@ -114,8 +139,71 @@ class CustomDataset(Dataset):
             if self.transform is not None:
                 transformed = self.transform(image=images)
                 images = transformed["image"]
-                images = transforms.Normalize(*self.mean_std)(images)
+                if not self.uint8:
+                    images = normalize_image(images, self.mean_std)
             return images, image_infos
 
     def __len__(self) -> int:
         return len(self.coco.getImgIds())
+
+
+class ClassAwareSampler(Sampler):
+    """드문 class (Battery, Clothing 등) 가 있는 image 를 더 자주 뽑는 sampler. (복원 추출)
+
+    cache.ClassStats 의 presence bitset 만 사용하므로 mask 를 읽지 않습니다.
+    class weight = (class 가 있는 image 비율) ** -power 이고 image weight 는 image 에 있는 class weight 중 최댓값입니다.
+    power=0 이면 uniform 입니다. epoch 마다 set_epoch 을 부르면 seed + epoch 으로 다시 뽑습니다.
+    CustomDataset 은 image id 를 index 로 사용하므로 image id 를 돌려줍니다.
+    """
+
+    def __init__(self, class_stats, num_samples=None, power=0.5, seed=0):
+        presence = np.stack([class_stats.has_class(c) for c in range(len(class_stats.category_names))], axis=1)
+        frequency = presence.mean(axis=0)
+        class_weights = np.where(frequency > 0, np.maximum(frequency, 1e-12) ** -power, 0.)
+        self.class_weights = class_weights
+        self.weights = torch.as_tensor((presence * class_weights).max(axis=1), dtype=torch.double)
+        self.image_ids = torch.as_tensor(class_stats.image_ids)
+        self.num_samples = num_samples or len(self.image_ids)
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """start: 이 epoch 에서 이미 학습한 sample 수 (checkpoint 에서 이어서 학습할 때)"""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        picks = torch.multinomial(self.weights, self.num_samples, replacement=True, generator=generator)
+        return iter(self.image_ids[picks[self.start:]].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class EpochShuffleSampler(Sampler):
+    """seed + epoch 으로 섞는 sampler. (shuffle=True 대신 사용)
+
+    epoch 의 순서가 seed 와 epoch 만으로 정해지므로 checkpoint 의 (epoch, step) 에서 같은 순서로 이어서 학습할 수 있습니다.
+    """
+
+    def __init__(self, num_samples, seed=0):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """start: 이 epoch 에서 이미 학습한 sample 수 (checkpoint 에서 이어서 학습할 때)"""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(self.num_samples, generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
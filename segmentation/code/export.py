@@ -0,0 +1,161 @@
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import torch
+import albumentations as A
+from albumentations.pytorch import ToTensorV2
+from dataset import CustomDataset
+from utils import ConfusionMatrix, collate_fn, load_model
+
+category_names = ['Backgroud', 'UNKNOWN', 'General trash', 'Paper', 'Paper pack', 'Metal', 'Glass', 'Plastic',
+                  'Styrofoam', 'Plastic bag', 'Battery', 'Clothing']
+
+
+def load_val_images(data_dir, val_json, num_images, cache_source=None):
+    """val 의 앞쪽 num_images 장 (images, masks) 을 float 로 읽습니다. (고정된 순서)"""
+    dataset = CustomDataset(data_dir=os.path.join(data_dir, val_json), category_names=category_names, mode='val',
+                            transform=A.Compose([ToTensorV2()]),
+                            cache_source=os.path.join(data_dir, cache_source) if cache_source else None)
+    num_images = min(num_images, len(dataset))
+    images, masks, _ = collate_fn([dataset[index] for index in range(num_images)])
+    return images, masks.long()
+
+
+def quantize_static(model, calib_images, batch_size):
+    """FX graph mode post-training static int8 quantization. calib_images 로 activation 범위를 잡습니다."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    model = copy.deepcopy(model)
+    qconfig_mapping = get_default_qconfig_mapping('x86')
+    # smp 의 입력 크기 검사는 FX trace 에서 control flow 가 되므로 끕니다. (입력은 val 과 같은 크기)
+    for module in model.modules():
+        if hasattr(module, 'requires_divisible_input_shape'):
+            module.requires_divisible_input_shape = False
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(calib_images[:1],))
+    with torch.no_grad():
+        for start in range(0, len(calib_images), batch_size):
+            prepared(calib_images[start:start + batch_size])
+    return convert_fx(prepared)
+
+
+def quantize_dynamic(model):
+    """weight 만 int8 로 바꾸는 dynamic quantization. (Linear 에만 적용되므로 conv 위주 model 에는 효과가 작습니다)"""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_torchscript(model, example, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, check_trace=False)
+        traced = torch.jit.freeze(traced.eval())
+    traced.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(model, example, path, opset=17):
+    import onnxruntime
+    torch.onnx.export(model, example, path, input_names=['images'], output_names=['logits'], opset_version=opset,
+                      dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}})
+    return _OnnxRunner(onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider']))
+
+
+def quantize_onnx_dynamic(path, quantized_path):
+    import onnxruntime
+    from onnxruntime.quantization import QuantType, quantize_dynamic as ort_quantize_dynamic
+    ort_quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    return _OnnxRunner(onnxruntime.InferenceSession(quantized_path, providers=['CPUExecutionProvider']))
+
+
+class _OnnxRunner:
+    """onnxruntime session 을 model 처럼 (tensor -> tensor) 부릅니다."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, images):
+        return torch.from_numpy(self.session.run(None, {'images': images.numpy()})[0])
+
+
+@torch.no_grad()
+def benchmark_variant(model, images, masks, batch_size, warmup=1):
+    """images/s, batch 별 latency 의 p50 / p99 (ms) 와 mIoU"""
+    for start in range(0, min(len(images), batch_size * warmup), batch_size):
+        model(images[start:start + batch_size])
+    metric = ConfusionMatrix(len(category_names), torch.device('cpu'))
+    latencies = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        tic = time.perf_counter()
+        logits = model(batch)
+        latencies.append(time.perf_counter() - tic)
+        metric.update(masks[start:start + batch_size], logits.argmax(dim=1))
+    latencies = np.asarray(latencies) * 1000
+    return {'images/s': len(images) / (latencies.sum() / 1000), 'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)), 'mIoU': metric.compute()['mIoU']}
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+    model = load_model('../model/' + args.model_dir, len(category_names), device, args, args.model, 'inference')
+    model = model.eval()
+
+    images, masks = load_val_images(args.data_dir, args.val, args.num_images + args.calib_images, args.cache_source)
+    # 평가와 calibration 은 겹치지 않는 val image 를 사용합니다.
+    images, masks, calib_images = images[:args.num_images], masks[:args.num_images], images[args.num_images:]
+    example = images[:args.batch_size]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stem = os.path.join(args.output_dir, args.model_dir.replace('/', '_'))
+    variants = {'eager fp32': model}
+    if args.format == 'torchscript':
+        variants['torchscript fp32'] = export_torchscript(model, example, f'{stem}.pt')
+        if args.quantize == 'static':
+            if len(calib_images) == 0:
+                raise ValueError('static quantization needs --calib_images > 0')
+            variants['torchscript int8 (static)'] = export_torchscript(quantize_static(model, calib_images, args.batch_size),
+                                                                       example, f'{stem}_int8.pt')
+        elif args.quantize == 'dynamic':
+            variants['torchscript int8 (dynamic)'] = export_torchscript(quantize_dynamic(model), example, f'{stem}_int8.pt')
+    else:
+        variants['onnx fp32'] = export_onnx(model, example, f'{stem}.onnx', args.opset)
+        if args.quantize == 'dynamic':
+            variants['onnx int8 (dynamic)'] = quantize_onnx_dynamic(f'{stem}.onnx', f'{stem}_int8.onnx')
+        elif args.quantize == 'static':
+            raise ValueError('static int8 is only supported with --format torchscript')
+    print(f'exported to {args.output_dir}')
+
+    if not args.benchmark:
+        return
+    print(f'{args.model} / {len(images)} val images / batch {args.batch_size} / {args.threads} threads')
+    base = None
+    for name, variant in variants.items():
+        result = benchmark_variant(variant, images, masks, args.batch_size)
+        base = result['mIoU'] if base is None else base
+        print(f"{name:<28} {result['images/s']:8.2f} images/s / p50 {result['p50_ms']:8.1f} ms / "
+              f"p99 {result['p99_ms']:8.1f} ms / mIoU {result['mIoU']:.4f} ({result['mIoU'] - base:+.4f})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # python export.py --model DeepLapV3PlusEfficientnetB0NoisyStudent --model_dir kfold0DeepLapV3PlusEfficientnetB0NoisyStudent --quantize static
+    parser.add_argument('--model', type=str, default='DeepLapV3PlusEfficientnetB0NoisyStudent')
+    parser.add_argument('--model_dir', type=str, default='DeepLapV3PlusEfficientnetB0NoisyStudent', help='folder under ../model with best.pth')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'dynamic', 'static'],
+                        help='int8 post-training quantization (static: calibrated on --calib_images val images)')
+    parser.add_argument('--opset', type=int, default=17, help='onnx opset (default: 17)')
+    parser.add_argument('--output_dir', type=str, default='../export')
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_EVAL', '../input/data'))
+    parser.add_argument('--val', type=str, default='val.json')
+    parser.add_argument('--cache_source', type=str, default=None, help='annotation file the mask cache was built from (e.g. train_all.json)')
+    parser.add_argument('--num_images', type=int, default=64, help='val images for the benchmark (default: 64)')
+    parser.add_argument('--calib_images', type=int, default=32, help='other val images for static calibration (default: 32)')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--benchmark', type=bool, default=True, help='compare eager fp32 / exported / quantized (default: True)')
+    args = parser.parse_args()
+
+    main(args)
@@ -1,26 +1,19 @@
 import argparse
 import os
 from importlib import import_module
-import pandas as pd
-import numpy as np
 import torch
 from dataset import CustomDataset
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
-from utils import load_model
-
-# collate_fn needs for batch
-def collate_fn(batch):
-    return tuple(zip(*batch))
+from utils import Prefetcher, collate_fn, load_model, normalize_batch, downsample_labels
+from submission import SubmissionWriter
+from tta import TTA
+from cache import ProbCacheWriter
 
 def get_model_dir(folder_path):
     return '../model/' + folder_path
 
-@torch.no_grad()
-def inference(data_dir, model_dir, output_dir, args):
-    use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
-
+def load_models(model_dir, args, device):
     num_classes = CustomDataset.num_classes  # 18
     model_names = args.model.split(',')
     model_dirs = list(map(get_model_dir, model_dir.split(',')))
@@ -29,8 +22,14 @@ def inference(data_dir, model_dir, output_dir, args):
         models.append(load_model(model_dir, num_classes, device, args, model_name, 'inference').to(device))
     for model in models:
         model.eval()
+    if args.channels_last:
+        models = [model.to(memory_format=torch.channels_last) for model in models]
+    return models
 
-    test_path = os.path.join(data_dir, 'test.json')
+
+def build_test_loader(data_dir, json_name, args):
+    use_cuda = torch.cuda.is_available()
+    test_path = os.path.join(data_dir, json_name)
 
     test_transform = A.Compose([
         ToTensorV2(),
@@ -42,87 +41,109 @@ def inference(data_dir, model_dir, output_dir, args):
     test_dataset = transform_module(data_dir=test_path,
                                     category_names=category_names,
                                     mode='test',
-                                    transform=test_transform)
+                                    transform=test_transform,
+                                    cache_source=os.path.join(data_dir, args.cache_source) if args.cache_source else None,
+                                    image_store=args.image_store,
+                                    uint8=args.uint8)
     test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
                                               batch_size=args.batch_size,
-                                              num_workers=1,
+                                              num_workers=args.num_workers,
                                               collate_fn=collate_fn,
                                               pin_memory=use_cuda,
                                               drop_last=False,
                                               )
+    return test_dataset, test_loader
+
+
+def build_tta(args):
+    weights = list(map(float, args.weights.split(','))) if args.weights else None
+    # --tta 0 이면 원래 크기 하나만 사용합니다.
+    return TTA.from_spec(args.tta_spec if args.tta else 'scales=1', model_weights=weights,
+                         dtype=getattr(torch, args.tta_dtype), max_pixels=args.tta_max_pixels,
+                         precision=args.precision, channels_last=args.channels_last)
+
+
+@torch.no_grad()
+def inference(data_dir, model_dir, output_dir, args):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+
+    models = load_models(model_dir, args, device)
+    test_dataset, test_loader = build_test_loader(data_dir, 'test.json', args)
 
     size = 256
-    transform = A.Compose([A.Resize(256, 256)])
-    file_name_list = []
-    preds_array = np.empty((0, size * size), dtype=np.long)
-    softmax = torch.nn.Softmax(dim=1)
     print("Calculating inference results..")
-    weights = list(map(float, args.weights.split(',')))
+    tta = build_tta(args)
+    print(tta)
     with torch.no_grad():
-        for step, (imgs, image_infos) in enumerate(test_loader):
+        for step, (images, image_infos) in enumerate(Prefetcher(test_loader, device)):
             print(f"step : {step} / {len(test_loader)}")
 
-            images = torch.stack(imgs)  # (batch, channel, height, width)
-            images = images.to(device)
-            images2 = torch.nn.UpsamplingBilinear2d(size=(256, 256))(images)
-            images3 = images
-            images5 = torch.nn.UpsamplingBilinear2d(size=(1024, 1024))(images)
-            outputs2 = models[0](images2)
-            outputs2 = torch.nn.UpsamplingBilinear2d(size=(512, 512))(outputs2)
-            outputs3 = models[0](images3)
-            outputs5 = models[0](images5)
-            outputs5 = torch.nn.UpsamplingBilinear2d(size=(512, 512))(outputs5)
-            outputs = (outputs2 * 0.3) + (outputs3 * 0.4) + (outputs5 * 0.3)
-            outs = softmax(outputs) * weights[0]
-            for i in range(1, len(models)):
-                outputs2 = models[i](images2)
-                outputs2 = torch.nn.UpsamplingBilinear2d(size=(512, 512))(outputs2)
-                outputs3 = models[i](images3)
-                outputs5 = models[i](images5)
-                outputs5 = torch.nn.UpsamplingBilinear2d(size=(512, 512))(outputs5)
-                outputs = (outputs2 * 0.3) + (outputs3 * 0.4) + (outputs5 * 0.3)
-                outs += softmax(outputs) * weights[i]
-            oms = torch.argmax(outs.squeeze(), dim=1).detach().cpu().numpy()
-
-            # resize (256 x 256)
-            temp_mask = []
-            for img, mask in zip(np.stack(imgs), oms):
-                transformed = transform(image=img, mask=mask)
-                mask = transformed['mask']
-                temp_mask.append(mask)
-
-            oms = np.array(temp_mask)
-            oms = oms.reshape([oms.shape[0], size * size]).astype(int)
-            preds_array = np.vstack((preds_array, oms))
-
-            file_name_list.append([i['file_name'] for i in image_infos])
+            # images: (batch, channel, height, width), 이미 device 위에 있습니다.
+            if args.uint8:
+                images = normalize_batch(images, test_dataset.mean_std)
+            outs = tta(models, images)
+
+            # resize (256 x 256): host 로 옮기기 전에 device 위에서 batch 단위로 줄입니다.
+            if args.downsample == 'prob':
+                outs = torch.nn.functional.interpolate(outs.float(), size=(size, size), mode='area')
+                oms = torch.argmax(outs, dim=1)
+            else:
+                oms = downsample_labels(torch.argmax(outs, dim=1), size, args.downsample, CustomDataset.num_classes)
+            oms = oms.to(torch.uint8).reshape(oms.shape[0], size * size).cpu().numpy()
+
+            # batch 단위로 돌려주므로 전체 prediction 을 memory 에 모아두지 않습니다.
+            yield [i['file_name'] for i in image_infos], oms
     print("End prediction.")
-    file_names = [y for x in file_name_list for y in x]
 
-    return file_names, preds_array
 
+@torch.no_grad()
+def save_probs(data_dir, model_dir, args):
+    """model 마다 TTA scale 별 class 확률 map 을 downsample 해서 cache 에 저장합니다.
 
-def make_submission(data_dir, model_dir, output_dir, args):
-    # sample_submisson.csv 열기
-    submission = pd.read_csv('/opt/ml/code/submission/sample_submission.csv', index_col=None)
+    저장한 cache 는 search_weights.py 로 ensemble / scale weight 를 찾을 때 사용합니다.
+    """
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
 
-    # test set에 대한 prediction
-    file_names, preds = inference(data_dir, model_dir, output_dir, args)
+    models = load_models(model_dir, args, device)
+    test_dataset, test_loader = build_test_loader(data_dir, args.probs_json, args)
+    file_names = [info['file_name'] for info in test_dataset.coco.loadImgs(list(range(len(test_dataset))))]
+    tta = build_tta(args)
+    size = args.probs_size
+    json_stem = os.path.splitext(os.path.basename(args.probs_json))[0]
+
+    for model, model_folder in zip(models, model_dir.split(',')):
+        path = os.path.join(args.save_probs, f'{model_folder}_{json_stem}.npy')
+        writer = ProbCacheWriter(path, file_names, tta.scales, CustomDataset.num_classes, size, args.probs_dtype,
+                                 meta={'model_dir': model_folder, 'json': args.probs_json, 'flips': list(tta.flips)})
+        print(f"saving probabilities to {path}")
+        start = 0
+        for step, (images, image_infos) in enumerate(Prefetcher(test_loader, device)):
+            if args.uint8:
+                images = normalize_batch(images, test_dataset.mean_std)
+            probs = []
+            for scale in tta.scales:
+                scale_probs = sum(tta.forward_view(model, images, scale, flip) for flip in tta.flips) / len(tta.flips)
+                probs.append(torch.nn.functional.interpolate(scale_probs, size=(size, size), mode='area'))
+            writer.write(start, torch.stack(probs, dim=1))
+            start += len(images)
+        writer.close()
 
-    # PredictionString 대입
-    for file_name, string in zip(file_names, preds):
-        submission = submission.append(
-            {"image_id": file_name, "PredictionString": ' '.join(str(e) for e in string.tolist())},
-            ignore_index=True)
 
-    # submission.csv로 저장
+def make_submission(data_dir, model_dir, output_dir, args):
+    # submission.csv 경로
     save_file_path = os.path.join(output_dir, f'{args.name}.csv')
     while os.path.isfile(save_file_path):
         if save_file_path[-5].isnumeric():
             save_file_path = save_file_path[:-5] + str(int(save_file_path[-5]) + 1) + ".csv"
         else:
             save_file_path = save_file_path[:-4] + str(0) + ".csv"
-    submission.to_csv(save_file_path, index=False)
+
+    # sample_submisson.csv 의 header 를 쓰고 test set에 대한 prediction 을 batch 마다 이어서 씁니다.
+    with SubmissionWriter(save_file_path, '/opt/ml/code/submission/sample_submission.csv') as writer:
+        for file_names, preds in inference(data_dir, model_dir, output_dir, args):
+            writer.write(file_names, preds)
 
     print("save submission done!")
     print(f'file path: {save_file_path}')
@@ -131,6 +152,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--batch_size', type=int, default=32, help='input batch size for validing (default: 32)')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of DataLoader workers (default: 1)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'], help='autocast precision (default: fp32)')
+    parser.add_argument('--channels_last', '--channels-last', type=bool, default=False, help='channels last memory format')
     parser.add_argument('--model', type=str, default='DeepLapV3PlusEfficientnetB5NoisyStudent', help='model type (default: DeepLapV3PlusEfficientnetB5NoisyStudent)')
     parser.add_argument('--dataset', type=str, default='CustomDataset', help='dataset augmentation type (default: CustomDataset)')
     parser.add_argument('--name', type=str, default='submission', help='submission file name (default: submission)')
@@ -138,8 +162,22 @@ if __name__ == '__main__':
     parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_EVAL', '../input/data'))
     parser.add_argument('--model_dir', type=str, default=os.environ.get('SM_CHANNEL_MODEL', '../model/DeepLapV3PlusEfficientnetB5NoisyStudent'))
     parser.add_argument('--output_dir', type=str, default=os.environ.get('SM_OUTPUT_DATA_DIR', '../submission'))
-    parser.add_argument('--tta', type=int, default=0)
-    parser.add_argument('--weights', type=str, default='')
+    parser.add_argument('--tta', type=int, default=1, help='use --tta_spec (default: 1), 0: single scale')
+    parser.add_argument('--tta_spec', type=str, default='scales=0.5,1,2;weights=0.3,0.4,0.3',
+                        help="TTA spec 'scales=...;weights=...;flips=none,hflip,vflip' (default: scales=0.5,1,2;weights=0.3,0.4,0.3)")
+    parser.add_argument('--tta_dtype', type=str, default='float16', help='dtype of the probability buffer (default: float16)')
+    parser.add_argument('--tta_max_pixels', type=int, default=None, help='max pixels per forward pass (default: whole batch)')
+    parser.add_argument('--weights', type=str, default='', help='model weights (default: equal)')
+    parser.add_argument('--downsample', type=str, default='nearest', help='512 -> 256: nearest, majority or prob (area on probabilities) (default: nearest)')
+    parser.add_argument('--image_store', type=bool, default=False, help='read images from the packed uint8 image store')
+    parser.add_argument('--uint8', type=bool, default=False, help='keep images as uint8 until the batch is on the device')
+    parser.add_argument('--cache_source', type=str, default=None, help='annotation file the image store was built from (e.g. train_all.json for val folds)')
+
+    # Probability cache (for search_weights.py)
+    parser.add_argument('--save_probs', type=str, default='', help='save per-model probability maps to this directory instead of making a submission')
+    parser.add_argument('--probs_json', type=str, default='test.json', help='annotation file to cache (e.g. val0.json, test.json)')
+    parser.add_argument('--probs_size', type=int, default=128, help='size of the cached probability maps (default: 128)')
+    parser.add_argument('--probs_dtype', type=str, default='uint8', help='uint8 (quantized) or float16 (default: uint8)')
     args = parser.parse_args()
 
     data_dir = args.data_dir
@@ -148,4 +186,7 @@ if __name__ == '__main__':
 
     os.makedirs(output_dir, exist_ok=True)
 
-    make_submission(data_dir, model_dir, output_dir, args)
+    if args.save_probs:
+        save_probs(data_dir, model_dir, args)
+    else:
+        make_submission(data_dir, model_dir, output_dir, args)
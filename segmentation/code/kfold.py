@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+import numpy as np
+import torch
+from pycocotools.coco import COCO
+from cache import ClassStats, ImageStore, MaskCache, ProbCache
+from search_weights import load_targets
+from utils import ConfusionMatrix
+
+category_names = ['Backgroud', 'UNKNOWN', 'General trash', 'Paper', 'Paper pack', 'Metal', 'Glass', 'Plastic',
+                  'Styrofoam', 'Plastic bag', 'Battery', 'Clothing']
+
+
+def stratify_labels(stats):
+    """image 마다 들어 있는 class 중 가장 드문 class (image 빈도 기준). object 가 없으면 0 (background)"""
+    presence = np.stack([stats.has_class(c) for c in range(len(stats.category_names))], axis=1)
+    presence[:, 0] = False
+    frequency = presence.sum(axis=0)
+    rarity = np.where(presence, frequency, np.iinfo(np.int64).max)
+    return np.where(presence.any(axis=1), rarity.argmin(axis=1), 0)
+
+
+def assign_folds(labels, k, seed=42):
+    """같은 label 의 image 들을 섞은 뒤 fold 에 번갈아 넣습니다. 드문 label 부터 넣어 fold 마다 고르게 나눕니다."""
+    rng = np.random.default_rng(seed)
+    folds = np.empty(len(labels), dtype=np.int64)
+    counts = np.bincount(labels)
+    position = 0
+    for label in sorted(np.unique(labels), key=lambda label: counts[label]):
+        members = rng.permutation(np.flatnonzero(labels == label))
+        folds[members] = (position + np.arange(len(members))) % k
+        position += len(members)
+    return folds
+
+
+def write_subset(coco, image_ids, path):
+    """image_ids 만 남긴 annotation 파일. CustomDataset 은 index 를 image id 로 쓰므로 id 를 0 부터 다시 매깁니다."""
+    new_ids = {image_id: new_id for new_id, image_id in enumerate(sorted(image_ids))}
+    images = [dict(info, id=new_ids[info['id']]) for info in coco.loadImgs(sorted(image_ids))]
+    annotations = [dict(ann, image_id=new_ids[ann['image_id']]) for ann in coco.loadAnns(coco.getAnnIds(imgIds=sorted(image_ids)))]
+    dataset = {key: value for key, value in coco.dataset.items() if key not in ('images', 'annotations')}
+    dataset.update(images=images, annotations=annotations)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dataset, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def make_folds(data_dir, source, k, seed, fold_dir):
+    """source (train_all.json) 를 stratified k fold 로 나눠 {fold_dir}/train{i}.json, val{i}.json 을 씁니다.
+
+    이미 만든 split 이 있으면 그대로 사용합니다. (split 정보는 folds.json)
+    """
+    out_dir = os.path.join(data_dir, fold_dir)
+    index_path = os.path.join(out_dir, 'folds.json')
+    if os.path.exists(index_path):
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    source_path = os.path.join(data_dir, source)
+    coco = COCO(source_path)
+    stats = ClassStats(source_path, category_names, coco=coco)
+    labels = stratify_labels(stats)
+    folds = assign_folds(labels, k, seed)
+    for fold in range(k):
+        write_subset(coco, stats.image_ids[folds != fold].tolist(), os.path.join(out_dir, f'train{fold}.json'))
+        write_subset(coco, stats.image_ids[folds == fold].tolist(), os.path.join(out_dir, f'val{fold}.json'))
+        label_counts = np.bincount(labels[folds == fold], minlength=len(category_names))
+        print(f'fold {fold}: {np.sum(folds == fold)} val images, rarest class counts {label_counts.tolist()}')
+    file_names = [info['file_name'] for info in coco.loadImgs(stats.image_ids.tolist())]
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump({'source': source, 'k': k, 'seed': seed, 'file_names': file_names, 'folds': folds.tolist()}, f, ensure_ascii=False)
+
+
+def device_slots(devices, cpu_slots):
+    """fold process 마다 줄 환경 변수. GPU 하나에 process 하나, cpu 는 cpu_slots 개로 core 를 나눕니다."""
+    if devices == 'cpu':
+        threads = max(1, (os.cpu_count() or 1) // cpu_slots)
+        return [{'CUDA_VISIBLE_DEVICES': '', 'OMP_NUM_THREADS': str(threads)} for _ in range(cpu_slots)]
+    return [{'CUDA_VISIBLE_DEVICES': device} for device in devices.split(',')]
+
+
+def run_jobs(jobs, slots, log_dir, poll_interval=5.):
+    """jobs: {name: [command, ...]} 를 slot 마다 하나씩 실행합니다. 한 job 의 command 들은 같은 slot 에서 차례로 실행됩니다.
+
+    returns: {name: {'returncode', 'seconds', 'log'}}
+    """
+    pending = deque(jobs.items())
+    running = {}
+    results = {}
+    os.makedirs(log_dir, exist_ok=True)
+
+    def start(slot, name, commands, started):
+        log_path = os.path.join(log_dir, f'{name}.log')
+        log = open(log_path, 'a')
+        env = dict(os.environ, **slots[slot])
+        print(f'[slot {slot}] {name}: {" ".join(commands[0])}')
+        process = subprocess.Popen(commands[0], stdout=log, stderr=subprocess.STDOUT, env=env)
+        running[slot] = (name, commands[1:], process, log, started)
+
+    while pending or running:
+        for slot in range(len(slots)):
+            if slot not in running and pending:
+                name, commands = pending.popleft()
+                start(slot, name, commands, time.time())
+        time.sleep(poll_interval)
+        for slot, (name, commands, process, log, started) in list(running.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            log.close()
+            del running[slot]
+            if returncode == 0 and commands:
+                start(slot, name, commands, started)
+                continue
+            results[name] = {'returncode': returncode, 'seconds': time.time() - started, 'log': log.name}
+            print(f'[slot {slot}] {name}: {"done" if returncode == 0 else f"failed ({returncode})"} '
+                  f'in {(time.time() - started) / 60:.1f} min')
+    return results
+
+
+def evaluate_oof(data_dir, source, probs_paths, device):
+    """fold 별 val 확률 cache 로 fold 별 / 전체 out-of-fold 지표를 구합니다."""
+    source_path = os.path.join(data_dir, source)
+    total = ConfusionMatrix(len(category_names), device)
+    fold_results = {}
+    for fold, path in probs_paths.items():
+        cache = ProbCache(path)
+        targets = load_targets(source_path, category_names, cache.file_names, cache.meta['size'], device)
+        metric = ConfusionMatrix(len(category_names), device)
+        for start in range(0, len(cache), 64):
+            probs = cache.dequantize(torch.from_numpy(np.array(cache.probs[start:start + 64])).to(device))
+            preds = probs.mean(dim=1).argmax(dim=1)
+            metric.update(targets[start:start + 64], preds)
+            total.update(targets[start:start + 64], preds)
+        fold_results[fold] = metric.compute()
+    return fold_results, (total.compute() if fold_results else None)
+
+
+def main(args, train_args):
+    fold_dir = f'kfold{args.k}_seed{args.seed}'
+    make_folds(args.data_dir, args.source, args.k, args.seed, fold_dir)
+
+    # 모든 fold process 가 같이 읽는 read-only cache (mask, decode 한 image) 를 먼저 만듭니다.
+    source_path = os.path.join(args.data_dir, args.source)
+    MaskCache(source_path, category_names)
+    if args.image_store:
+        ImageStore(source_path, args.data_dir)
+    shared = ['--data_dir', args.data_dir, '--cache_source', args.source] + (['--image_store', 'True'] if args.image_store else [])
+
+    folds = list(map(int, args.folds.split(','))) if args.folds else list(range(args.k))
+    jobs, probs_paths, save_dirs = {}, {}, {}
+    for fold in folds:
+        name = f'kfold{fold}{args.model}'
+        save_dir = os.path.join(args.model_dir, name)
+        if os.path.exists(save_dir) and not args.resume:
+            raise FileExistsError(f'{save_dir} exists, use --resume to continue it')
+        save_dirs[fold] = save_dir
+        commands = [[sys.executable, 'train.py', '--model', args.model, '--name', name, '--model_dir', args.model_dir,
+                     '--train', f'{fold_dir}/train{fold}.json', '--val', f'{fold_dir}/val{fold}.json'] + shared + train_args
+                    + (['--load_model', 'True'] if args.resume and os.path.exists(save_dir) else [])]
+        if args.oof:
+            # out-of-fold 확률: inference.py 는 ../model 기준의 folder 이름을 받습니다.
+            model_folder = os.path.relpath(save_dir, '../model')
+            commands.append([sys.executable, 'inference.py', '--model', args.model, '--model_dir', model_folder,
+                             '--save_probs', args.probs_dir, '--probs_json', f'{fold_dir}/val{fold}.json',
+                             '--probs_size', str(args.probs_size), '--tta', '0'] + shared)
+            probs_paths[fold] = os.path.join(args.probs_dir, f'{model_folder}_val{fold}.npy')
+        jobs[name] = commands
+
+    start_time = time.time()
+    runs = run_jobs(jobs, device_slots(args.devices, args.cpu_slots), os.path.join(args.model_dir, f'kfold_logs_{args.model}'))
+    wall_time = time.time() - start_time
+
+    report = {'model': args.model, 'k': args.k, 'seed': args.seed, 'fold_dir': fold_dir, 'devices': args.devices,
+              'wall_time': wall_time, 'run_time': sum(run['seconds'] for run in runs.values()), 'folds': {}}
+    for fold in folds:
+        info_path = os.path.join(save_dirs[fold], 'train_info.json')
+        train_info = {}
+        if os.path.exists(info_path):
+            with open(info_path, 'r') as f:
+                train_info = json.load(f)
+        report['folds'][fold] = dict(runs[f'kfold{fold}{args.model}'], best_val_mIOU=train_info.get('best_val_mIOU'),
+                                     save_dir=save_dirs[fold])
+
+    finished = {fold: path for fold, path in probs_paths.items() if os.path.exists(path)}
+    fold_results, oof = evaluate_oof(args.data_dir, args.source, finished, torch.device(args.eval_device))
+    for fold, result in fold_results.items():
+        report['folds'][fold]['oof'] = result
+    report['oof'] = oof
+    report['oof_size'] = args.probs_size
+
+    report_path = os.path.join(args.model_dir, f'kfold_report_{args.model}.json')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    for fold in folds:
+        result = report['folds'][fold]
+        oof_mIoU = result.get('oof', {}).get('mIoU')
+        print(f"fold {fold}: best val mIoU {result['best_val_mIOU']} / oof mIoU {oof_mIoU} / {result['seconds'] / 60:.1f} min")
+    if oof is not None:
+        print(f"out-of-fold mIoU: {oof['mIoU']:.4f}")
+    print(f'wall time {wall_time / 60:.1f} min (sum of runs {report["run_time"] / 60:.1f} min), report: {report_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # python kfold.py --model DeepLapV3PlusEfficientnetB0NoisyStudent --devices 0,1 -- --epochs 20 --batch_size 8
+    # '--' 뒤의 인자는 그대로 train.py 에 넘깁니다.
+    parser.add_argument('--model', type=str, default='DeepLapV3PlusEfficientnetB0NoisyStudent')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42, help='split seed (default: 42)')
+    parser.add_argument('--folds', type=str, default='', help='folds to run, e.g. 0,2 (default: all)')
+    parser.add_argument('--source', type=str, default='train_all.json', help='annotation file to split (default: train_all.json)')
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '../input/data'))
+    parser.add_argument('--model_dir', type=str, default=os.environ.get('SM_MODEL_DIR', '../model'))
+    parser.add_argument('--devices', type=str, default=','.join(map(str, range(torch.cuda.device_count()))) or 'cpu',
+                        help="GPU ids to run folds on (one fold per GPU at a time), or 'cpu' (default: all GPUs)")
+    parser.add_argument('--cpu_slots', type=int, default=1, help="parallel folds with --devices cpu (default: 1)")
+    parser.add_argument('--image_store', type=bool, default=True, help='share one decoded image store between folds (default: True)')
+    parser.add_argument('--resume', type=bool, default=False, help='continue existing fold runs (train.py --load_model True)')
+    parser.add_argument('--oof', type=bool, default=True, help='save out-of-fold probabilities and report their metrics (default: True)')
+    parser.add_argument('--probs_dir', type=str, default='../probs')
+    parser.add_argument('--probs_size', type=int, default=256, help='size of the out-of-fold probability maps (default: 256)')
+    parser.add_argument('--eval_device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+
+    main(args, argv[split + 1:])
@@ -161,6 +161,23 @@ def lovasz_softmax(probas, labels, classes='present', per_image=False, ignore=No
       classes: 'all' for all, 'present' for classes present in labels, or a list of classes to average.
       per_image: compute the loss per image instead of per batch
       ignore: void class labels
+    All classes (and with per_image all images) are sorted at once, see lovasz_softmax_batched.
+    """
+    if probas.dim() == 3:
+        # assumes output of a sigmoid layer
+        probas = probas.unsqueeze(1)
+    B, C, H, W = probas.size()
+    groups = B if per_image else 1
+    probas = probas.reshape(groups, -1, C, H * W).transpose(1, 2).reshape(groups, C, -1)  # G, C, P
+    labels = labels.reshape(groups, -1)  # G, P
+    valid = None if ignore is None else (labels != ignore)
+    return lovasz_softmax_batched(probas, labels, classes=classes, valid=valid)
+
+
+def lovasz_softmax_loop(probas, labels, classes='present', per_image=False, ignore=None):
+    """
+    Original Multi-class Lovasz-Softmax loss (one sort per class and per image).
+    Kept as the reference of lovasz_softmax.
     """
     if per_image:
         loss = mean(lovasz_softmax_flat(*flatten_probas(prob.unsqueeze(0), lab.unsqueeze(0), ignore), classes=classes)
@@ -170,6 +187,67 @@ def lovasz_softmax(probas, labels, classes='present', per_image=False, ignore=No
     return loss
 
 
+def lovasz_grad_batched(gt_sorted):
+    """
+    lovasz_grad along the last dimension
+      gt_sorted: [..., P] float Tensor
+    """
+    gts = gt_sorted.sum(-1, keepdim=True)
+    intersection = gts - gt_sorted.cumsum(-1)
+    union = gts + (1 - gt_sorted).cumsum(-1)
+    jaccard = 1. - intersection / union
+    if gt_sorted.size(-1) > 1:  # cover 1-pixel case
+        jaccard = torch.cat([jaccard[..., :1], jaccard[..., 1:] - jaccard[..., :-1]], dim=-1)
+    return jaccard
+
+
+def lovasz_softmax_batched(probas, labels, classes='present', valid=None):
+    """
+    Multi-class Lovasz-Softmax loss for G groups (images, or the whole batch) at once
+      probas: [G, C, P] Variable, class probabilities at each prediction (between 0 and 1)
+      labels: [G, P] Tensor, ground truth labels (between 0 and C - 1)
+      classes: 'all' for all, 'present' for classes present in labels, or a list of classes to average.
+      valid: [G, P] bool Tensor, False for void pixels (None: all valid)
+    The errors of every counted (group, class) are sorted with one torch.sort; with classes='present'
+    the absent ones are dropped before the sort. Void pixels get error 0 and are not foreground, so
+    they are sorted after every positive error and do not change the loss.
+    Returns the mean over groups of the mean over (present) classes, as lovasz_softmax_loop.
+    """
+    G, C, P = probas.size()
+    class_to_sum = list(range(C)) if classes in ['all', 'present'] else list(classes)
+    if C == 1:
+        if len(class_to_sum) > 1:
+            raise ValueError('Sigmoid output possible only with 1 class')
+        class_pred = probas
+    else:
+        class_pred = probas[:, class_to_sum]
+    class_idx = torch.as_tensor(class_to_sum, device=labels.device).view(1, -1, 1)
+    fg = (labels.unsqueeze(1) == class_idx).to(probas.dtype)  # G, K, P
+    if valid is not None:
+        fg = fg * valid.unsqueeze(1)
+    errors = (fg - class_pred).abs()
+    if valid is not None:
+        errors = errors * valid.unsqueeze(1)
+
+    if classes == 'present':
+        present = fg.sum(-1) > 0  # G, K
+        counted = present.to(probas.dtype)
+        errors, fg = errors[present], fg[present]  # N, P
+    else:
+        counted = probas.new_ones(G, len(class_to_sum))
+
+    errors_sorted, perm = torch.sort(errors, dim=-1, descending=True)
+    fg_sorted = torch.gather(fg, -1, perm)
+    class_losses = (errors_sorted * lovasz_grad_batched(fg_sorted)).sum(-1)
+    if classes == 'present':
+        losses = counted.masked_scatter(present, class_losses)  # G, K, 0 for absent classes
+    else:
+        losses = class_losses
+    # groups without any counted class give 0, as mean(..., empty=0)
+    group_losses = (losses * counted).sum(-1) / counted.sum(-1).clamp(min=1)
+    return group_losses.mean()
+
+
 def lovasz_softmax_flat(probas, labels, classes='present'):
     """
     Multi-class Lovasz-Softmax loss
@@ -185,7 +263,7 @@ def lovasz_softmax_flat(probas, labels, classes='present'):
     class_to_sum = list(range(C)) if classes in ['all', 'present'] else classes
     for c in class_to_sum:
         fg = (labels == c).float()  # foreground for class c
-        if (classes is 'present' and fg.sum() == 0):
+        if (classes == 'present' and fg.sum() == 0):
             continue
         if C == 1:
             if len(classes) > 1:
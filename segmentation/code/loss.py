@@ -1,26 +1,28 @@
 import torch.nn as nn
 import numpy as np
 import torch
-from scipy.ndimage.morphology import distance_transform_edt as edt
 from torch.autograd import Variable
-import segmentation_models_pytorch as smp
 import lib.lovasz_losses as LOVASZ
-from utils import get_classes_count
+from utils import distance_field, get_classes_count
 
 use_cuda = torch.cuda.is_available()
 device = torch.device("cuda" if use_cuda else "cpu")
 
 
+def log_inverse_class_weights(classes_count):
+    weights = torch.tensor(classes_count)
+    # weights = torch.pow(weights, 1./10) # 10분의 1승 적용
+    weights = torch.log(weights)  # 로그함수 적용
+    weights = weights / weights.sum()
+    weights = 1.0 / weights
+    return weights / weights.sum()
+
+
 class WeightedCrossEntropy(nn.Module):
     def __init__(self):
         super(WeightedCrossEntropy, self).__init__()
         classes_count = get_classes_count()  # 클래스 별 카운트
-        weights = torch.tensor(classes_count)
-        # weights = torch.pow(weights, 1./10) # 10분의 1승 적용
-        weights = torch.log(weights)  # 로그함수 적용
-        weights = weights / weights.sum()
-        weights = 1.0 / weights
-        weights = weights / weights.sum()
+        weights = log_inverse_class_weights(classes_count)
         print("* 클래스 별 픽셀 갯수")
         print(classes_count)
         print("* 최종 weight")
@@ -65,92 +67,81 @@ copy pasted from - all credit goes to original authors:
 https://github.com/SilmarilBearer/HausdorffLoss
 """
 class HausdorffDTLoss(nn.Module):
-    """Binary Hausdorff loss based on distance transform"""
-    def __init__(self, alpha=2.0, **kwargs):
+    """Hausdorff loss based on distance transform (모든 class, 모든 image 를 한 번에 device 위에서 계산)
+
+    distance field 는 utils.distance_field 로 구합니다. dt_backend 는 'torch' (기본값, device 위의 exact separable EDT)
+    또는 'scipy' (host) 입니다.
+    target 의 distance field 가 미리 계산되어 있으면 (cache.DistanceFieldCache) forward 의 target_dt 로 넘길 수 있습니다.
+    """
+    def __init__(self, alpha=2.0, num_classes=12, dt_backend='torch', **kwargs):
         super(HausdorffDTLoss, self).__init__()
         self.alpha = alpha
+        self.num_classes = num_classes
+        self.dt_backend = dt_backend
+        self.CrossEntropyLoss = nn.CrossEntropyLoss()
 
     @torch.no_grad()
-    def distance_field(self, img: np.ndarray) -> np.ndarray:
-        field = np.zeros_like(img)
+    def distance_field(self, img: torch.Tensor) -> torch.Tensor:
+        """(b, c, x, y) -> (b, c, x, y)"""
+        return distance_field(img.flatten(0, 1), self.dt_backend).view(img.shape)
 
-        for batch in range(len(img)):
-            fg_mask = img[batch] > 0.5
+    def forward(
+            self, pred: torch.Tensor, target: torch.Tensor, target_dt: torch.Tensor = None
+    ) -> torch.Tensor:
+        """
+        pred: (b, c, x, y) logits
+        target: (b, x, y) labels
+        target_dt: (b, c, x, y) target 의 distance field (없으면 여기서 계산합니다)
+        """
+        pred_all = torch.softmax(pred, dim=1)
+        classes = torch.arange(self.num_classes, device=target.device).view(1, -1, 1, 1)
+        target_all = (target.unsqueeze(1) == classes).to(pred_all.dtype)
 
-            if fg_mask.any():
-                bg_mask = ~fg_mask
+        pred_dt = self.distance_field(pred_all.detach())
+        if target_dt is None:
+            target_dt = self.distance_field(target_all)
 
-                fg_dist = edt(fg_mask)
-                bg_dist = edt(bg_mask)
+        pred_error = (pred_all - target_all) ** 2
+        distance = pred_dt ** self.alpha + target_dt.to(pred_dt.dtype) ** self.alpha
+        # class 별 mean 의 합
+        loss_sum = (pred_error * distance).mean(dim=(0, 2, 3)).sum()
 
-                field[batch] = fg_dist + bg_dist
+        ce_loss = self.CrossEntropyLoss(pred, target)
+        return loss_sum / self.num_classes / pred_all.shape[0] / 3 + ce_loss
 
-        return field
 
-    def forward(
-            self, pred: torch.Tensor, target: torch.Tensor, debug=False
-    ) -> torch.Tensor:
-        """
-        Uses one binary channel: 1 - fg, 0 - bg
-        pred: (b, 1, x, y, z) or (b, 1, x, y)
-        target: (b, 1, x, y, z) or (b, 1, x, y)
-        """
-        pred_ = torch.clone(pred)
-        target_ = torch.clone(target)
-        m = nn.Softmax(dim=1)
-        pred_all = m(pred)
-        target = target.view(target.shape[0], 1, target.shape[1], target.shape[2])
-        target_all = make_one_hot(target)
-
-        loss_sum = 0
-
-        for c in range(12):  # for class
-            pred = pred_all[:, c, :, :]
-            target = target_all[:, c, :, :]
-
-            pred_dt = torch.from_numpy(self.distance_field(pred.detach().cpu().numpy())).float()
-            target_dt = torch.from_numpy(self.distance_field(target.detach().cpu().numpy())).float()
-
-            pred_error = (pred - target) ** 2
-            distance = pred_dt ** self.alpha + target_dt ** self.alpha
-
-            dt_field = pred_error.to(device) * distance.to(device)
-            loss = dt_field.mean()
-
-            if debug:
-                loss_sum += (
-                    loss.cpu().numpy(),
-                    (
-                        dt_field.cpu().numpy()[0, 0],
-                        pred_error.cpu().numpy()[0, 0],
-                        distance.cpu().numpy()[0, 0],
-                        pred_dt.cpu().numpy()[0, 0],
-                        target_dt.cpu().numpy()[0, 0],
-                    ),
-                )
+def class_overlaps(log_probs, target):
+    """one-hot 을 만들지 않고 class 별 intersection, 확률 합, target pixel 수를 구합니다.
 
-            else:
-                loss_sum += loss
-        ce_loss_f = nn.CrossEntropyLoss()
-        ce_loss = ce_loss_f(pred_, target_)
-        return loss_sum / 12 / pred_all.shape[0] / 3 + ce_loss
+    log_probs: (N, C, H, W) log softmax, target: (N, H, W)
+    returns: log p_t (N, H, W), intersection (C,), prob_sum (C,), target_count (C,)
+    """
+    num_classes = log_probs.shape[1]
+    log_p_t = log_probs.gather(1, target.unsqueeze(1)).squeeze(1)
+    flat_target = target.flatten()
+    intersection = log_p_t.new_zeros(num_classes).index_add(0, flat_target, log_p_t.exp().flatten())
+    prob_sum = log_probs.exp().sum(dim=(0, 2, 3))
+    target_count = torch.bincount(flat_target, minlength=num_classes).to(log_probs.dtype)
+    return log_p_t, intersection, prob_sum, target_count
+
+
+def hard_dice_loss(inputs, target, smooth=1.):
+    """argmax 예측과 target 의 dice (모든 class 를 합쳐서 계산). one-hot 끼리의 dice 와 같습니다.
+
+    one-hot 의 합은 예측, target 모두 pixel 수(N)이고 intersection 은 맞은 pixel 수라서
+    1 - (2 * correct + smooth) / (2 * N + smooth) 입니다.
+    """
+    correct = (inputs.argmax(dim=1) == target).sum().to(inputs.dtype)
+    return 1 - (2 * correct + smooth) / (2 * target.numel() + smooth)
 
 
 class DiceLoss(nn.Module):
     def __init__(self):
         super(DiceLoss, self).__init__()
-        self.DiceLoss = smp.utils.losses.DiceLoss()
 
     def forward(self, inputs, target):
-        # inputs: N, C(probs), H, W -> N, C(max_one_hot), H, W
-        inputs_max_idx = torch.argmax(inputs, 1, keepdim=True).to(device)
-        inputs_one_hot = torch.FloatTensor(inputs.shape).to(device)
-        inputs_one_hot.zero_()
-        inputs_one_hot.scatter_(1, inputs_max_idx, 1)
-        # target: N, H, W -> H, C, H, W
-        target = target.view(target.shape[0], 1, target.shape[1], target.shape[2])
-        target_one_hot = make_one_hot(target)  # N, H, W -> N, C, H, W
-        return self.DiceLoss(inputs_one_hot, target_one_hot)
+        # smp.utils.losses.DiceLoss(eps=1) 에 argmax one-hot 을 넣은 것과 같은 값
+        return hard_dice_loss(inputs, target)
 
 
 class DiceCrossEntropyLoss(nn.Module):
@@ -161,23 +152,79 @@ class DiceCrossEntropyLoss(nn.Module):
     def forward(self, inputs, target):  # N, C, H, W # N, H, W
         # cross entropy loss
         ce_loss = self.CrossEntropyLoss(inputs, target)
-
         # dice loss
-        # inputs: N, C(probs), H, W -> N, C(max_one_hot), H, W
-        inputs_max_idx = torch.argmax(inputs, 1, keepdim=True).to(device)
-        inputs_one_hot = torch.FloatTensor(inputs.shape).to(device)
-        inputs_one_hot.zero_()
-        inputs_one_hot.scatter_(1, inputs_max_idx, 1)
-        # target: N, H, W -> H, C, H, W
-        target = target.view(target.shape[0], 1, target.shape[1], target.shape[2])
-        target_one_hot = make_one_hot(target)  # N, H, W -> N, C, H, W
-        numerator = 2 * torch.sum(inputs_one_hot * target_one_hot)
-        denominator = torch.sum(inputs_one_hot + target_one_hot)
-        dice_loss = 1 - (numerator + 1) / (denominator + 1)
-
+        dice_loss = hard_dice_loss(inputs, target)
         return ce_loss * 1 + dice_loss * 10
 
 
+class SoftDiceCrossEntropyLoss(nn.Module):
+    """softmax 확률의 class 별 soft dice 와 (focal) cross entropy 를 한 번에 계산합니다.
+
+    loss = ce_weight * CE(또는 focal_gamma > 0 이면 focal) + dice_weight * (1 - class 별 dice 의 (weighted) mean)
+    intersection 등은 class_overlaps 로 label index 에서 바로 구하므로 one-hot tensor 를 만들지 않습니다.
+    class_weights: class 별 weight (list) 또는 'log_inverse' (WeightedCrossEntropy 와 같은 weight)
+    """
+    def __init__(self, ce_weight=1., dice_weight=1., focal_gamma=0., smooth=1., class_weights=None):
+        super(SoftDiceCrossEntropyLoss, self).__init__()
+        self.ce_weight = ce_weight
+        self.dice_weight = dice_weight
+        self.focal_gamma = focal_gamma
+        self.smooth = smooth
+        if isinstance(class_weights, str):
+            if class_weights != 'log_inverse':
+                raise ValueError(f'Unknown class weights ({class_weights})')
+            class_weights = log_inverse_class_weights(get_classes_count())
+        if class_weights is not None:
+            class_weights = torch.as_tensor(class_weights, dtype=torch.float32)
+            self.register_buffer('class_weights', class_weights)
+        else:
+            self.class_weights = None
+
+    def forward(self, inputs, target):
+        log_probs = torch.log_softmax(inputs, dim=1)
+        log_p_t, intersection, prob_sum, target_count = class_overlaps(log_probs, target)
+        loss = 0
+
+        if self.ce_weight:
+            pixel_loss = -log_p_t
+            if self.focal_gamma:
+                pixel_loss = pixel_loss * (1 - log_p_t.exp()) ** self.focal_gamma
+            if self.class_weights is None:
+                ce_loss = pixel_loss.mean()
+            else:
+                # nn.CrossEntropyLoss(weight=...) 와 같은 weighted mean
+                pixel_weights = self.class_weights[target]
+                ce_loss = (pixel_loss * pixel_weights).sum() / pixel_weights.sum()
+            loss = loss + self.ce_weight * ce_loss
+
+        if self.dice_weight:
+            dice = (2 * intersection + self.smooth) / (prob_sum + target_count + self.smooth)
+            if self.class_weights is None:
+                dice = dice.mean()
+            else:
+                dice = (dice * self.class_weights).sum() / self.class_weights.sum()
+            loss = loss + self.dice_weight * (1 - dice)
+        return loss
+
+
+class SoftDiceLoss(SoftDiceCrossEntropyLoss):
+    def __init__(self, **kwargs):
+        kwargs.setdefault('ce_weight', 0.)
+        super(SoftDiceLoss, self).__init__(**kwargs)
+
+
+class FocalDiceLoss(SoftDiceCrossEntropyLoss):
+    def __init__(self, **kwargs):
+        kwargs.setdefault('focal_gamma', 2.)
+        super(FocalDiceLoss, self).__init__(**kwargs)
+
+
+class WeightedSoftDiceCrossEntropyLoss(SoftDiceCrossEntropyLoss):
+    def __init__(self, **kwargs):
+        kwargs.setdefault('class_weights', 'log_inverse')
+        super(WeightedSoftDiceCrossEntropyLoss, self).__init__(**kwargs)
+
+
 class RovaszLoss(nn.Module):
     def __init__(self):
         super(RovaszLoss, self).__init__()
@@ -199,12 +246,30 @@ class RovaszCrossEntropyLoss(nn.Module):
         return lovasz_loss + ce_loss
 
 
+class Float32Loss(nn.Module):
+    """mixed precision(--precision fp16/bf16) 에서 criterion 을 autocast 밖에서 fp32 로 계산합니다.
+
+    lovasz 의 sort/cumsum, dice 의 합 등은 fp16 에서 정확도가 떨어지므로 logits 를 fp32 로 바꿔서 넘깁니다.
+    """
+    def __init__(self, criterion):
+        super(Float32Loss, self).__init__()
+        self.criterion = criterion
+
+    def forward(self, inputs, target, **kwargs):
+        with torch.autocast(device_type=inputs.device.type, enabled=False):
+            return self.criterion(inputs.float(), target, **kwargs)
+
+
 _criterion_entrypoints = {
     'cross_entropy': nn.CrossEntropyLoss,
     'weighted_cross_entropy': WeightedCrossEntropy,
     'HausdorffDT': HausdorffDTLoss,
     'dice': DiceLoss,
     'dice_cross_entropy': DiceCrossEntropyLoss,
+    'soft_dice': SoftDiceLoss,
+    'soft_dice_cross_entropy': SoftDiceCrossEntropyLoss,
+    'focal_dice': FocalDiceLoss,
+    'weighted_soft_dice_cross_entropy': WeightedSoftDiceCrossEntropyLoss,
     'rovasz': RovaszLoss,
     'rovasz_cross_entropy': RovaszCrossEntropyLoss
 }
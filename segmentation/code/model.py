@@ -1,14 +1,24 @@
+import os
+import torch
 import torch.nn as nn
-from torchvision.models import vgg16
-import segmentation_models_pytorch as smp
-from segmentation.TransUNet.networks.vit_seg_modeling import VisionTransformer as ViT_seg
-from segmentation.TransUNet.networks.vit_seg_modeling import CONFIGS as CONFIGS_ViT_seg
-import numpy as np
+
+# pretrained encoder weight 를 받아 두는 곳. (SEG_PRETRAINED_DIR 로 바꿀 수 있습니다)
+PRETRAINED_DIR = os.environ.get('SEG_PRETRAINED_DIR',
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pretrained'))
+
+
+def use_pretrained_dir():
+    """torch.hub (model_zoo) 와 huggingface hub 의 download 위치를 PRETRAINED_DIR 로 고정합니다."""
+    torch.hub.set_dir(PRETRAINED_DIR)
+    os.environ.setdefault('HF_HUB_CACHE', os.path.join(PRETRAINED_DIR, 'huggingface'))
 
 
 class R50_ViT(nn.Module):
-    def __init__(self, num_classes):
+    def __init__(self, num_classes, pretrained=True):
         super().__init__()
+        import numpy as np
+        from segmentation.TransUNet.networks.vit_seg_modeling import VisionTransformer as ViT_seg
+        from segmentation.TransUNet.networks.vit_seg_modeling import CONFIGS as CONFIGS_ViT_seg
         config_vit = CONFIGS_ViT_seg['R50-ViT-B_16']
         config_vit.n_classes = 12
         config_vit.n_skip = 3
@@ -16,16 +26,19 @@ class R50_ViT(nn.Module):
         config_vit.transformer.dropout_rate = 0.2
 
         self.model = ViT_seg(config_vit, img_size=512, num_classes=num_classes)
-        self.model.load_from(weights=np.load(config_vit.pretrained_path))
+        if pretrained:
+            self.model.load_from(weights=np.load(config_vit.pretrained_path))
 
     def forward(self, x):
         return self.model(x)
 
 
 class FCN8s(nn.Module):
-    def __init__(self, num_classes):
+    def __init__(self, num_classes, pretrained=True):
         super(FCN8s, self).__init__()
-        self.pretrained_model = vgg16(pretrained=True)
+        from torchvision.models import vgg16
+        use_pretrained_dir()
+        self.pretrained_model = vgg16(pretrained=pretrained)
         features, classifiers = list(self.pretrained_model.features.children()), list(
             self.pretrained_model.classifier.children())
 
@@ -88,31 +101,23 @@ class FCN8s(nn.Module):
         return upscore8
 
 
-class DeepLapV3PlusEfficientnetB0Imagenet(nn.Module):
-    ENCODER = 'timm-efficientnet-b0'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
+class SMPModel(nn.Module):
+    """segmentation_models_pytorch 의 ARCHITECTURE(ENCODER, ENCODER_WEIGHTS) 를 감싼 model.
 
-class DeepLapV3PlusEfficientnetB0Advprop(nn.Module):
-    ENCODER = 'timm-efficientnet-b0'
-    ENCODER_WEIGHTS = 'advprop'
+    smp 는 model 을 만들 때 import 하므로 `import model` 만으로는 불러오지 않습니다.
+    pretrained=False 면 encoder weight 를 받지 않습니다. (저장한 weight 를 바로 읽을 때)
+    """
+    ARCHITECTURE = None
+    ENCODER = None
+    ENCODER_WEIGHTS = None
 
-    def __init__(self, num_classes=12):
+    def __init__(self, num_classes=12, pretrained=True):
         super().__init__()
-        self.model = smp.DeepLabV3Plus(
+        use_pretrained_dir()
+        import segmentation_models_pytorch as smp
+        self.model = getattr(smp, self.ARCHITECTURE)(
             encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
+            encoder_weights=self.ENCODER_WEIGHTS if pretrained else None,
             classes=num_classes,
         )
 
@@ -120,289 +125,41 @@ class DeepLapV3PlusEfficientnetB0Advprop(nn.Module):
         return self.model(x)
 
 
-class DeepLapV3PlusEfficientnetB0NoisyStudent(nn.Module):
-    ENCODER = 'timm-efficientnet-b0'
-    ENCODER_WEIGHTS = 'noisy-student'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
+# model 이름: (smp architecture, encoder, encoder weights)
+_smp_models = {
+    'DeepLapV3PlusEfficientnetB0Imagenet': ('DeepLabV3Plus', 'timm-efficientnet-b0', 'imagenet'),
+    'DeepLapV3PlusEfficientnetB0Advprop': ('DeepLabV3Plus', 'timm-efficientnet-b0', 'advprop'),
+    'DeepLapV3PlusEfficientnetB0NoisyStudent': ('DeepLabV3Plus', 'timm-efficientnet-b0', 'noisy-student'),
+    'DeepLapV3PlusEfficientnetB4NoisyStudent': ('DeepLabV3Plus', 'timm-efficientnet-b4', 'noisy-student'),
+    'DeepLapV3PlusEfficientnetB5': ('DeepLabV3Plus', 'efficientnet-b5', 'imagenet'),
+    'DeepLapV3PlusEfficientnetB5NoisyStudent': ('DeepLabV3Plus', 'timm-efficientnet-b5', 'noisy-student'),
+    'DeepLapV3PlusEfficientnetB7NoisyStudent': ('DeepLabV3Plus', 'timm-efficientnet-b7', 'noisy-student'),
+    'DeepLapV3PlusResnext50': ('DeepLabV3Plus', 'se_resnext50_32x4d', 'imagenet'),
+    'DeepLapV3PlusResnext101': ('DeepLabV3Plus', 'se_resnext101_32x4d', 'imagenet'),
+    'ResNet34': ('DeepLabV3Plus', 'resnet34', 'imagenet'),
+    'UnetPlusPlusInceptionResnetV2': ('UnetPlusPlus', 'inceptionresnetv2', 'imagenet'),
+    'UnetPlusPlusInceptionResnetV2Background': ('UnetPlusPlus', 'inceptionresnetv2', 'imagenet+background'),
+    'UnetPlusPlusInceptionV4': ('UnetPlusPlus', 'inceptionv4', 'imagenet'),
+    'UnetPlusPlusInceptionV4Background': ('UnetPlusPlus', 'inceptionv4', 'imagenet+background'),
+    'DeepLapV3PlusRegnety002Imagenet': ('DeepLabV3Plus', 'timm-regnety_002', 'imagenet'),
+    'DeepLapV3PlusRegnety064Imagenet': ('DeepLabV3Plus', 'timm-regnety_064', 'imagenet'),
+    'DeepLapV3PlusRegnetx160Imagenet': ('DeepLabV3Plus', 'timm-regnetx_160', 'imagenet'),
+    'DeepLapV3PlusRegnety160Imagenet': ('DeepLabV3Plus', 'timm-regnety_160', 'imagenet'),
+    'DeepLapV3PlusRegnety320Imagenet': ('DeepLabV3Plus', 'timm-regnety_320', 'imagenet'),
+    'UnetPlusPlusResnext50Swsl': ('UnetPlusPlus', 'resnext50_32x4d', 'swsl'),
+}
 
+# 이전과 같이 model.DeepLapV3PlusEfficientnetB0NoisyStudent 처럼 class 로 사용할 수 있습니다.
+for _name, (_architecture, _encoder, _weights) in _smp_models.items():
+    globals()[_name] = type(_name, (SMPModel,), {'ARCHITECTURE': _architecture, 'ENCODER': _encoder,
+                                                 'ENCODER_WEIGHTS': _weights, '__module__': __name__})
 
-class DeepLapV3PlusEfficientnetB4NoisyStudent(nn.Module):
-    ENCODER = 'timm-efficientnet-b4'
-    ENCODER_WEIGHTS = 'noisy-student'
 
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusEfficientnetB5(nn.Module):
-    ENCODER = 'efficientnet-b5'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusEfficientnetB5NoisyStudent(nn.Module):
-    ENCODER = 'timm-efficientnet-b5'
-    ENCODER_WEIGHTS = 'noisy-student'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
+def model_names():
+    return ['R50_ViT', 'FCN8s'] + list(_smp_models)
 
 
-class DeepLapV3PlusEfficientnetB7NoisyStudent(nn.Module):
-    ENCODER = 'timm-efficientnet-b7'
-    ENCODER_WEIGHTS = 'noisy-student'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusResnext50(nn.Module):
-    ENCODER = 'se_resnext50_32x4d'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusResnext101(nn.Module):
-    ENCODER = 'se_resnext101_32x4d'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class ResNet34(nn.Module):
-    ENCODER = 'resnet34'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class UnetPlusPlusInceptionResnetV2(nn.Module):
-    ENCODER = 'inceptionresnetv2'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.UnetPlusPlus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class UnetPlusPlusInceptionResnetV2Background(nn.Module):
-    ENCODER = 'inceptionresnetv2'
-    ENCODER_WEIGHTS = 'imagenet+background'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.UnetPlusPlus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class UnetPlusPlusInceptionV4(nn.Module):
-    ENCODER = 'inceptionv4'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.UnetPlusPlus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class UnetPlusPlusInceptionV4Background(nn.Module):
-    ENCODER = 'inceptionv4'
-    ENCODER_WEIGHTS = 'imagenet+background'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.UnetPlusPlus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusRegnety002Imagenet(nn.Module):
-    ENCODER = 'timm-regnety_002'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusRegnety064Imagenet(nn.Module):
-    ENCODER = 'timm-regnety_064'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusRegnetx160Imagenet(nn.Module):
-    ENCODER = 'timm-regnetx_160'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusRegnety160Imagenet(nn.Module):
-    ENCODER = 'timm-regnety_160'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class DeepLapV3PlusRegnety320Imagenet(nn.Module):
-    ENCODER = 'timm-regnety_320'
-    ENCODER_WEIGHTS = 'imagenet'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.DeepLabV3Plus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
-
-
-class UnetPlusPlusResnext50Swsl(nn.Module):
-    ENCODER = 'resnext50_32x4d'
-    ENCODER_WEIGHTS = 'swsl'
-
-    def __init__(self, num_classes=12):
-        super().__init__()
-        self.model = smp.UnetPlusPlus(
-            encoder_name=self.ENCODER,
-            encoder_weights=self.ENCODER_WEIGHTS,
-            classes=num_classes,
-        )
-
-    def forward(self, x):
-        return self.model(x)
+def build_model(model_name, num_classes=12, pretrained=True):
+    if model_name not in model_names():
+        raise RuntimeError('Unknown model (%s)' % model_name)
+    return globals()[model_name](num_classes=num_classes, pretrained=pretrained)
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from cache import MaskCache, ProbCache
+from utils import ConfusionMatrix
+
+
+def load_targets(annotation_path, category_names, file_names, size, device):
+    """val mask 를 cache 크기로 nearest downsample 합니다. (inference 의 A.Resize 와 같은 방식)"""
+    mask_cache = MaskCache(annotation_path, category_names)
+    masks = torch.from_numpy(np.stack([mask_cache[file_name] for file_name in file_names]))
+    masks = F.interpolate(masks[:, None].float(), size=(size, size), mode='nearest')[:, 0]
+    return masks.long().to(device)
+
+
+class EnsembleEvaluator:
+    """cache 된 확률만으로 (model weight, scale weight) 조합의 mIoU 를 계산합니다."""
+
+    def __init__(self, caches, targets, num_classes, device, chunk_size=64):
+        self.caches = caches
+        self.probs = [cache.to_tensor(device) for cache in caches]  # (N, scales, C, size, size)
+        self.targets = targets
+        self.num_classes = num_classes
+        self.device = device
+        self.chunk_size = chunk_size
+
+    @torch.no_grad()
+    def __call__(self, model_weights, scale_weights):
+        metric = ConfusionMatrix(self.num_classes, self.device)
+        scale_weights = torch.as_tensor(scale_weights, dtype=torch.float32, device=self.device).view(1, -1, 1, 1, 1)
+        for start in range(0, len(self.targets), self.chunk_size):
+            outs = 0
+            for cache, probs, model_weight in zip(self.caches, self.probs, model_weights):
+                if model_weight == 0:
+                    continue
+                chunk = cache.dequantize(probs[start:start + self.chunk_size])
+                outs = outs + (chunk * scale_weights).sum(dim=1) * model_weight
+            if isinstance(outs, int):
+                return 0.
+            metric.update(self.targets[start:start + self.chunk_size], outs.argmax(dim=1))
+        return metric.compute()['mIoU']
+
+
+def coordinate_search(evaluate, weights, step=0.1, rounds=2):
+    """합이 1 인 weight 를 한 좌표씩 grid 로 바꿔 보며 evaluate 가 가장 큰 값을 찾습니다."""
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+    best_score = evaluate(weights)
+    grid = np.round(np.arange(0, 1 + 1e-9, step), 6)
+    for _ in range(rounds):
+        improved = False
+        for i in range(len(weights)):
+            rest = np.delete(weights, i)
+            for value in grid:
+                candidate = np.insert(rest / rest.sum() * (1 - value) if rest.sum() > 0 else
+                                      np.full(len(rest), (1 - value) / max(1, len(rest))), i, value)
+                score = evaluate(candidate)
+                if score > best_score + 1e-12:
+                    best_score, weights, improved = score, candidate, True
+        if not improved:
+            break
+    return weights, best_score
+
+
+def search(args):
+    device = torch.device(args.device)
+    category_names = ['Backgroud', 'UNKNOWN', 'General trash', 'Paper', 'Paper pack', 'Metal', 'Glass', 'Plastic',
+                      'Styrofoam', 'Plastic bag', 'Battery', 'Clothing']
+    json_stem = os.path.splitext(os.path.basename(args.val))[0]
+    caches = [ProbCache(os.path.join(args.probs_dir, f'{model_dir}_{json_stem}.npy')) for model_dir in args.model_dir.split(',')]
+    for cache in caches[1:]:
+        if cache.file_names != caches[0].file_names or cache.scales != caches[0].scales:
+            raise ValueError(f'{cache.path} does not match {caches[0].path}')
+
+    targets = load_targets(os.path.join(args.data_dir, args.val), category_names, caches[0].file_names,
+                           caches[0].meta['size'], device)
+    evaluator = EnsembleEvaluator(caches, targets, len(category_names), device)
+
+    num_models, scales = len(caches), caches[0].scales
+    model_weights = np.full(num_models, 1. / num_models)
+    scale_weights = np.asarray(list(map(float, args.scale_weights.split(',')))) if args.scale_weights else np.full(len(scales), 1. / len(scales))
+    start_time = time.time()
+    base_score = evaluator(model_weights, scale_weights)
+    print(f'initial mIoU: {base_score:.4f} (model weights {model_weights.round(3).tolist()}, scale weights {scale_weights.round(3).tolist()})')
+
+    score = base_score
+    for _ in range(args.rounds):
+        if len(scales) > 1:
+            scale_weights, score = coordinate_search(lambda w: evaluator(model_weights, w), scale_weights, args.step)
+        if num_models > 1:
+            model_weights, score = coordinate_search(lambda w: evaluator(w, scale_weights), model_weights, args.step)
+    print(f'best mIoU: {score:.4f} ({time.time() - start_time:.1f}s)')
+    print(f"--weights {','.join(f'{w:.3f}' for w in model_weights)}")
+    print(f"--tta_spec 'scales={','.join(map(str, scales))};weights={','.join(f'{w:.3f}' for w in scale_weights)}'")
+
+    result = {'val': args.val, 'model_dir': args.model_dir, 'scales': scales,
+              'model_weights': model_weights.tolist(), 'scale_weights': scale_weights.tolist(),
+              'initial_mIoU': base_score, 'best_mIoU': score}
+    with open(os.path.join(args.probs_dir, f'weights_{json_stem}.json'), 'w') as f:
+        json.dump(result, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # python inference.py --model ... --model_dir kfold0...,kfold1... --save_probs ../probs --probs_json val0.json
+    # python search_weights.py --model_dir kfold0...,kfold1... --val val0.json
+    parser.add_argument('--model_dir', type=str, required=True, help='model folders used with inference.py --save_probs')
+    parser.add_argument('--probs_dir', type=str, default='../probs')
+    parser.add_argument('--val', type=str, default='val.json')
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_EVAL', '../input/data'))
+    parser.add_argument('--scale_weights', type=str, default='', help='initial scale weights (default: equal)')
+    parser.add_argument('--step', type=float, default=0.05, help='grid step of the weight search (default: 0.05)')
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    search(args)
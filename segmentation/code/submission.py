@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+def format_prediction_strings(preds):
+    """(batch, pixels) 의 label 들을 row 마다 ' '.join(str(e) for e in row) 와 같은 bytes 로 만듭니다.
+
+    python 에서 pixel 마다 str 을 만드는 대신 자릿수별로 ascii 를 한 번에 채워 넣습니다.
+    """
+    preds = np.asarray(preds)
+    if preds.ndim != 2:
+        raise ValueError(f'preds should be (batch, pixels), got shape {preds.shape}')
+    if preds.shape[1] == 0:
+        return [b''] * preds.shape[0]
+    num_pixels = preds.shape[1]
+    preds = preds.astype(np.int64).ravel()
+    if preds.min() < 0:
+        raise ValueError('prediction labels should be non-negative')
+
+    num_digits = len(str(int(preds.max())))
+    digits = np.ones_like(preds)
+    for k in range(1, num_digits):
+        digits += preds >= 10 ** k
+    lengths = digits + 1  # 숫자 + 구분자(' ')
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    buffer = np.full(ends[-1], ord(' '), dtype=np.uint8)
+    for k in range(num_digits):
+        selected = digits > k
+        buffer[(starts + digits - 1 - k)[selected]] = preds[selected] // 10 ** k % 10 + ord('0')
+
+    # row 의 마지막 구분자는 빼고 자릅니다.
+    row_starts = starts[::num_pixels]
+    row_ends = ends[num_pixels - 1::num_pixels] - 1
+    return [buffer[start:end].tobytes() for start, end in zip(row_starts, row_ends)]
+
+
+class SubmissionWriter:
+    """submission csv 를 batch 가 끝날 때마다 이어서 씁니다.
+
+    sample_submission 의 header(와 row)를 pandas 로 먼저 쓰고, 그 뒤 row 들은
+    DataFrame.append + to_csv 로 만든 것과 같은 bytes 로 바로 씁니다.
+    """
+
+    def __init__(self, path, sample_submission=None):
+        self.path = path
+        self.sample_submission = sample_submission
+        self.line_terminator = os.linesep.encode()
+        self.file = None
+
+    def __enter__(self):
+        if self.sample_submission is not None:
+            submission = pd.read_csv(self.sample_submission, index_col=None)
+        else:
+            submission = pd.DataFrame(columns=['image_id', 'PredictionString'])
+        submission.to_csv(self.path, index=False)
+        self.file = open(self.path, 'ab')
+        return self
+
+    def write(self, file_names, preds):
+        for file_name, prediction_string in zip(file_names, format_prediction_strings(preds)):
+            self.file.write(file_name.encode() + b',' + prediction_string + self.line_terminator)
+
+    def __exit__(self, *exc):
+        self.file.close()
+        self.file = None
@@ -10,8 +10,13 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
-from utils import label_accuracy_score, seed_everything, seed_worker, copyblob
-from loss import create_criterion
+from utils import (ConfusionMatrix, PrecisionDataParallel, Prefetcher, collate_fn, precision_autocast, seed_everything,
+                   seed_worker, normalize_batch)
+from batch_aug import BatchMix
+from cache import ClassStats, DistanceFieldCache
+from dataset import ClassAwareSampler, EpochShuffleSampler
+from checkpoint import CheckpointManager, capture_rng_state, restore_rng_state
+from loss import create_criterion, Float32Loss
 import time
 from utils import load_model
 
@@ -47,10 +52,7 @@ def train(data_dir, model_dir, args):
     # path configuration
     train_path = data_dir + '/' + args.train
     val_path = data_dir + '/' + args.val
-
-    # needs for batch
-    def collate_fn(batch):
-        return tuple(zip(*batch))
+    cache_source = data_dir + '/' + args.cache_source if args.cache_source else None
 
     if args.aug:
         train_transform = A.Compose([
@@ -59,6 +61,9 @@ def train(data_dir, model_dir, args):
             A.Resize(512, 512),
             ToTensorV2(),
         ])
+        val_transform = A.Compose([
+            ToTensorV2()
+        ])
     else:
         train_transform = A.Compose([
             ToTensorV2()
@@ -71,47 +76,86 @@ def train(data_dir, model_dir, args):
     transform_module = getattr(import_module("dataset"), args.dataset)
     category_names = ['Backgroud', 'UNKNOWN', 'General trash', 'Paper', 'Paper pack', 'Metal', 'Glass', 'Plastic',
                       'Styrofoam', 'Plastic bag', 'Battery', 'Clothing']
-    train_dataset = transform_module(data_dir=train_path, category_names=category_names, mode='train', transform=train_transform, cutmix=args.cutmix)
-    val_dataset = transform_module(data_dir=val_path, category_names=category_names, mode='val', transform=val_transform, cutmix=args.cutmix)
+    # CutMix, CopyBlob 은 dataset 이 아니라 device 위의 batch 에서 합니다. (batch_aug.BatchMix)
+    train_dataset = transform_module(data_dir=train_path, category_names=category_names, mode='train', transform=train_transform,
+                                     cache_source=cache_source, image_store=args.image_store, uint8=args.uint8)
+    val_dataset = transform_module(data_dir=val_path, category_names=category_names, mode='val', transform=val_transform,
+                                   cache_source=cache_source, image_store=args.image_store, uint8=args.uint8)
     num_classes = train_dataset.num_classes  # 12
 
+    # 드문 class 가 있는 image 를 더 자주 뽑습니다. (annotation 의 class 통계만 사용)
+    # epoch 의 순서는 seed + epoch 으로 정해지므로 checkpoint 의 (epoch, step) 에서 같은 순서로 이어갈 수 있습니다.
+    if args.class_aware_sampler:
+        train_sampler = ClassAwareSampler(ClassStats(train_path, category_names), power=args.sampler_power, seed=args.seed)
+        print(f'class aware sampler: class weights {np.round(train_sampler.class_weights, 3).tolist()}')
+    else:
+        train_sampler = EpochShuffleSampler(len(train_dataset), seed=args.seed)
+    steps_per_epoch = train_sampler.num_samples // args.batch_size
+
     # DataLoader
     train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                batch_size=args.batch_size,
-                                               shuffle=True,
-                                               num_workers=4,
+                                               shuffle=False,
+                                               sampler=train_sampler,
+                                               num_workers=args.num_workers,
                                                collate_fn=collate_fn,
+                                               pin_memory=use_cuda,
+                                               persistent_workers=args.num_workers > 0,
                                                drop_last=True,
                                                worker_init_fn=seed_worker)
 
     val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
                                              batch_size=args.valid_batch_size,
                                              shuffle=False,
-                                             num_workers=4,
+                                             num_workers=args.num_workers,
                                              collate_fn=collate_fn,
+                                             pin_memory=use_cuda,
+                                             persistent_workers=args.num_workers > 0,
                                              worker_init_fn=seed_worker)
 
+    # category_names: ['Backgroud', 'UNKNOWN', 'General trash', 'Paper', 'Paper pack', 'Metal', 'Glass', 'Plastic', 'Styrofoam', 'Plastic bag', 'Battery', 'Clothing']
+    batch_mix = BatchMix(cutmix_p=args.cutmix_p if args.cutmix else 0., copyblob=args.copyblob,
+                         src_classes=map(int, args.copyblob_src.split(',')),
+                         dst_classes=map(int, args.copyblob_dst.split(',')))
+
     # resume model
     if args.load_model == False:
         model_module = getattr(import_module("model"), args.model)
         model = model_module(
             num_classes=num_classes
         ).to(device)
-        model = torch.nn.DataParallel(model)
     else:
         if os.path.exists(os.path.join(model_dir, args.name, 'latest.pth')):
             model = load_model(model_dir, num_classes, device, args, args.model, 'train', 'latest.pth').to(device)
-        else:
+        elif os.path.exists(os.path.join(model_dir, args.name, 'best.pth')):
             model = load_model(model_dir, num_classes, device, args, args.model, 'train', 'best.pth').to(device)
-        model = torch.nn.DataParallel(model)
+        else:
+            # 첫 epoch 중간의 checkpoint 만 있는 경우: weight 는 아래에서 checkpoint 로 읽습니다.
+            model = getattr(import_module("model"), args.model)(num_classes=num_classes).to(device)
         save_dir = os.path.join(model_dir, args.name)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    model = PrecisionDataParallel(model, args.precision)
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
     with open(os.path.join(save_dir, 'transform'), 'w') as f:
         f.write(str(train_transform) + '\n\n' + str(val_transform))
 
     # loss & metric
-    criterion = create_criterion(args.criterion)  # default: cross_entropy
+    criterion_kwargs = {'dt_backend': args.dt_backend} if args.criterion == 'HausdorffDT' else {}
+    criterion = create_criterion(args.criterion, **criterion_kwargs)  # default: cross_entropy
+    # HausdorffDT 의 target distance field 는 mask 가 바뀌지 않는 validation 에서만 cache 에서 읽습니다.
+    val_dt_cache = None
+    if args.dt_cache:
+        if args.criterion != 'HausdorffDT':
+            raise ValueError('--dt_cache is only used with --criterion HausdorffDT')
+        val_file_names = [info['file_name'] for info in val_dataset.coco.loadImgs(val_dataset.coco.getImgIds())]
+        val_dt_cache = DistanceFieldCache(val_dataset.mask_cache, val_file_names, num_classes, device,
+                                          backend=args.dt_backend)
+    if args.precision != 'fp32':
+        criterion = Float32Loss(criterion)
+    # fp16 은 gradient underflow 를 막기 위해 loss scaling 을 합니다. (bf16, fp32 에서는 아무것도 하지 않습니다)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.precision == 'fp16' and use_cuda)
     opt_module = getattr(import_module("torch.optim"), args.optimizer)  # default: Adam
     optimizer = opt_module(
         filter(lambda p: p.requires_grad, model.parameters()),
@@ -155,42 +199,65 @@ def train(data_dir, model_dir, args):
         train_info = {'best_val_mIOU': 0,
                       'epoch': -1,
                       }
+    if train_info.get('scaler'):
+        scaler.load_state_dict(train_info['scaler'])
     start_epoch = train_info['epoch'] + 1
+    start_step = 0
     best_val_mIoU = train_info['best_val_mIOU']
+
+    # 전체 학습 상태 (optimizer, scheduler, scaler, RNG, epoch 안의 step) 는 checkpoint_{epoch}_{step}.pth 에 있습니다.
+    checkpoints = CheckpointManager(save_dir, keep_last=args.keep_checkpoints)
+    checkpoint = checkpoints.load() if args.load_model else None
+    if checkpoint is not None:
+        model.module.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if checkpoint['scheduler'] is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        if checkpoint['scaler']:
+            scaler.load_state_dict(checkpoint['scaler'])
+        restore_rng_state(checkpoint['rng'])
+        start_epoch, start_step = checkpoint['epoch'], checkpoint['step']
+        best_val_mIoU = checkpoint['best_val_mIOU']
+
+    def training_state():
+        return {'model': model.module.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict() if args.scheduler is not None else None,
+                'scaler': scaler.state_dict(),
+                'rng': capture_rng_state(),
+                'best_val_mIOU': best_val_mIoU}
+
     print(f'best_val_mIOU: {best_val_mIoU}')
-    print(f'start_epoch: {start_epoch}')
+    print(f'start_epoch: {start_epoch}' + (f' (step {start_step})' if start_step else ''))
     if start_epoch >= args.epochs:
         print('already trained')
         return
     best_val_loss = np.inf
     for epoch in range(start_epoch, args.epochs):
         model.train()
+        train_sampler.set_epoch(epoch, start_step * args.batch_size if epoch == start_epoch else 0)
         train_loss = 0
         train_cnt = 0
-        train_mIoU_list = []
+        train_metric = ConfusionMatrix(num_classes, device)
 
         # train loop
-        for idx, (images, masks, _) in enumerate(train_loader):
-            images = torch.stack(images)  # (batch, channel, height, width)
-            masks = torch.stack(masks).long()  # (batch, channel, height, width)
-
-            # copyblob
-            if args.copyblob:
-                for i in range(args.batch_size):
-                    rand_idx = np.random.randint(args.batch_size)
-                    # category_names: ['Backgroud', 'UNKNOWN', 'General trash', 'Paper', 'Paper pack', 'Metal', 'Glass', 'Plastic', 'Styrofoam', 'Plastic bag', 'Battery', 'Clothing']
-                    copyblob(src_img=images[i], src_mask=masks[i], dst_img=images[rand_idx], dst_mask=masks[rand_idx],
-                             src_class=np.random.choice([2, 4, 5, 6, 7, 8], 1).item(), dst_class=0)
-                    copyblob(src_img=images[i], src_mask=masks[i], dst_img=images[rand_idx], dst_mask=masks[rand_idx],
-                             src_class=np.random.choice([2, 4, 5, 6, 7, 8], 1).item(), dst_class=3)
-
-            images, masks = images.to(device), masks.to(device)
-            outputs = model(images)
-            loss = criterion(outputs, masks)
+        for idx, (images, masks, image_infos) in enumerate(Prefetcher(train_loader, device),
+                                                           start=start_step if epoch == start_epoch else 0):
+            # images: (batch, channel, height, width), masks: (batch, height, width). 이미 device 위에 있습니다.
+            masks = masks.long()
+            images, masks = batch_mix(images, masks)
+            if args.uint8:
+                images = normalize_batch(images, train_dataset.mean_std)
+            if args.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+            with precision_autocast(device, args.precision):
+                outputs = model(images)
+                loss = criterion(outputs, masks)
 
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             if args.scheduler != None:
                 scheduler.step()
@@ -198,23 +265,25 @@ def train(data_dir, model_dir, args):
             train_loss += loss
             train_cnt += 1
 
-            outputs = torch.argmax(outputs.squeeze(), dim=1).detach().cpu().numpy()
-            mIoU = label_accuracy_score(masks.detach().cpu().numpy(), outputs, n_class=12)[2]
-            train_mIoU_list.append(mIoU)
+            train_metric.update(masks, torch.argmax(outputs.detach(), dim=1))
 
             if (idx + 1) % args.log_interval == 0:
                 train_loss = train_loss / train_cnt
+                train_mIoU = train_metric.compute()['mIoU']
                 current_lr = get_lr(optimizer)
                 print(
-                    f"Epoch[{epoch + 1}/{args.epochs}]({idx + 1}/{len(train_loader)}) || "
-                    f"training loss {train_loss:4.4} || training mIoU {np.mean(train_mIoU_list):4.2%} || lr {current_lr}"
+                    f"Epoch[{epoch + 1}/{args.epochs}]({idx + 1}/{steps_per_epoch}) || "
+                    f"training loss {train_loss:4.4} || training mIoU {train_mIoU:4.2%} || lr {current_lr}"
                 )
-                logger.add_scalar("Train/loss", train_loss, epoch * len(train_loader) + idx)
-                logger.add_scalar("Train/mIoU", np.mean(train_mIoU_list), epoch * len(train_loader) + idx)
+                logger.add_scalar("Train/loss", train_loss, epoch * steps_per_epoch + idx)
+                logger.add_scalar("Train/mIoU", train_mIoU, epoch * steps_per_epoch + idx)
 
                 train_loss = 0
                 train_cnt = 0
-                train_mIoU_list = []
+                train_metric.reset()
+
+            if args.checkpoint_interval and (idx + 1) % args.checkpoint_interval == 0 and idx + 1 < steps_per_epoch:
+                checkpoints.save(training_state(), epoch, idx + 1)
 
         # val loop
         model.eval()
@@ -223,31 +292,35 @@ def train(data_dir, model_dir, args):
 
             total_loss = 0
             cnt = 0
-            mIoU_list = []
-
-            for (images, masks, _) in val_loader:
-                images = torch.stack(images)  # (batch, channel, height, width)
-                masks = torch.stack(masks).long()  # (batch, channel, height, width)
-                images, masks = images.to(device), masks.to(device)
-
-                outputs = model(images)
-                loss = criterion(outputs, masks)
+            val_metric = ConfusionMatrix(num_classes, device)
+
+            for (images, masks, image_infos) in Prefetcher(val_loader, device):
+                masks = masks.long()
+                loss_kwargs = {}
+                if val_dt_cache is not None:
+                    loss_kwargs['target_dt'] = val_dt_cache.lookup([info['file_name'] for info in image_infos], device)
+                if args.uint8:
+                    images = normalize_batch(images, val_dataset.mean_std)
+                if args.channels_last:
+                    images = images.contiguous(memory_format=torch.channels_last)
+
+                with precision_autocast(device, args.precision):
+                    outputs = model(images)
+                    loss = criterion(outputs, masks, **loss_kwargs)
 
                 total_loss += loss
                 cnt += 1
-                outputs = torch.argmax(outputs.squeeze(), dim=1).detach().cpu().numpy()
-
-                mIoU = label_accuracy_score(masks.detach().cpu().numpy(), outputs, n_class=12)[2]
-                mIoU_list.append(mIoU)
+                val_metric.update(masks, torch.argmax(outputs, dim=1))
 
             val_loss = total_loss / cnt
             best_val_loss = min(best_val_loss, val_loss)
-            val_mIoU = np.mean(mIoU_list)
+            val_result = val_metric.all_reduce().compute()
+            val_mIoU = val_result['mIoU']
 
             # save best epoch
             if val_mIoU > best_val_mIoU:
                 print(f"New best model for val mIoU : {val_mIoU:4.2%}! saving the best model..")
-                torch.save(model.module.state_dict(), f"{save_dir}/best.pth")
+                checkpoints.save_weights(model.module.state_dict(), 'best.pth')
                 best_val_mIoU = val_mIoU
                 train_info['best_val_mIOU'] = best_val_mIoU
             # torch.save(model.module.state_dict(), f"{save_dir}/last.pth")
@@ -256,14 +329,21 @@ def train(data_dir, model_dir, args):
                 f"best mIoU : {best_val_mIoU:4.2%}, best loss: {best_val_loss:4.4}"
             )
             train_info['epoch'] = epoch
+            train_info['scaler'] = scaler.state_dict()
             with open(os.path.join(save_dir, 'train_info.json'), 'w') as fp:
                 json.dump(train_info, fp)
-            torch.save(model.module.state_dict(), f"{save_dir}/latest.pth")
+            checkpoints.save_weights(model.module.state_dict(), 'latest.pth')
+            checkpoints.save(training_state(), epoch + 1, 0)
             logger.add_scalar("Val/loss", val_loss, epoch)
             logger.add_scalar("Val/mIoU", val_mIoU, epoch)
+            logger.add_scalar("Val/acc", val_result['acc'], epoch)
+            logger.add_scalar("Val/fwavacc", val_result['fwavacc'], epoch)
+            for category_name, iou in zip(category_names, val_result['IoU']):
+                logger.add_scalar(f"Val/IoU/{category_name}", iou, epoch)
             s = f'Time elapsed: {(time.time() - start_time) / 60: .2f} min'
             print(s)
             print()
+    checkpoints.close()
 
 
 if __name__ == '__main__':
@@ -276,6 +356,9 @@ if __name__ == '__main__':
     parser.add_argument('--augmentation', type=str, default='BaseAugmentation', help='data augmentation type (default: BaseAugmentation)')
     parser.add_argument('--batch_size', type=int, default=8, help='input batch size for training (default: 64)')
     parser.add_argument('--valid_batch_size', type=int, default=8, help='input batch size for validing (default: 1000)')
+    parser.add_argument('--num_workers', type=int, default=4, help='number of DataLoader workers (default: 4)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'], help='autocast precision (default: fp32)')
+    parser.add_argument('--channels_last', '--channels-last', type=bool, default=False, help='channels last memory format')
     parser.add_argument('--model', type=str, default='FCN8s', help='model type (default: BaseModel)')
     parser.add_argument('--optimizer', type=str, default='Adam', help='optimizer type (default: SGD)')
     parser.add_argument('--lr', type=float, default=1e-4, help='learning rate (default: 1e-3)')
@@ -294,9 +377,27 @@ if __name__ == '__main__':
     # Special Augmentations
     parser.add_argument('--copyblob', type=bool, default=False, help='copyblob on')
     parser.add_argument('--cutmix', type=bool, default=True, help='cutmix on (default: False)')
+    parser.add_argument('--cutmix_p', type=float, default=0.3, help='cutmix probability per sample (default: 0.3)')
+    parser.add_argument('--copyblob_src', type=str, default='2,4,5,6,7,8', help='copyblob source classes (default: 2,4,5,6,7,8)')
+    parser.add_argument('--copyblob_dst', type=str, default='0,3', help='copyblob destination classes (default: 0,3)')
     parser.add_argument('--train', type=str, default='train.json')
     parser.add_argument('--val', type=str, default='val.json')
     parser.add_argument('--aug', type=bool, default=True)
+
+    # Data cache
+    parser.add_argument('--cache_source', type=str, default=None, help='annotation file to build the mask cache / image store from (e.g. train_all.json)')
+    parser.add_argument('--image_store', type=bool, default=False, help='read images from the packed uint8 image store')
+    parser.add_argument('--uint8', type=bool, default=False, help='keep images as uint8 until the batch is on the device')
+    parser.add_argument('--dt_cache', type=bool, default=False,
+                        help='read HausdorffDT target distance fields of the val images only from a float16 cache, '
+                             'also with --cache_source train_all.json (12 x 512 x 512 x 2 bytes per image, '
+                             'about 3.9 GiB for val)')
+    parser.add_argument('--dt_backend', type=str, default='torch', choices=['torch', 'scipy'],
+                        help='HausdorffDT distance transform: the exact EDT on the device or scipy on the host')
+    parser.add_argument('--class_aware_sampler', type=bool, default=False, help='oversample images with rare classes')
+    parser.add_argument('--sampler_power', type=float, default=0.5, help='class aware sampler weight = image frequency ** -power (default: 0.5)')
+    parser.add_argument('--checkpoint_interval', type=int, default=0, help='also save a full checkpoint every N steps inside an epoch (default: 0, end of epoch only)')
+    parser.add_argument('--keep_checkpoints', type=int, default=3, help='number of full checkpoints to keep (default: 3)')
     args = parser.parse_args()
 
     seed_everything(args.seed)
@@ -0,0 +1,136 @@
+import time
+import torch
+import torch.nn.functional as F
+from utils import precision_autocast
+
+_flip_dims = {
+    'none': None,
+    'hflip': (3,),
+    'vflip': (2,),
+}
+
+
+def _parse_floats(value):
+    return tuple(float(v) for v in value.split(',') if v != '')
+
+
+class TTA:
+    """multi-scale / flip TTA 를 spec 으로 정의하고 softmax 확률을 하나의 buffer 에 바로 누적합니다.
+
+    spec 예시: 'scales=0.5,1,2;weights=0.3,0.4,0.3;flips=none,hflip'
+      - scales: 입력 크기에 곱할 배율
+      - weights: scale 별 weight (default: 모두 같게)
+      - flips: none, hflip, vflip 중 사용할 것 (flip 끼리는 평균)
+    model 별 weight 는 model_weights 로 줍니다.
+    precision(fp32/fp16/bf16) 으로 model forward 를 autocast 하고, channels_last 면 입력을 channels last 로 바꿉니다.
+    scale / flip / model 의 logit 은 원래 크기로 되돌려 softmax 한 뒤 dtype buffer 에 weight 를 곱해 더하므로
+    중간 결과를 모아두지 않습니다. max_pixels 를 주면 한 번의 forward 에 들어가는 pixel 수를 제한합니다.
+    """
+
+    def __init__(self, scales=(1.,), scale_weights=None, flips=('none',), model_weights=None,
+                 dtype=torch.float16, max_pixels=None, precision='fp32', channels_last=False):
+        for flip in flips:
+            if flip not in _flip_dims:
+                raise ValueError(f'Unknown flip ({flip})')
+        if scale_weights is None:
+            scale_weights = (1. / len(scales),) * len(scales)
+        if len(scale_weights) != len(scales):
+            raise ValueError('scales and weights should have the same length')
+        self.scales = tuple(scales)
+        self.scale_weights = tuple(scale_weights)
+        self.flips = tuple(flips)
+        self.model_weights = None if model_weights is None else tuple(model_weights)
+        self.dtype = dtype
+        self.max_pixels = max_pixels
+        self.precision = precision
+        self.channels_last = channels_last
+
+    @classmethod
+    def from_spec(cls, spec, **kwargs):
+        options = dict(item.split('=', 1) for item in spec.replace(' ', '').split(';') if item)
+        unknown = set(options) - {'scales', 'weights', 'flips'}
+        if unknown:
+            raise ValueError(f'Unknown tta option ({", ".join(sorted(unknown))})')
+        scales = _parse_floats(options.get('scales', '1'))
+        scale_weights = _parse_floats(options['weights']) if 'weights' in options else None
+        flips = tuple(options.get('flips', 'none').split(','))
+        return cls(scales, scale_weights, flips, **kwargs)
+
+    @property
+    def spec(self):
+        return (f"scales={','.join(map(str, self.scales))};"
+                f"weights={','.join(map(str, self.scale_weights))};"
+                f"flips={','.join(self.flips)}")
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.spec})'
+
+    def views(self):
+        """(scale, flip, weight) 조합. weight 는 model weight 를 곱하기 전 값입니다."""
+        for scale, scale_weight in zip(self.scales, self.scale_weights):
+            for flip in self.flips:
+                yield scale, flip, scale_weight / len(self.flips)
+
+    def chunk_size(self, batch_size, height, width):
+        if self.max_pixels is None:
+            return batch_size
+        return max(1, min(batch_size, self.max_pixels // (height * width)))
+
+    @torch.no_grad()
+    def forward_view(self, model, images, scale, flip):
+        """하나의 (scale, flip) view 에 대한 원래 크기의 softmax 확률."""
+        height, width = images.shape[-2:]
+        size = (max(1, round(height * scale)), max(1, round(width * scale)))
+        x = images
+        if size != (height, width):
+            # torch.nn.UpsamplingBilinear2d 와 같은 align_corners=True
+            x = F.interpolate(x, size=size, mode='bilinear', align_corners=True)
+        dims = _flip_dims[flip]
+        if dims is not None:
+            x = torch.flip(x, dims)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with precision_autocast(x.device, self.precision):
+            logits = model(x)
+        if dims is not None:
+            logits = torch.flip(logits, dims)
+        if logits.shape[-2:] != (height, width):
+            logits = F.interpolate(logits, size=(height, width), mode='bilinear', align_corners=True)
+        return torch.softmax(logits.float(), dim=1)
+
+    @torch.no_grad()
+    def __call__(self, models, images):
+        """images: (batch, channel, height, width) -> (batch, num_classes, height, width) 확률 (self.dtype)"""
+        model_weights = self.model_weights or (1. / len(models),) * len(models)
+        if len(model_weights) != len(models):
+            raise ValueError('models and model_weights should have the same length')
+        batch_size, _, height, width = images.shape
+        outs = None
+        for model, model_weight in zip(models, model_weights):
+            for scale, flip, weight in self.views():
+                step = self.chunk_size(batch_size, round(height * scale), round(width * scale))
+                for start in range(0, batch_size, step):
+                    probs = self.forward_view(model, images[start:start + step], scale, flip)
+                    if outs is None:
+                        outs = torch.zeros((batch_size,) + probs.shape[1:], dtype=self.dtype, device=probs.device)
+                    outs[start:start + step].add_(probs, alpha=model_weight * weight)
+        return outs
+
+
+@torch.no_grad()
+def benchmark_tta(models, ttas, images, repeat=3, warmup=1):
+    """TTA 설정 별 throughput(images/s) 을 잽니다."""
+    results = []
+    for tta in ttas:
+        for _ in range(warmup):
+            tta(models, images)
+        if images.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            tta(models, images)
+        if images.is_cuda:
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        results.append({'spec': tta.spec, 'images/s': repeat * len(images) / elapsed})
+    return results
@@ -2,7 +2,9 @@ import numpy as np
 import torch
 import random
 import os
+from contextlib import nullcontext
 from importlib import import_module
+from torch.utils.data import default_collate
 from pycocotools.coco import COCO
 
 
@@ -38,6 +40,262 @@ def label_accuracy_score(label_trues, label_preds, n_class):
     return acc, acc_cls, mean_iu, fwavacc
 
 
+class ConfusionMatrix:
+    """confusion matrix 를 device 위의 tensor 로 누적하고 누적된 전체에 대한 metric 을 계산합니다.
+
+    update 는 미리 만든 hist 에 index_add_ 로 더하므로 host 로 옮기지도, output 크기를 위해 sync 하지도 않습니다.
+    compute 의 결과는 label_accuracy_score 를 전체 dataset 에 한 번에 적용한 것과 같습니다.
+    """
+
+    def __init__(self, num_classes, device=None):
+        self.num_classes = num_classes
+        self.hist = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+
+    @torch.no_grad()
+    def update(self, label_trues, label_preds):
+        label_trues = label_trues.reshape(-1).to(self.hist.device)
+        label_preds = label_preds.reshape(-1).to(self.hist.device)
+        mask = (label_trues >= 0) & (label_trues < self.num_classes)
+        n = self.num_classes
+        # boolean mask 나 bincount 는 output 크기를 정하려고 sync 하므로, 미리 만든 hist 에 index_add_ 로 더합니다.
+        # 범위 밖의 pixel 은 0 번 칸에 0 을 더합니다.
+        index = torch.where(mask, n * label_trues.long() + label_preds.long(), torch.zeros_like(label_trues, dtype=torch.long))
+        self.hist.view(-1).index_add_(0, index, mask.long())
+
+    def reset(self):
+        self.hist.zero_()
+
+    def merge(self, other):
+        self.hist += other.hist.to(self.hist.device)
+        return self
+
+    def all_reduce(self):
+        """data parallel(DDP) 의 모든 replica 의 confusion matrix 를 합칩니다."""
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.hist)
+        return self
+
+    @torch.no_grad()
+    def compute(self):
+        """Returns dict of overall accuracy, mean accuracy, mean IU, IU per class, fwavacc"""
+        hist = self.hist.double()
+        diag = torch.diag(hist)
+        acc = diag.sum() / hist.sum()
+        acc_cls = torch.nanmean(diag / hist.sum(dim=1))
+        iu = diag / (hist.sum(dim=1) + hist.sum(dim=0) - diag)
+        mean_iu = torch.nanmean(iu)
+        freq = hist.sum(dim=1) / hist.sum()
+        fwavacc = (freq[freq > 0] * iu[freq > 0]).sum()
+        # 여기서 한 번만 host 로 옮깁니다.
+        acc, acc_cls, mean_iu, fwavacc, iu = torch.stack([acc, acc_cls, mean_iu, fwavacc]).tolist() + [iu.tolist()]
+        return {'acc': acc, 'acc_cls': acc_cls, 'mIoU': mean_iu, 'IoU': iu, 'fwavacc': fwavacc}
+
+
+def downsample_labels(labels, size, mode='nearest', num_classes=12):
+    """(batch, height, width) label 을 device 위에서 (batch, size, size) 로 줄입니다.
+
+    nearest: A.Resize(size, size) 로 mask 를 줄인 것(cv2 INTER_NEAREST)과 같은 pixel 을 고릅니다.
+    majority: 줄어드는 window 안에서 가장 많은 class 를 고릅니다. (같으면 작은 class)
+    """
+    batch_size, height, width = labels.shape
+    if mode == 'nearest':
+        rows = (torch.arange(size, device=labels.device) * height) // size
+        cols = (torch.arange(size, device=labels.device) * width) // size
+        return labels[:, rows][:, :, cols]
+    if mode == 'majority':
+        if height % size or width % size:
+            raise ValueError(f'majority downsample needs an integer factor, got {(height, width)} -> {size}')
+        fh, fw = height // size, width // size
+        windows = labels.view(batch_size, size, fh, size, fw).permute(0, 1, 3, 2, 4).reshape(batch_size, size, size, fh * fw)
+        counts = torch.nn.functional.one_hot(windows.long(), num_classes).sum(dim=-2)
+        return counts.argmax(dim=-1).to(labels.dtype)
+    raise ValueError(f'Unknown downsample mode ({mode})')
+
+
+def _column_distance_sq(seeds):
+    """(n, height, width) bool seed 에서 같은 column 의 가장 가까운 seed 까지의 거리 제곱 (float32, 없으면 inf)"""
+    pos = torch.arange(seeds.shape[1], dtype=torch.float32, device=seeds.device).view(1, -1, 1).expand(seeds.shape)
+    inf = torch.full_like(pos, float('inf'))
+    above = torch.where(seeds, pos, -inf).cummax(dim=1).values
+    below = torch.where(seeds, pos, inf).flip(1).cummin(dim=1).values.flip(1)
+    dist = torch.minimum(pos - above, below - pos)
+    return dist * dist
+
+
+def _row_distance_sq(f, max_elements):
+    """(rows, n) 의 각 row 에 대해 d(q) = min_p (q - p)^2 + f(p) 를 (rows, q, p) broadcast 의 min 으로 구합니다.
+
+    data 에 따라 달라지는 loop 나 host sync 가 없고, max_elements 를 넘지 않게 row 를 나눠서 계산합니다.
+    f 는 정수 거리 제곱(또는 inf)이고 2^24 보다 작으므로 float32 로도 값이 정확합니다.
+    """
+    num_rows, n = f.shape
+    pos = torch.arange(n, dtype=f.dtype, device=f.device)
+    parabola = (pos.view(-1, 1) - pos.view(1, -1)) ** 2  # (q, p)
+    step = max(1, max_elements // (n * n))
+    out = torch.empty_like(f)
+    for start in range(0, num_rows, step):
+        out[start:start + step] = (f[start:start + step, None, :] + parabola).amin(dim=-1)
+    return out
+
+
+def nearest_seed_distance(seeds, max_elements=2 ** 26):
+    """(N, height, width) bool seed 에서 각 pixel 의 가장 가까운 seed 까지의 euclidean 거리를 device 위에서 구합니다.
+
+    exact separable EDT 입니다. column 방향의 거리는 cummax / cummin 으로, row 방향은 min_p (q - p)^2 + f(p) 로 구하므로
+    scipy.ndimage.distance_transform_edt 와 같은 값입니다. seed 가 하나도 없는 map 은 inf 입니다.
+    row 방향의 broadcast 는 max_elements 개(float32) 씩 계산해서 memory 를 제한합니다.
+    """
+    num_maps, height, width = seeds.shape
+    dist_sq = _row_distance_sq(_column_distance_sq(seeds).view(-1, width), max_elements)
+    # sqrt 는 scipy 처럼 float64 에서 한 뒤 float32 로 바꿉니다.
+    return dist_sq.view(seeds.shape).double().sqrt().float()
+
+
+def _scipy_distance_field(fg):
+    """이전 HausdorffDTLoss.distance_field: map 마다 host 에서 scipy EDT 를 합니다."""
+    from scipy.ndimage import distance_transform_edt as edt
+    field = np.zeros(fg.shape, dtype=np.float32)
+    for i, fg_mask in enumerate(fg):
+        if fg_mask.any():
+            field[i] = edt(fg_mask) + edt(~fg_mask)
+    return field
+
+
+@torch.no_grad()
+def distance_field(masks, backend='torch', max_elements=2 ** 26):
+    """(N, height, width) mask(> 0.5 가 foreground) 의 edt(fg) + edt(bg) 를 구합니다.
+
+    foreground pixel 은 가장 가까운 background 까지, background pixel 은 가장 가까운 foreground 까지의 거리이고
+    foreground 가 없는 map 은 0 입니다. (HausdorffDTLoss 의 scipy 구현과 같은 정의)
+    backend 가 'torch' 면 nearest_seed_distance 로 device 위에서 한 번에 계산하고 (기본값), 'scipy' 면 host 에서
+    map 마다 계산합니다. 두 backend 의 값은 같습니다.
+    'torch' 는 pixel 마다 row 의 모든 pixel 을 보므로 (O(width) 배의 연산) GPU 용이고, CPU 에서는 'scipy' 가 더 빠릅니다.
+    """
+    fg = masks > 0.5
+    if backend == 'scipy':
+        return torch.from_numpy(_scipy_distance_field(fg.cpu().numpy())).to(masks.device)
+    if backend != 'torch':
+        raise ValueError(f'Unknown distance field backend ({backend})')
+    to_bg = nearest_seed_distance(~fg, max_elements)
+    to_fg = nearest_seed_distance(fg, max_elements)
+    # background 가 없는 map 에서 scipy 는 (-1, 0) 에 background 가 있는 것처럼 계산하므로 같은 값을 씁니다.
+    height, width = fg.shape[1:]
+    ys = torch.arange(1, height + 1, dtype=torch.float64, device=fg.device).view(-1, 1)
+    xs = torch.arange(width, dtype=torch.float64, device=fg.device).view(1, -1)
+    corner = (ys * ys + xs * xs).sqrt().float()
+    to_bg = torch.where(torch.isinf(to_bg), corner, to_bg)
+    field = torch.where(fg, to_bg, to_fg)
+    return torch.nan_to_num_(field, posinf=0.)
+
+
+_precision_dtypes = {
+    'fp32': None,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def precision_autocast(device, precision='fp32'):
+    """--precision 에 맞는 autocast context. (cpu 에서는 bf16 을 사용하세요)"""
+    if precision not in _precision_dtypes:
+        raise ValueError(f'Unknown precision ({precision})')
+    dtype = _precision_dtypes[precision]
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+class _PrecisionForward(torch.nn.Module):
+    """replica 의 forward 를 precision_autocast 안에서 부릅니다."""
+
+    def __init__(self, module, device, precision):
+        super().__init__()
+        self.module = module
+        self.device = device
+        self.precision = precision
+
+    def forward(self, *inputs, **kwargs):
+        with precision_autocast(self.device, self.precision):
+            return self.module(*inputs, **kwargs)
+
+
+class PrecisionDataParallel(torch.nn.DataParallel):
+    """GPU 가 여러 개일 때도 --precision 의 dtype 으로 forward 하는 DataParallel.
+
+    DataParallel 은 replica thread 마다 autocast 를 dtype 없이 다시 켜므로 bf16 이 fp16 으로 바뀝니다.
+    replica 마다 forward 안에서 dtype 을 지정해 autocast 를 켭니다. (module 은 그대로라 checkpoint 의 key 는 같습니다)
+    """
+
+    def __init__(self, module, precision='fp32', **kwargs):
+        super().__init__(module, **kwargs)
+        self.precision = precision
+
+    def parallel_apply(self, replicas, inputs, kwargs):
+        replicas = [_PrecisionForward(replica, self.src_device_obj, self.precision) for replica in replicas]
+        return super().parallel_apply(replicas, inputs, kwargs)
+
+
+def normalize_batch(images, mean_std):
+    """uint8 (batch, channel, height, width) 이미지를 float 로 바꾸고 batch 단위로 normalize 합니다."""
+    mean = torch.as_tensor(mean_std[0], dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    std = torch.as_tensor(mean_std[1], dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    images = images.float().div_(255.0)
+    return images.sub_(mean).div_(std)
+
+
+def collate_fn(batch):
+    """DataLoader worker 안에서 image, mask 를 contiguous tensor 로 쌓습니다.
+
+    worker 에서는 default_collate 가 shared memory 에 쌓으므로 main process 로 복사 없이 넘어옵니다.
+    mask 는 dtype 그대로(uint8) 넘기고 device 로 옮긴 뒤 long 으로 바꿉니다.
+    image_infos 는 list 로 그대로 둡니다.
+    """
+    samples = tuple(zip(*batch))
+    images = default_collate(list(samples[0]))  # (batch, channel, height, width)
+    if len(samples) == 2:  # test
+        return images, list(samples[1])
+    masks = default_collate(list(samples[1]))  # (batch, height, width)
+    return images, masks, list(samples[2])
+
+
+class Prefetcher:
+    """DataLoader 를 감싸서 다음 batch 를 별도 cuda stream 에서 미리 device 로 옮겨 둡니다.
+
+    현재 batch 로 학습하는 동안 다음 batch 의 (pinned memory ->) device 전송이 겹쳐서 진행됩니다.
+    cpu 에서는 그냥 순서대로 옮깁니다.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            return tuple(item.to(self.device, non_blocking=True) if torch.is_tensor(item) else item for item in batch)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)
+        loader_iter = iter(self.loader)
+        next_batch = next(loader_iter, None)
+        next_batch = None if next_batch is None else self._to_device(next_batch)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for item in batch:
+                    if torch.is_tensor(item):
+                        item.record_stream(current_stream)
+            next_batch = next(loader_iter, None)
+            next_batch = None if next_batch is None else self._to_device(next_batch)
+            yield batch
+
+
 def seed_everything(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
@@ -56,10 +314,8 @@ def seed_worker(_worker_id):
 
 
 def load_model(model_dir, num_classes, device, args, model_name, mode='train', file_name='best.pth'):
-    model_cls = getattr(import_module("model"), model_name)
-    model = model_cls(
-        num_classes=num_classes
-    )
+    # weight 를 바로 읽으므로 pretrained encoder 는 받지 않습니다.
+    model = import_module("model").build_model(model_name, num_classes, pretrained=False)
     if mode == 'train':
         model_path = os.path.join(model_dir, args.name, file_name)
     elif mode == 'inference':
@@ -95,20 +351,15 @@ def copyblob(src_img, src_mask, dst_img, dst_mask, src_class, dst_class):
         dst_img[:, dst_idx[0], dst_idx[1]] = src_img[:, src_idx[0], src_idx[1]]
 
 
-def get_classes_count():
-    # 모든 사진들로부터 background를 제외한 클래스별 픽셀 카운트를 구합니다.
-    coco = COCO("../input/data/train_all.json")
-    annotations = coco.loadAnns(coco.getAnnIds())
-    class_num = len(coco.getCatIds())
-    classes_count = [0] * class_num
-    for annotation in annotations:
-        class_id = annotation["category_id"]
-        pixel_count = np.sum(coco.annToMask(annotation))
-        classes_count[class_id] += pixel_count
-    # background의 픽셀 카운트를 계산합니다.
-    image_num = len(coco.getImgIds())
-    total_pixel_count = image_num * 512 * 512
-    background_pixel_count = total_pixel_count - sum(classes_count)
-    # 모든 클래스별 픽셀 카운트를 구합니다.
-    nclasses_count = [background_pixel_count] + classes_count
-    return nclasses_count
+def get_classes_count(annotation_path="../input/data/train_all.json"):
+    # 모든 사진들로부터 클래스별 픽셀 카운트를 구합니다. [background] + category_id 순서
+    # annotation 을 rasterize 하지 않고 cache.ClassStats 의 RLE area 를 사용합니다.
+    from cache import ClassStats  # cache 가 utils 를 import 합니다.
+    category_names = ['Backgroud', 'UNKNOWN', 'General trash', 'Paper', 'Paper pack', 'Metal', 'Glass', 'Plastic',
+                      'Styrofoam', 'Plastic bag', 'Battery', 'Clothing']
+    stats = ClassStats(annotation_path, category_names)
+    classes_count = stats.classes_count
+    # background 는 전체 pixel 에서 나머지를 뺀 값입니다.
+    background_pixel_count = int(classes_count[0])
+    order = np.argsort(stats.category_ids[1:]) + 1
+    return [background_pixel_count] + [int(classes_count[i]) for i in order]